@@ -1,24 +1,209 @@
 import os
+import time
+from datetime import datetime, timedelta
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, abort, current_app, jsonify, request, stream_with_context
 from werkzeug.exceptions import HTTPException
 from flask_cors import CORS
 
-from auth import AuthError, RequiresAuth
-from common_handles import db, migrate
-from models import film_actors, Actor, Film, setup_db
+import compression, import_jobs, metrics, replicas
+from warmup import readiness, warm_worker
+from auth import AuthError, RequiresAuth, settings_from_env, token_cache
+from common_handles import db
+from models import film_actors, Actor, Film, setup_db, keyset_page, keyset_rows, stream_batches, cast_of, \
+    bulk_insert, bulk_link, update_rows, delete_rows, missing_ids, on_write, engines, pool_status, changes_since, \
+    last_modified
+from params import page_args, filter_args, sort_args, changes_args, graph_args, validate_rows, validate_changes, \
+    target_args, batch_items, ndjson_items, NDJSON, MAX_BATCH_ROWS
+from serialise import dumps, encode_rows, list_document, row_encoder
+from response_cache import cache, cache_tags
+from idempotency import idempotent
+from rate_limit import list_slots
+from replicas import pin_writer
+from costar_graph import graph, rows_by_id
+from import_jobs import job_status, start_import
+
+STREAM_CHUNK_ROWS = 500
+
+# Committed writes invalidate the cached GET responses that depend on them
+on_write(cache.invalidate)
+# ...and keep the client that wrote reading from the primary until replicas catch up
+on_write(pin_writer)
+
+# Cache and connection pool statistics, alongside the latency histograms on /metrics
+def cache_metrics():
+    token_stats = token_cache.stats()
+    return metrics.gauges(
+        'auth_token_cache_events_total', 'Verified-token cache lookups and evictions.',
+        {(('result', result),): token_stats[result] for result in ('hits', 'misses', 'evictions')},
+        kind='counter') + metrics.gauges(
+        'response_cache_lookups_total', 'Response cache lookups.',
+        {(('result', result),): value for result, value in cache.stats().items()}, kind='counter')
+
+
+def pool_metrics():
+    statuses = {name: pool_status(name) for name in engines()}
+    lines = []
+    for stat, value in statuses['primary'].items():
+        if isinstance(value, (int, float)):
+            lines += metrics.gauges('db_pool_' + stat, 'Connection pool ' + stat.replace('_', ' ') + '.',
+                                    {(('engine', name),): status[stat] for name, status in statuses.items()
+                                     if stat in status})
+    return lines
+
+
+metrics.collectors['cache'] = cache_metrics
+metrics.collectors['db_pool'] = pool_metrics
+
+
+def read_batch(key):
+    """ Read a batch request body: a JSON array, {"<key>": [...]}, or NDJSON lines. """
+    if request.mimetype == NDJSON:
+        items = ndjson_items(request.get_data(as_text=True))
+    else:
+        items = request.get_json(silent=True)
+    return batch_items(items, key, MAX_BATCH_ROWS)
+
+
+def list_response(model, key, cast_key):
+    """ A page of `model` rows, a streamed export, or a page with include=cast. """
+    fields, after, limit = page_args(model, request.args)
+    criteria = filter_args(model, request.args)
+    order = sort_args(model, request.args, after)
+    fmt = export_format()
+    if fmt:
+        return export_response(model, key, fmt, fields, after, criteria, order)
+    with_cast = 'cast' in request.args.get('include', '').split(',')
+    modified = last_modified(model)
+    if with_cast:
+        modified = max([time for time in (modified, last_modified(Actor if model is Film else Film)) if time],
+                       default=None)
+    if not_modified(modified):
+        return with_last_modified(Response(status=304), modified)
+    if with_cast:
+        # Nested rows: build dicts and attach the cast, then encode the whole document
+        cache_tags('cast', 'actor' if model is Film else 'film')
+        rows, next_cursor = keyset_page(model, fields, after, limit, criteria, order)
+        cast = cast_of(model, [row['id'] for row in rows])
+        for row in rows:
+            row[cast_key] = cast[row['id']]
+        body = dumps({"Success": "True", key: rows, "next": next_cursor})
+    else:
+        # Fixed columns: encode straight from the Row tuples
+        fields, rows, next_cursor = keyset_rows(model, fields, after, limit, criteria, order)
+        body = list_document(key, encode_rows(model, fields, rows), next_cursor)
+    return with_last_modified(Response(body, mimetype='application/json'), modified)
+
+
+def not_modified(modified):
+    """ Whether the client's copy, per If-Modified-Since, is current. If-None-Match takes precedence. """
+    since = request.if_modified_since
+    if modified is None or since is None or request.if_none_match:
+        return False
+    return modified <= since.replace(tzinfo=None)
+
+
+def with_last_modified(response, modified):
+    """ Send Last-Modified only once its (whole) second is over, so any later write moves it on. """
+    if modified is not None:
+        header = modified.replace(microsecond=0) + timedelta(seconds=1 if modified.microsecond else 0)
+        if header <= datetime.utcnow():
+            response.last_modified = header
+    return response
+
+
+def export_format():
+    """ Which streaming export, if any, the client asked for: 'ndjson', 'json' or None. """
+    requested = request.args.get('stream')
+    if requested in ('ndjson', 'json'):
+        return requested
+    if request.accept_mimetypes.best == NDJSON:
+        return 'ndjson'
+    return None
+
+
+def export_response(model, key, fmt, fields=None, after=None, criteria=None, order=None):
+    """ Stream a whole table as NDJSON, or as a chunked JSON array shaped like the list response. """
+    started = time.perf_counter()
+
+    def generate():
+        ttfb = None
+        if fmt == 'json':
+            yield '{"Success": "True", "%s": [' % key
+        row_fields, batches = stream_batches(model, fields, after, criteria, STREAM_CHUNK_ROWS, order)
+        encoder = row_encoder(model, row_fields)
+        separator = '\n' if fmt == 'ndjson' else ','
+        first = True
+        for rows in batches:
+            chunk = separator.join([encoder(row) for row in rows])
+            if fmt == 'ndjson':
+                chunk += '\n'
+            elif not first:
+                chunk = ',' + chunk
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+            first = False
+            yield chunk
+        if fmt == 'json':
+            yield ']}'
+        current_app.logger.info("%s export: first rows after %.1f ms, done after %.1f ms",
+                                key, 1000 * (ttfb or time.perf_counter() - started),
+                                1000 * (time.perf_counter() - started))
+
+    return Response(stream_with_context(generate()),
+                    mimetype=NDJSON if fmt == 'ndjson' else 'application/json')
+
+
+def patch_one(model, key, id):
+    """ Set the supplied fields of one row, in a single UPDATE ... RETURNING; 404 if there's no such row. """
+    changes = validate_changes(model, request.get_json(silent=True))
+    rows = update_rows(model, changes, ids=[id], fields=model.default_fields)
+    if not rows:
+        abort(404, description=f"{model.__name__} not found.")
+    return Response(dumps({"Success": "True", key: dict(zip(model.default_fields, rows[0]))}),
+                    mimetype='application/json')
+
+
+def patch_many(model):
+    """ Set the same fields on every row given by "ids", or matching the search parameters. """
+    body = request.get_json(silent=True)
+    ids, criteria = target_args(model, request.args, body, MAX_BATCH_ROWS)
+    changes = validate_changes(model, body.get('changes') if isinstance(body, dict) else None)
+    ids = [row[0] for row in update_rows(model, changes, ids, criteria)]
+    return jsonify({"Success": "True", "updated": len(ids), "ids": ids})
+
+
+def delete_one(model, id):
+    """ Delete one row (and its casting links); 404 if there's no such row. """
+    if not delete_rows(model, ids=[id]):
+        abort(404, description=f"{model.__name__} not found.")
+    return jsonify({"Success": "True", "deleted": 1, "ids": [id]})
+
+
+def delete_many(model):
+    """ Delete every row given by "ids", or matching the search parameters. """
+    ids, criteria = target_args(model, request.args, request.get_json(silent=True), MAX_BATCH_ROWS)
+    ids = delete_rows(model, ids, criteria)
+    return jsonify({"Success": "True", "deleted": len(ids), "ids": ids})
 
 
 def create_app():
     """ Create the main App instance. """
     app = Flask(__name__)
     setup_db(app)
+    metrics.init_app(app)
+    compression.init_app(app)
+    replicas.init_app(app)
+    import_jobs.init_app(app)
     CORS(app)
 
-    AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-    API_AUDIENCE = os.environ['API_AUDIENCE']
-    AUTH0_CLIENT_ID = os.environ['AUTH0_CLIENT_ID']
-    AUTH0_CALLBACK_URL = os.environ['AUTH0_CALLBACK_URL']
+    app.config.update(
+        AUTH0_CLIENT_ID=os.environ.get('AUTH0_CLIENT_ID'),
+        AUTH0_CALLBACK_URL=os.environ.get('AUTH0_CALLBACK_URL'),
+        **settings_from_env())
+    # `flask db ...` and `flask shell` need the migration commands; serving doesn't
+    if os.environ.get('FLASK_RUN_FROM_CLI'):
+        init_cli(app)
 
     @app.after_request
     def after_request(response):
@@ -34,42 +219,130 @@ def create_app():
 
     @app.route('/status')
     def status():
+        """ Health check, with the database connection pools' metrics. """
         return jsonify({
-            "Success": "True"
+            "Success": "True",
+            "database": pool_status(),
+            "replicas": {name: pool_status(name) for name in engines() if name != 'primary'}
         })
     
+    @app.route('/ready')
+    def ready():
+        """ Readiness check: 200 once this worker has its signing keys and database connections, else 503. """
+        return jsonify(readiness.status()), 200 if readiness.ready else 503
+
+    @app.route('/metrics')
+    def get_metrics():
+        """ Request latency (per endpoint and phase), cache and pool metrics, in the Prometheus text format. """
+        return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
     # GET All endpoints - All Films & All Actors
 
     @app.route('/films')
     @RequiresAuth('get:film')
+    @cache.cached('film', 'cast', bypass=export_format)
+    @list_slots
     def get_films(p):
-      """Return the serialised set of Films from the DB"""
-      films = Film.query.all()
-      fetched_films = []
-      for film in films:
-        fetched_films.append(film.format())
+      """Return a page of serialised Films from the DB (keyset paginated on id)"""
+      return list_response(Film, "films", "actors")
+
+    @app.route('/actors')
+    @RequiresAuth('get:actor')
+    @cache.cached('actor', 'cast', bypass=export_format)
+    @list_slots
+    def get_actors(p):
+      """Return a page of serialised Actors from the DB (keyset paginated on id)"""
+      return list_response(Actor, "actors", "films")
+
+    @app.route('/changes')
+    @RequiresAuth('get:film', 'get:actor')
+    @list_slots
+    def get_changes(p):
+      """Films and actors written or deleted since change number `since`, for incremental sync"""
+      since, limit = changes_args(request.args)
+      changed, deleted, next_since, more = changes_since(since, limit)
+      return Response(dumps({
+        "Success": "True",
+        "films": changed[Film],
+        "actors": changed[Actor],
+        "deleted": {"films": deleted[Film], "actors": deleted[Actor]},
+        "next": next_since,
+        "more": more
+      }), mimetype='application/json')
+
+    # GET cast endpoints - Actors in a Film & Films of an Actor
+
+    @app.route('/films/<int:film_id>/actors')
+    @RequiresAuth('get:actor')
+    @cache.cached()
+    def get_film_actors(p, film_id):
+      """Return the cast of a Film"""
+      if Film.query.with_entities(Film.id).filter_by(id=film_id).scalar() is None:
+        abort(404, description="Film not found.")
+      actors = cast_of(Film, [film_id])[film_id]
+      cache_tags('film:%d' % film_id, 'cast:film:%d' % film_id, *['actor:%d' % actor['id'] for actor in actors])
       return jsonify({
         "Success": "True",
-        "films": fetched_films
+        "actors": actors
       })
 
-    @app.route('/actors')
+    @app.route('/actors/<int:actor_id>/films')
+    @RequiresAuth('get:film')
+    @cache.cached()
+    def get_actor_films(p, actor_id):
+      """Return the filmography of an Actor"""
+      if Actor.query.with_entities(Actor.id).filter_by(id=actor_id).scalar() is None:
+        abort(404, description="Actor not found.")
+      films = cast_of(Actor, [actor_id])[actor_id]
+      cache_tags('actor:%d' % actor_id, 'cast:actor:%d' % actor_id, *['film:%d' % film['id'] for film in films])
+      return jsonify({
+        "Success": "True",
+        "films": films
+      })
+
+    # GET co-star endpoints - Co-stars of an Actor & the shortest chain of co-stars between two
+
+    @app.route('/actors/<int:actor_id>/costars')
     @RequiresAuth('get:actor')
-    def get_actors(p):
-      """Return the serialised set of Actors from the DB"""
-      actors = Actor.query.all()
-      fetched_actors = []
-      for actor in actors:
-        fetched_actors.append(actor.format())
+    @cache.cached('cast')
+    def get_actor_costars(p, actor_id):
+      """Return the actors who shared most films with an Actor, from the co-star index"""
+      limit, _ = graph_args(request.args)
+      if Actor.query.with_entities(Actor.id).filter_by(id=actor_id).scalar() is None:
+        abort(404, description="Actor not found.")
+      total, top = graph.refresh().costars(actor_id, limit)
+      actors = rows_by_id(Actor, [id for id, _ in top])
+      cache_tags('actor:%d' % actor_id, *['actor:%d' % id for id, _ in top])
       return jsonify({
         "Success": "True",
-        "actors": fetched_actors
+        "total": total,
+        "costars": [dict(actors[id], shared_films=shared) for id, shared in top if id in actors]
+      })
+
+    @app.route('/actors/<int:actor_id>/path/<int:other_id>')
+    @RequiresAuth('get:actor', 'get:film')
+    @cache.cached('cast')
+    def get_actor_path(p, actor_id, other_id):
+      """Return a shortest chain of co-stars linking two Actors, and the films linking them"""
+      _, max_degrees = graph_args(request.args)
+      if missing_ids(Actor, {actor_id, other_id}):
+        abort(404, description="Actor not found.")
+      path = graph.refresh().path(actor_id, other_id, max_degrees)
+      actor_ids, film_ids = path or ([], [])
+      actors, films = rows_by_id(Actor, actor_ids), rows_by_id(Film, film_ids)
+      cache_tags(*['actor:%d' % id for id in actor_ids], *['film:%d' % id for id in film_ids])
+      return jsonify({
+        "Success": "True",
+        "degrees": len(film_ids) if path else None,
+        "actors": [actors[id] for id in actor_ids if id in actors],
+        "films": [films[id] for id in film_ids if id in films]
       })
 
     # POST endpoints - Add a Film & Add an Actor
 
     @app.route('/film', methods=['POST'])
     @RequiresAuth('post:film')
+    @idempotent
     def post_film(p):
         """ Endpoint to add a film. """
         request_data = request.get_json()
@@ -84,6 +357,7 @@ def create_app():
 
     @app.route('/actor', methods=['POST'])
     @RequiresAuth('post:actor')
+    @idempotent
     def post_actor(p):
         """ Endpoint to add an actor. """
         request_data = request.get_json()
@@ -97,8 +371,164 @@ def create_app():
             "actor": actor.format()
         })
 
+    # Batch POST endpoints - Add many Films, Actors or casting links at once
+
+    @app.route('/films', methods=['POST'])
+    @RequiresAuth('post:film')
+    def post_films(p):
+        """ Endpoint to add a batch of films (JSON array or NDJSON). """
+        rows = validate_rows(Film, read_batch("films"))
+        ids = bulk_insert(Film, rows)
+        return jsonify({
+            "Success": "True",
+            "created": len(ids),
+            "ids": ids
+        })
+
+    @app.route('/actors', methods=['POST'])
+    @RequiresAuth('post:actor')
+    def post_actors(p):
+        """ Endpoint to add a batch of actors (JSON array or NDJSON). """
+        rows = validate_rows(Actor, read_batch("actors"))
+        ids = bulk_insert(Actor, rows)
+        return jsonify({
+            "Success": "True",
+            "created": len(ids),
+            "ids": ids
+        })
+
+    @app.route('/casting', methods=['POST'])
+    @RequiresAuth('patch:film')
+    def post_casting(p):
+        """ Endpoint to cast actors in films, from a batch of {film_id, actor_id} links. """
+        rows = validate_rows(film_actors, read_batch("links"))
+        for model, field in ((Film, 'film_id'), (Actor, 'actor_id')):
+            missing = missing_ids(model, {row[field] for row in rows})
+            if missing:
+                abort(400, description=f"Unknown {field}(s): " + ", ".join(map(str, sorted(missing)[:20])))
+        created = bulk_link([(row['film_id'], row['actor_id']) for row in rows])
+        return jsonify({
+            "Success": "True",
+            "created": created
+        })
+
+    # Background imports - queue a CSV or NDJSON file, then poll the job
+
+    @app.route('/imports/films', methods=['POST'])
+    @RequiresAuth('post:film')
+    def import_films(p):
+        """ Endpoint to queue a file of films for loading in the background. """
+        return start_import(p, 'films')
+
+    @app.route('/imports/actors', methods=['POST'])
+    @RequiresAuth('post:actor')
+    def import_actors(p):
+        """ Endpoint to queue a file of actors for loading in the background. """
+        return start_import(p, 'actors')
+
+    @app.route('/imports/casting', methods=['POST'])
+    @RequiresAuth('patch:film')
+    def import_casting(p):
+        """ Endpoint to queue a file of {film_id, actor_id} links for loading in the background. """
+        return start_import(p, 'casting')
+
+    @app.route('/imports/<int:job_id>')
+    @RequiresAuth(any_of=('post:film', 'post:actor', 'patch:film'))
+    def get_import(p, job_id):
+        """ Progress of one of the caller's import jobs. """
+        job = job_status(job_id, p.get('sub'))
+        if job is None:
+            abort(404, description="Import job not found.")
+        return Response(dumps({"Success": "True", "job": job}), mimetype='application/json')
+
+    # PATCH & DELETE endpoints - one Film or Actor, or many by id or by search parameters
+
+    @app.route('/films/<int:film_id>', methods=['PATCH'])
+    @RequiresAuth('patch:film')
+    def patch_film(p, film_id):
+        """ Endpoint to change the supplied fields of a film. """
+        return patch_one(Film, "film", film_id)
+
+    @app.route('/actors/<int:actor_id>', methods=['PATCH'])
+    @RequiresAuth('patch:actor')
+    def patch_actor(p, actor_id):
+        """ Endpoint to change the supplied fields of an actor. """
+        return patch_one(Actor, "actor", actor_id)
+
+    @app.route('/films', methods=['PATCH'])
+    @RequiresAuth('patch:film')
+    def patch_films(p):
+        """ Endpoint to apply {"changes": {...}} to films given by "ids" or matching search parameters. """
+        return patch_many(Film)
+
+    @app.route('/actors', methods=['PATCH'])
+    @RequiresAuth('patch:actor')
+    def patch_actors(p):
+        """ Endpoint to apply {"changes": {...}} to actors given by "ids" or matching search parameters. """
+        return patch_many(Actor)
+
+    @app.route('/films/<int:film_id>', methods=['DELETE'])
+    @RequiresAuth('delete:film')
+    def delete_film(p, film_id):
+        """ Endpoint to delete a film and its casting links. """
+        return delete_one(Film, film_id)
+
+    @app.route('/actors/<int:actor_id>', methods=['DELETE'])
+    @RequiresAuth('delete:actor')
+    def delete_actor(p, actor_id):
+        """ Endpoint to delete an actor and its casting links. """
+        return delete_one(Actor, actor_id)
+
+    @app.route('/films', methods=['DELETE'])
+    @RequiresAuth('delete:film')
+    def delete_films(p):
+        """ Endpoint to delete the films given by "ids" or matching search parameters. """
+        return delete_many(Film)
+
+    @app.route('/actors', methods=['DELETE'])
+    @RequiresAuth('delete:actor')
+    def delete_actors(p):
+        """ Endpoint to delete the actors given by "ids" or matching search parameters. """
+        return delete_many(Actor)
+
     """ Error Handlers. """
 
+    @app.errorhandler(400)
+    def handle_bad_request(error):
+        """ Handler for Bad Request 400. """
+        return jsonify({"Success": "False",
+        "Error": 400,
+        "Message": error.description}), 400
+
+    @app.errorhandler(404)
+    def handle_not_found(error):
+        """ Handler for Not Found 404. """
+        return jsonify({"Success": "False",
+        "Error": 404,
+        "Message": error.description}), 404
+
+    @app.errorhandler(409)
+    def handle_conflict(error):
+        """ Handler for Conflict 409. """
+        return jsonify({"Success": "False",
+        "Error": 409,
+        "Message": error.description}), 409
+
+    @app.errorhandler(422)
+    def handle_unprocessable(error):
+        """ Handler for Unprocessable Entity 422. """
+        return jsonify({"Success": "False",
+        "Error": 422,
+        "Message": error.description}), 422
+
+    @app.errorhandler(429)
+    @app.errorhandler(503)
+    def handle_retry_later(error):
+        """ Handler for Too Many Requests 429 and Service Unavailable 503, with Retry-After. """
+        return jsonify({"Success": "False",
+        "Error": error.code,
+        "Message": error.description}), error.code, {'Retry-After': str(error.retry_after or 1)}
+
     @app.errorhandler(500)
     def handle_ISE(error):
         """ Handler for Internal Server Error 500. """
@@ -125,20 +555,37 @@ def create_app():
 
     return app
 
-app = create_app()
+def init_cli(app):
+    """ Register Flask-Migrate (and so Alembic) and the shell context, for CLI commands only. """
+    from common_handles import migrate
+    migrate.init_app(app, db)
+    app.shell_context_processor(make_shell_context)
+    return app
 
-if __name__ == '__main__':
-    app.run()
 
-@app.shell_context_processor
 def make_shell_context():
     print ("Welcome to Interactive Mode.")
     print ("============================")
     print ("The following structures are available: db, app, Actor, Film, and film_actors.")
     return {
             'db': db,
-            'app': app,
+            'app': current_app._get_current_object(),
             'Actor': Actor,
             'Film': Film,
             'film_actors': film_actors
             }
+
+
+def __getattr__(name):
+    """ `app` (e.g. gunicorn's app:app) is created on first use, not on every import of this module. """
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if __name__ == '__main__':
+    app = create_app()
+    warm_worker(app, forked=False)
+    app.run()
@@ -0,0 +1,434 @@
+"""Async serving mode: the API as an ASGI app on an async database engine.
+
+    uvicorn asgi:app --workers 2
+
+The sync Flask app (gunicorn app:app) is unchanged. Both share the models,
+query building, parameter validation and auth code; here database round trips
+and JWKS fetches are awaited, so one worker serves many requests at once.
+
+Served here as in the Flask app: GET /, /status, /metrics; GET /films and
+/actors (fields, search, sort and include=cast, but not the stream= exports);
+the cast endpoints; POST /film and /actor (with Idempotency-Key); and the batch
+POST /films, /actors and /casting. List responses aren't cached and carry no
+Last-Modified. Everything else is Flask-only and listed in FLASK_ONLY: those
+get an explicit 404, or a 405 on a path that is served for another method.
+"""
+import json, re, time
+from urllib.parse import parse_qsl
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.exceptions import HTTPException
+
+import idempotency, metrics
+from auth import AuthError, Permissions, check_permissions, parse_auth_header, settings_from_env, verify_token_async
+from db_pool import engine_options
+from models import film_actors, Actor, Film, database_url, projection, page_result, cast_select, group_cast, \
+    notify_write, change_log, change_rows, bump, cast_tags, BULK_CHUNK_SIZE
+from params import page_args, filter_args, sort_args, validate_rows, batch_items, ndjson_items, NDJSON, \
+    MAX_BATCH_ROWS
+from rate_limit import limiter, list_slots
+from serialise import dumps, encode_rows, list_document
+
+# Async DBAPI drivers to use in place of the sync ones
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_url(url):
+    scheme, rest = url.split('://', 1)
+    return ASYNC_DRIVERS.get(scheme.split('+')[0], scheme) + '://' + rest
+
+
+def create_engine(url=None):
+    """An async engine with the same pool settings as the sync app."""
+    url = url or database_url()
+    options = engine_options(url)
+    options.pop('poolclass', None)   # the async engine brings its own queue pool
+    return create_async_engine(async_url(url), **options)
+
+
+## Requests and responses
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = dict(parse_qsl(scope.get('query_string', b'').decode()))
+        self.headers = {name.decode().lower(): value.decode() for name, value in scope.get('headers', [])}
+        self.body = body
+        self.client = (scope.get('client') or ('',))[0]
+
+    def json(self):
+        try:
+            return json.loads(self.body or b'null')
+        except ValueError:
+            return None
+
+    @property
+    def mimetype(self):
+        return self.headers.get('content-type', '').split(';')[0].strip().lower()
+
+
+def json_response(payload, status=200):
+    return status, 'application/json', dumps(payload)
+
+
+def error_response(status, message):
+    return json_response({"Success": "False", "Error": status, "Message": message}, status)
+
+
+## Routing
+ROUTES = []
+
+
+def route(path, method='GET', permission=None):
+    """Register an async handler; `<int:name>` path segments become keyword arguments."""
+    pattern = re.compile('^' + re.sub(r'<int:(\w+)>', r'(?P<\1>\\d+)', path) + '$')
+    if permission is not None:
+        permission = Permissions((permission,))
+
+    def decorator(handler):
+        ROUTES.append((method, pattern, path, permission, handler))
+        return handler
+    return decorator
+
+
+class AsyncCastingApp:
+    """Minimal ASGI application dispatching to the handlers registered with @route."""
+
+    def __init__(self, url=None, config=None):
+        self.url = url
+        self.config = config   # the auth settings; from the environment on first use unless given
+        self.engine = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        started = time.perf_counter()
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        request = Request(scope, body)
+        # Handlers return (status, mimetype, content), optionally followed by extra headers
+        endpoint, (status, mimetype, content, *extra) = await self.dispatch(request)
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', mimetype.encode()),
+            (b'content-length', str(len(content)).encode()),
+            (b'access-control-allow-origin', b'*'),
+            (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+            (b'access-control-allow-methods', b'GET,PATCH,POST,DELETE')] +
+            [(name.encode(), value.encode()) for headers in extra for name, value in headers.items()]})
+        await send({'type': 'http.response.body', 'body': content})
+        metrics.request_latency.observe(time.perf_counter() - started, endpoint, request.method, str(status))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.engine = create_engine(self.url)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.engine is not None:
+                    await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, request):
+        if self.engine is None:   # servers that skip the lifespan protocol
+            self.engine = create_engine(self.url)
+        if self.config is None:
+            self.config = settings_from_env()
+        allowed = False
+        for method, pattern, path, permission, handler in ROUTES:
+            match = pattern.match(request.path)
+            if not match:
+                continue
+            allowed = True
+            if method != request.method:
+                continue
+            try:
+                payload = None
+                if permission is not None:
+                    payload = await verify_token_async(parse_auth_header(request.headers.get('authorization')),
+                                                      self.config)
+                    limiter.check(permission, payload, request.client)
+                    check_permissions(permission, payload)
+                params = {name: int(value) for name, value in match.groupdict().items()}
+                return path, await handler(self, request, payload, **params)
+            except AuthError as error:
+                return path, error_response(error.status_code, error.error['description'])
+            except HTTPException as error:
+                retry_after = getattr(error, 'retry_after', None)
+                if retry_after:
+                    return path, error_response(error.code, error.description) + ({'retry-after': str(retry_after)},)
+                return path, error_response(error.code, error.description)
+            except Exception:
+                return path, error_response(500, "Internal Server Error.")
+        if allowed:
+            return 'unmatched', error_response(405, "Method Not Allowed.")
+        return 'unmatched', error_response(404, "Not Found.")
+
+    async def stored_response(self, digest, fingerprint):
+        """The response stored for an Idempotency-Key, from this worker's store or the database."""
+        stored = idempotency.store.get(digest)
+        if stored is not None:
+            return idempotency.check_fingerprint(stored, fingerprint)
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(idempotency.lookup(digest))).first()
+        stored = idempotency.stored_response(row, fingerprint)
+        if stored is not None:
+            idempotency.store.set(digest, stored)
+        return stored
+
+    async def fetch_all(self, query):
+        async with self.engine.connect() as conn:
+            return (await conn.execute(query)).all()
+
+
+## Endpoints
+@route('/')
+async def get_greeting(app, request, p):
+    """ Friendly welcome message advising that this is an API service. """
+    return 200, 'text/html', b"Welcome to the Casting Database - API (Application Programming Interface) layer."
+
+
+@route('/status')
+async def status(app, request, p):
+    return json_response({"Success": "True", "mode": "asgi"})
+
+
+@route('/metrics')
+async def get_metrics(app, request, p):
+    return 200, 'text/plain; version=0.0.4', metrics.exposition().encode()
+
+
+async def list_response(app, request, model, key, cast_key):
+    """A page of `model` rows, with include=cast and the search filters, as in the Flask app."""
+    if request.args.get('stream') or request.headers.get('accept', '').startswith(NDJSON):
+        return error_response(400, "Streamed exports are only served by the Flask app (gunicorn app:app).")
+    fields, after, limit = page_args(model, request.args)
+    order = sort_args(model, request.args, after)
+    fields, query = projection(model, fields, after, filter_args(model, request.args), order)
+    rows, next_cursor = page_result(await app.fetch_all(query.limit(limit + 1)), limit, order)
+    if 'cast' not in request.args.get('include', '').split(','):
+        return 200, 'application/json', list_document(key, encode_rows(model, fields, rows), next_cursor)
+    rows = [dict(zip(fields, row)) for row in rows]
+    if rows:
+        related = {row['id']: [] for row in rows}
+        cast_fields, cast_query = cast_select(model, related)
+        group_cast(related, cast_fields, await app.fetch_all(cast_query))
+        for row in rows:
+            row[cast_key] = related[row['id']]
+    return json_response({"Success": "True", key: rows, "next": next_cursor})
+
+
+@route('/films', permission='get:film')
+async def get_films(app, request, p):
+    async with list_slots.admitted('get_films'):
+        return await list_response(app, request, Film, "films", "actors")
+
+
+@route('/actors', permission='get:actor')
+async def get_actors(app, request, p):
+    async with list_slots.admitted('get_actors'):
+        return await list_response(app, request, Actor, "actors", "films")
+
+
+async def cast_response(app, model, id, key):
+    if not await app.fetch_all(projection(model, ['id'])[1].where(model.id == id)):
+        return error_response(404, "%s not found." % model.__name__)
+    fields, query = cast_select(model, [id])
+    related = group_cast({id: []}, fields, await app.fetch_all(query))
+    return json_response({"Success": "True", key: related[id]})
+
+
+@route('/films/<int:film_id>/actors', permission='get:actor')
+async def get_film_actors(app, request, p, film_id):
+    return await cast_response(app, Film, film_id, "actors")
+
+
+@route('/actors/<int:actor_id>/films', permission='get:film')
+async def get_actor_films(app, request, p, actor_id):
+    return await cast_response(app, Actor, actor_id, "films")
+
+
+async def insert_response(app, request, p, model, key):
+    """Insert one row from the JSON body and return it, as POST /film and /actor do.
+
+    With an Idempotency-Key, the key and the response are stored in the insert's
+    transaction, and a repeated key gets the stored response back.
+    """
+    row = validate_rows(model, [request.json()])[0]
+    prepare = getattr(model, 'prepare_row', None)
+    claim = idempotency.request_key(p, request.method, request.path,
+                                    request.headers.get('idempotency-key'), request.body)
+    if claim is not None:
+        stored = await app.stored_response(*claim)
+        if stored is not None:
+            return replayed(stored)
+    try:
+        async with app.engine.begin() as conn:
+            if claim is not None:
+                await conn.execute(idempotency.expired(claim[0]))
+                await conn.execute(idempotency.reserve(*claim))
+            result = await conn.execute(insert(model.__table__).values(prepare(row) if prepare else row))
+            id = result.inserted_primary_key[0]
+            await conn.execute(insert(change_log), change_rows(model.__tablename__, [id]))
+            response = json_response({"Success": "True", key: dict(row, id=id)})
+            if claim is not None:
+                await conn.execute(idempotency.finish(claim[0], response[0], response[2]))
+    except IntegrityError:
+        if claim is None:
+            raise
+        # Another worker committed this key since the lookup
+        stored = await app.stored_response(*claim)
+        if stored is None:
+            return error_response(409, "A request with this Idempotency-Key is still in progress.")
+        return replayed(stored)
+    if claim is not None:
+        idempotency.store.set(claim[0], idempotency.Stored(claim[1], response[0], response[2]))
+    notify_write(model.__tablename__)
+    return response
+
+
+def replayed(stored):
+    return stored.status, 'application/json', stored.body, {'idempotent-replayed': 'true'}
+
+
+@route('/film', method='POST', permission='post:film')
+async def post_film(app, request, p):
+    return await insert_response(app, request, p, Film, "film")
+
+
+@route('/actor', method='POST', permission='post:actor')
+async def post_actor(app, request, p):
+    return await insert_response(app, request, p, Actor, "actor")
+
+
+## Batch inserts, as models.bulk_insert and bulk_link: one transaction per chunk of BULK_CHUNK_SIZE
+def read_batch(request, key):
+    """The items of a batch POST body: a JSON array, {"<key>": [...]}, or NDJSON lines."""
+    if request.mimetype == NDJSON:
+        items = ndjson_items(request.body.decode('utf-8', 'replace'))
+    else:
+        items = request.json()
+    return batch_items(items, key, MAX_BATCH_ROWS)
+
+
+async def insert_chunk(app, conn, model, rows):
+    """Insert validated rows and log them, in the connection's transaction; the new ids in order."""
+    prepare = getattr(model, 'prepare_row', None)
+    if prepare is not None:
+        rows = [prepare(row) for row in rows]
+    if app.engine.dialect.full_returning:
+        ids = [id for id, in await conn.execute(insert(model.__table__).values(rows).returning(model.id))]
+    else:   # SQLite: no RETURNING, so one INSERT per row to learn its id
+        ids = [(await conn.execute(insert(model.__table__).values(row))).inserted_primary_key[0] for row in rows]
+    await conn.execute(insert(change_log), change_rows(model.__tablename__, ids))
+    return ids
+
+
+async def batch_response(app, request, model, key):
+    rows = validate_rows(model, read_batch(request, key))
+    ids = []
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        async with app.engine.begin() as conn:
+            ids += await insert_chunk(app, conn, model, rows[start:start + BULK_CHUNK_SIZE])
+        notify_write(model.__tablename__)
+    return json_response({"Success": "True", "created": len(ids), "ids": ids})
+
+
+@route('/films', method='POST', permission='post:film')
+async def post_films(app, request, p):
+    return await batch_response(app, request, Film, "films")
+
+
+@route('/actors', method='POST', permission='post:actor')
+async def post_actors(app, request, p):
+    return await batch_response(app, request, Actor, "actors")
+
+
+async def missing_ids(app, model, ids):
+    """The ids (of a set) that don't exist in `model`'s table."""
+    ordered, found = sorted(ids), set()
+    for start in range(0, len(ordered), BULK_CHUNK_SIZE):
+        chunk = ordered[start:start + BULK_CHUNK_SIZE]
+        found.update(id for id, in await app.fetch_all(select(model.id).where(model.id.in_(chunk))))
+    return ids - found
+
+
+async def link_chunk(conn, pairs):
+    """Insert the (film_id, actor_id) links that don't exist yet, and bump and log both sides; returns them."""
+    existing = {tuple(row) for row in await conn.execute(
+        select(film_actors.c.film_id, film_actors.c.actor_id)
+        .where(film_actors.c.film_id.in_({film_id for film_id, _ in pairs}))
+        .where(film_actors.c.actor_id.in_({actor_id for _, actor_id in pairs})))}
+    new = [{'film_id': film_id, 'actor_id': actor_id}
+           for film_id, actor_id in pairs if (film_id, actor_id) not in existing]
+    if new:
+        await conn.execute(film_actors.insert(), new)
+        # The triggers changed the cast counts; mark those films and actors as updated
+        for model, field in ((Film, 'film_id'), (Actor, 'actor_id')):
+            ids = sorted({link[field] for link in new})
+            await conn.execute(bump(model).where(model.id.in_(ids)))
+            await conn.execute(insert(change_log), change_rows(model.__tablename__, ids))
+    return new
+
+
+@route('/casting', method='POST', permission='patch:film')
+async def post_casting(app, request, p):
+    rows = validate_rows(film_actors, read_batch(request, "links"))
+    for model, field in ((Film, 'film_id'), (Actor, 'actor_id')):
+        missing = await missing_ids(app, model, {row[field] for row in rows})
+        if missing:
+            return error_response(400, f"Unknown {field}(s): " + ", ".join(map(str, sorted(missing)[:20])))
+    pairs, created = list(dict.fromkeys((row['film_id'], row['actor_id']) for row in rows)), 0
+    for start in range(0, len(pairs), BULK_CHUNK_SIZE):
+        async with app.engine.begin() as conn:
+            new = await link_chunk(conn, pairs[start:start + BULK_CHUNK_SIZE])
+        created += len(new)
+        if new:
+            notify_write(*cast_tags(new))
+    return json_response({"Success": "True", "created": created})
+
+
+## Flask-only endpoints
+# (path, method, status): 404 where the path isn't served here at all, 405 where it is for another method
+FLASK_ONLY = (
+    ('/ready', 'GET', 404),
+    ('/changes', 'GET', 404),
+    ('/actors/<int:actor_id>/costars', 'GET', 404),
+    ('/actors/<int:actor_id>/path/<int:other_id>', 'GET', 404),
+    ('/imports/films', 'POST', 404),
+    ('/imports/actors', 'POST', 404),
+    ('/imports/casting', 'POST', 404),
+    ('/imports/<int:job_id>', 'GET', 404),
+    ('/films/<int:film_id>', 'PATCH', 404),
+    ('/actors/<int:actor_id>', 'PATCH', 404),
+    ('/films/<int:film_id>', 'DELETE', 404),
+    ('/actors/<int:actor_id>', 'DELETE', 404),
+    ('/films', 'PATCH', 405),
+    ('/actors', 'PATCH', 405),
+    ('/films', 'DELETE', 405),
+    ('/actors', 'DELETE', 405),
+)
+
+
+def flask_only(path, method, status):
+    message = "%s %s is only served by the Flask app (gunicorn app:app)." % (method, path)
+
+    async def handler(app, request, p, **params):
+        return error_response(status, message)
+    route(path, method)(handler)
+
+
+for endpoint in FLASK_ONLY:
+    flask_only(*endpoint)
+
+
+app = AsyncCastingApp()
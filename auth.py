@@ -1,14 +1,72 @@
-import json, os
-from flask import request, _request_ctx_stack
+import json, logging, os, random, threading
+from flask import current_app, request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+
+from jwks import JWKSKeyStore
+from metrics import phase
+from rate_limit import limiter
+from token_cache import TokenCache
 
 
-# Read AUTH0_DOMAIN and API_AUDIENCE from environment variables
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = ['RS256']
-API_AUDIENCE = os.environ['API_AUDIENCE']
+# Read from the app's config when a token is first verified; create_app fills them in from the environment.
+# AUTH0_JWKS_FILE optionally loads the signing keys from a local JWKS file instead of the Auth0 tenant
+AUTH_SETTINGS = ('AUTH0_DOMAIN', 'API_AUDIENCE', 'AUTH0_JWKS_FILE')
+# Fraction of successful permission checks that are logged (failures always are)
+AUTH_LOG_SAMPLE_RATE = float(os.environ.get('AUTH_LOG_SAMPLE_RATE', 0.01))
+
+logger = logging.getLogger('auth')
+
+## Verified-token cache, so a repeated bearer token skips the RS256 signature check
+token_cache = TokenCache(max_size=int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 1024)))
+
+## Process-wide JWKS key stores, one per key source, shared by every request in this worker
+key_stores = {}
+_key_stores_lock = threading.Lock()
+
+
+def settings_from_env():
+    """The auth settings from the environment (None where unset), for an app's config."""
+    return {name: os.environ.get(name) for name in AUTH_SETTINGS}
+
+
+def auth_config(config=None):
+    """`config`, or the current Flask app's, once it is known to name the Auth0 domain and audience."""
+    if config is None:
+        config = current_app.config
+    for name in ('AUTH0_DOMAIN', 'API_AUDIENCE'):
+        if not config.get(name):
+            raise RuntimeError(name + ' is not configured')
+    return config
+
+
+def get_key_store(config=None):
+    """The key store for the configured JWKS file or Auth0 tenant, created on first use."""
+    config = auth_config(config)
+    path = config.get('AUTH0_JWKS_FILE')
+    source = path or 'https://%s/.well-known/jwks.json' % config['AUTH0_DOMAIN']
+    store = key_stores.get(source)
+    if store is None:
+        with _key_stores_lock:
+            store = key_stores.get(source)
+            if store is None:
+                if path:
+                    store = JWKSKeyStore(path=path, algorithm=ALGORITHMS[0])
+                else:
+                    store = JWKSKeyStore(url=source, algorithm=ALGORITHMS[0])
+                store.on_rotate(token_cache.evict_kids)
+                key_stores[source] = store
+    return store
+
+## Structured logging
+def log_event(level, event, sample_rate=1.0, **fields):
+    """Log one JSON event at `level`, keeping only a `sample_rate` fraction of them."""
+    if not logger.isEnabledFor(level):
+        return
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    logger.log(level, json.dumps(dict(event=event, **fields), default=str))
 
 ## AuthError Exception
 class AuthError(Exception):
@@ -18,7 +76,10 @@ class AuthError(Exception):
 
 ## Auth Header
 def get_token_auth_header():
-    auth = request.headers.get("Authorization", None)
+    return parse_auth_header(request.headers.get("Authorization", None))
+
+def parse_auth_header(auth):
+    """Extract the bearer token from an Authorization header value."""
     if not auth:
         raise AuthError(
             {
@@ -48,55 +109,114 @@ def get_token_auth_header():
     token = auth_section[1]
     return token
 
-def check_permissions(permission, payload):
-    try:
+## Permissions
+class Claims(dict):
+    """A verified token payload, with its permissions precompiled to a frozenset.
+
+    Built once per token and kept in the token cache, so every later request
+    with the same token checks its scopes with set operations instead of
+    scanning the permissions list.
+    """
+
+    def __init__(self, payload):
+        super().__init__(payload)
         permissions = payload.get('permissions')
-        if (permission in permissions):
-            print (str(permission) + " in " + str(permissions))
-            return True
-        else:
-            raise AuthError(
-                    {
-                        'code': 'invalid_permissions',
-                        'description': 'User doesn\'t have permission.'
-                    }, 403)
-    except:
+        # None when the claim is missing or malformed: every permission check then fails with a 401
+        self.permissions = frozenset(permissions) if isinstance(permissions, (list, tuple)) else None
+
+
+class Permissions:
+    """The permissions a route requires: all of `all_of`, and at least one of `any_of` if given."""
+
+    def __init__(self, all_of=(), any_of=()):
+        self.all_of = frozenset(all_of)
+        self.any_of = frozenset(any_of)
+        required = sorted(self.all_of)
+        if self.any_of:
+            required.append('|'.join(sorted(self.any_of)))
+        self.name = ','.join(required)
+
+    def allows(self, granted):
+        return self.all_of <= granted and (not self.any_of or not self.any_of.isdisjoint(granted))
+
+    def __str__(self):
+        return self.name
+
+
+def granted_permissions(payload):
+    """The frozenset of permissions granted by a verified payload."""
+    if not isinstance(payload, Claims):
+        payload = Claims(payload)
+    if payload.permissions is None:
         raise AuthError(
                 {
-                    'code': 'invalid_permissions',
-                    'description': 'User doesn\'t have permission.'
+                    'code': 'invalid_claims',
+                    'description': 'Token does not contain a permissions claim.'
                 }, 401)
+    return payload.permissions
 
 
-def verify_decode_jwt(token):
-    jsonURL = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jsonWebKeySet = json.loads(jsonURL.read())
-    unverified_token_header = jwt.get_unverified_header(token)
-    rsa_key = {}
+def check_permissions(permission, payload):
+    """Check `payload` against a permission name or a precompiled Permissions requirement."""
+    if not isinstance(permission, Permissions):
+        permission = Permissions((permission,))
+    if permission.allows(granted_permissions(payload)):
+        log_event(logging.DEBUG, 'permission_granted', AUTH_LOG_SAMPLE_RATE,
+                  permission=permission.name, sub=payload.get('sub'))
+        return True
+    log_event(logging.INFO, 'permission_denied', permission=permission.name, sub=payload.get('sub'))
+    raise AuthError(
+            {
+                'code': 'invalid_permissions',
+                'description': 'User doesn\'t have permission.'
+            }, 403)
+
+
+def unverified_kid(token):
+    """Read the Key ID (kid) from a token's header, before it is verified."""
+    try:
+        unverified_token_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        raise AuthError(
+            {
+                'code': 'invalid_header',
+                'description': 'Unable to parse authentication token.'
+            }, 400)
     if 'kid' not in unverified_token_header:
         raise AuthError(
             {
                 'code': 'invalid_token',
                 'description': 'Token does not contain a Key ID (kid) and so cannot be verified.'
             }, 401)
-    for key in jsonWebKeySet['keys']:
-        if key['kid'] == unverified_token_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n':   key['n'],
-                'e':   key['e']
-            }
-    if rsa_key:
+    return unverified_token_header['kid']
+
+
+def verify_decode_jwt(token, config=None):
+    kid = unverified_kid(token)
+    config = auth_config(config)
+    with phase('auth_jwks'):
+        rsa_key = get_key_store(config).get_key(kid)
+    return decode_jwt(token, rsa_key, config)
+
+
+def decode_jwt(token, rsa_key, config):
+    """Check the token's signature against `rsa_key` and its claims against `config`, and return its payload."""
+    if rsa_key is None:
+        raise AuthError(
+            {
+                'code': 'invalid_header',
+                'description': 'Unable to find the appropriate key to verify the token.'
+            }, 401)
+    else:
         try:
-            payload = jwt.decode(token,
-                                 rsa_key,
-                                 algorithms=ALGORITHMS,
-                                 audience=API_AUDIENCE,
-                                 issuer='https://' + AUTH0_DOMAIN + '/')
+            with phase('auth_verify'):
+                payload = jwt.decode(token,
+                                     rsa_key,
+                                     algorithms=ALGORITHMS,
+                                     audience=config['API_AUDIENCE'],
+                                     issuer='https://' + config['AUTH0_DOMAIN'] + '/')
 
-            return payload
+            return Claims(payload)
 
         except jwt.ExpiredSignatureError:
             raise AuthError(
@@ -119,13 +239,65 @@ def verify_decode_jwt(token):
                 }, 400)
 
 
-def RequiresAuth(permission=''):
+def verify_token(token, config=None):
+    """Verify a token, reusing the payload if this token was verified before."""
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = verify_decode_jwt(token, config)
+        token_cache.put(token, payload, unverified_kid(token))
+    return payload
+
+
+async def verify_token_async(token, config):
+    """verify_token for the async app: a JWKS refetch, if needed, runs off the event loop."""
+    payload = token_cache.get(token)
+    if payload is None:
+        kid = unverified_kid(token)
+        config = auth_config(config)
+        payload = decode_jwt(token, await get_key_store(config).get_key_async(kid), config)
+        token_cache.put(token, payload, kid)
+    return payload
+
+
+def current_claims():
+    """The verified payload for this request, verifying the bearer token on first use."""
+    ctx = _request_ctx_stack.top
+    payload = getattr(ctx, 'current_user', None)
+    if payload is None:
+        with phase('auth_header'):
+            token = get_token_auth_header()
+        payload = ctx.current_user = verify_token(token)
+    return payload
+
+
+def verified_claims():
+    """The verified payload for this request if its token has been checked already, else None."""
+    return getattr(_request_ctx_stack.top, 'current_user', None)
+
+
+def RequiresAuth(*permissions, any_of=()):
+    """Require every permission in `permissions`, and at least one of `any_of` if given.
+
+        @RequiresAuth('patch:film')
+        @RequiresAuth('get:film', 'get:actor')
+        @RequiresAuth(any_of=('patch:film', 'patch:actor'))
+
+    Raises ValueError when no permission is given, rather than letting any
+    valid token through.
+    """
+    permissions = [permission for permission in permissions if permission]
+    any_of = [permission for permission in any_of if permission]
+    if not permissions and not any_of:
+        raise ValueError('RequiresAuth needs at least one permission')
+    required = Permissions(permissions, any_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload = current_claims()
+            # Charged before the handler runs, and before a denied request's 403
+            limiter.check(required, payload, request.remote_addr)
+            check_permissions(required, payload)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""Per-request overhead of @RequiresAuth with a cached token, and of the permission check alone.
+
+    python benchmarks/bench_auth.py [iterations]
+
+The list scan the check used to do is timed next to the frozenset check, for a token
+with a handful of permissions and for one carrying a few hundred.
+"""
+import sys, time
+
+from common import ALL_PERMISSIONS, make_token, report
+
+
+def per_call(function, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return {'us_per_call': '%.2f' % (1e6 * (time.perf_counter() - started) / iterations)}
+
+
+def main(iterations=100000):
+    from flask import Flask
+    from auth import Claims, Permissions, RequiresAuth, check_permissions, settings_from_env, token_cache
+
+    app = Flask(__name__)
+    app.config.update(settings_from_env())
+
+    @RequiresAuth('patch:film')
+    def one(payload):
+        return payload
+
+    @RequiresAuth('get:film', 'get:actor', any_of=('patch:film', 'patch:actor'))
+    def several(payload):
+        return payload
+
+    many = ALL_PERMISSIONS + ['scope:%d' % i for i in range(300)]
+    for name, permissions in (('8 perms', ALL_PERMISSIONS), ('308 perms', many)):
+        headers = {'Authorization': 'Bearer ' + make_token(permissions)}
+        token_cache.clear()
+
+        def request(route):
+            with app.test_request_context(headers=headers):
+                return route()
+
+        report('%s: bare request' % name, **per_call(lambda: request(lambda: None), iterations))
+        report('%s: one scope' % name, **per_call(lambda: request(one), iterations))
+        report('%s: several scopes' % name, **per_call(lambda: request(several), iterations))
+
+        # The last permission is the one required, the worst case for a list scan
+        plain, claims = {'permissions': permissions}, Claims({'permissions': permissions})
+        wanted = permissions[-1]
+        required = Permissions((wanted,))
+        report('%s: list scan' % name, **per_call(lambda: wanted in plain['permissions'], iterations))
+        report('%s: frozenset check' % name, **per_call(lambda: check_permissions(required, claims), iterations))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,79 @@
+"""Cold start: time from process start to the first served request.
+
+    python benchmarks/bench_boot.py [runs]
+
+`in process` starts a fresh interpreter that imports app, creates it and serves one
+authenticated GET /films through the test client, timing each step; `sync` and
+`async` spawn gunicorn (one worker) and uvicorn and time the first 200 from GET /films.
+Medians over `runs` cold starts are reported.
+"""
+import json, os, statistics, subprocess, sys, time
+from http.client import HTTPConnection
+
+from common import ROOT, SERVERS, auth_headers, fresh_app, report, seed
+
+PROBE = '''
+import json, os, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.app
+created = time.perf_counter()
+response = application.test_client().get('/films?limit=50', headers={'Authorization': os.environ['BOOT_TOKEN']})
+served = time.perf_counter()
+print(json.dumps({'import_ms': 1000 * (imported - started), 'create_ms': 1000 * (created - imported),
+                  'first_request_ms': 1000 * (served - created), 'status': response.status_code,
+                  'alembic_loaded': 'alembic' in sys.modules}))
+'''
+
+
+def in_process(env):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    result = json.loads(output)
+    result['total_ms'] = 1000 * (time.perf_counter() - started)
+    return result
+
+
+def first_response(mode, port, env, timeout=30.0):
+    """Milliseconds from spawning the server to its first 200 for GET /films."""
+    bin_dir = os.path.dirname(sys.executable)
+    command = SERVERS[mode]
+    command = [os.path.join(bin_dir, command[0])] + [arg.format(workers=1, port=port) for arg in command[1:]]
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                connection = HTTPConnection('127.0.0.1', port, timeout=5)
+                connection.request('GET', '/films?limit=50', headers={'Authorization': env['BOOT_TOKEN']})
+                if connection.getresponse().status == 200:
+                    return 1000 * (time.perf_counter() - started)
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError('%s server on port %d did not answer' % (mode, port))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def medians(results):
+    return {key: '%.0f' % statistics.median(result[key] for result in results)
+            for key in results[0] if key.endswith('_ms')}
+
+
+def main(runs=5):
+    seed(fresh_app(), films=1000, actors=1000)
+    env = dict(os.environ, BOOT_TOKEN=auth_headers()['Authorization'])
+
+    results = [in_process(env) for _ in range(runs)]
+    report('in process', alembic_loaded=results[0]['alembic_loaded'], **medians(results))
+
+    for port, mode in enumerate(('sync', 'async'), start=8721):
+        timings = [first_response(mode, port, env) for _ in range(runs)]
+        report(mode, first_request_ms='%.0f' % statistics.median(timings))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
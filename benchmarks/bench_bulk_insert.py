@@ -0,0 +1,30 @@
+"""Insert throughput: one POST /film per row vs batched POST /films.
+
+    python benchmarks/bench_bulk_insert.py [rows] [batch_size]
+"""
+import sys, time
+
+from common import auth_headers, fresh_app, report
+
+
+def main(rows=2000, batch_size=1000):
+    app = fresh_app()
+    client = app.test_client()
+    headers = auth_headers()
+    films = [{'name': 'Film %d' % i, 'date_of_release': '01-Jan-2000'} for i in range(rows)]
+
+    started = time.perf_counter()
+    for film in films:
+        client.post('/film', headers=headers, json=film)
+    elapsed = time.perf_counter() - started
+    report('per-row POST /film', rows=rows, seconds='%.2f' % elapsed, rows_per_s='%.0f' % (rows / elapsed))
+
+    started = time.perf_counter()
+    for start in range(0, rows, batch_size):
+        client.post('/films', headers=headers, json=films[start:start + batch_size])
+    elapsed = time.perf_counter() - started
+    report('batched POST /films', rows=rows, seconds='%.2f' % elapsed, rows_per_s='%.0f' % (rows / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,57 @@
+"""Time to the first row, total time and peak memory: one jsonify'd list vs the streaming exports.
+
+The first-row time is taken at the first chunk carrying a row, not the first
+chunk on the wire: stream=json sends its '{"Success": ..., "films": [' prefix
+before running the query.
+
+    python benchmarks/bench_export.py [rows]
+"""
+import sys, time, tracemalloc
+
+from common import auth_headers, fresh_app, seed, report
+
+
+ROW_MARKER = b'"id"'
+
+
+def measure(client, url, headers):
+    tracemalloc.start()
+    started = time.perf_counter()
+    response = client.get(url, headers=headers, buffered=False)
+    first_row = first_row_peak = None
+    size = 0
+    for chunk in response.response:
+        chunk = chunk if isinstance(chunk, bytes) else chunk.encode()
+        size += len(chunk)
+        if first_row is None and ROW_MARKER in chunk:
+            first_row = time.perf_counter() - started
+            first_row_peak = tracemalloc.get_traced_memory()[1]
+    total = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    response.close()
+    return {'first_row_ms': '%.1f' % (1000 * first_row), 'total_ms': '%.1f' % (1000 * total),
+            'bytes': size, 'first_row_peak_kib': first_row_peak // 1024, 'peak_kib': peak // 1024}
+
+
+def main(rows=100000):
+    app = fresh_app()
+    seed(app, films=rows)
+
+    from flask import jsonify
+    from models import Film
+
+    @app.route('/bench/films-jsonify')
+    def films_jsonify():
+        """The pre-pagination list endpoint, for comparison."""
+        return jsonify({"Success": "True", "films": [film.format() for film in Film.query.all()]})
+
+    client = app.test_client()
+    headers = auth_headers()
+    report('jsonify (all rows)', **measure(client, '/bench/films-jsonify', headers))
+    report('stream=json', **measure(client, '/films?stream=json', headers))
+    report('stream=ndjson', **measure(client, '/films?stream=ndjson', headers))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
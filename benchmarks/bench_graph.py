@@ -0,0 +1,98 @@
+"""The in-memory co-star index on synthetic graphs: build time, memory per link and query latency.
+
+    python benchmarks/bench_graph.py [links ...]     # default 1000000 5000000
+    python benchmarks/bench_graph.py --db 100000     # also build from a seeded SQLite database
+
+Films get 4 to 40 actors each, drawn with a skew so that a few actors are in many
+films, as in a real catalogue. For each size this reports the time to build the
+index from sorted (film, actor) pairs, the bytes the arrays hold per link (and how much
+the process's peak memory grew while building), then p50/p95 latency of co-star lookups and of
+shortest paths between random pairs of actors.
+"""
+import argparse, random, resource, time
+
+from common import fresh_app, percentile, report, seed
+
+from costar_graph import CostarGraph
+
+
+def synthetic_links(links, actors_per_link=0.2, seed=7):
+    """Sorted (film_id, actor_id) pairs, about `links` of them, and the number of actors."""
+    rng = random.Random(seed)
+    actors = max(2, int(links * actors_per_link))
+    pairs, film_id = [], 0
+    while len(pairs) < links:
+        film_id += 1
+        cast = {1 + int(actors * rng.random() ** 2) for _ in range(rng.randint(4, 40))}
+        pairs.extend((film_id, actor_id) for actor_id in sorted(cast))
+    return pairs, actors
+
+
+def timed(call, times):
+    """(results, seconds taken) of `times` calls."""
+    results, samples = [], []
+    for _ in range(times):
+        started = time.perf_counter()
+        results.append(call())
+        samples.append(time.perf_counter() - started)
+    return results, samples
+
+
+def latencies(samples):
+    return {'p50_ms': '%.3f' % (1000 * percentile(samples, 0.5)),
+            'p95_ms': '%.3f' % (1000 * percentile(samples, 0.95))}
+
+
+def bench(links, queries=1000, paths=200):
+    pairs, actors = synthetic_links(links)
+    graph = CostarGraph()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    graph.load(pairs)
+    # Growth of the process's peak resident set (kB on Linux) while building
+    peak = 1024 * (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+    stored = graph.films.nbytes() + graph.casts.nbytes()
+    report('build %d links' % len(pairs), seconds='%.2f' % graph.build_seconds,
+           ns_per_link='%.0f' % (1e9 * graph.build_seconds / len(pairs)),
+           bytes_per_link='%.1f' % (stored / len(pairs)), peak_mb='%.0f' % (peak / 2 ** 20))
+
+    rng = random.Random(11)
+    _, samples = timed(lambda: graph.costars(rng.randint(1, actors), 100), queries)
+    report('  costars', **latencies(samples))
+
+    results, samples = timed(lambda: graph.path(rng.randint(1, actors), rng.randint(1, actors)), paths)
+    found = [films for _, films in filter(None, results)]
+    report('  path', found='%d/%d' % (len(found), paths),
+           mean_degrees='%.2f' % (sum(map(len, found)) / max(len(found), 1)), **latencies(samples))
+
+
+def bench_db(films, cast_per_film=10):
+    """Time the first build from the database, then a catch-up after a few casting changes."""
+    from costar_graph import graph
+    from models import bulk_link
+    app = fresh_app()
+    seed(app, films=films, actors=films, cast_per_film=cast_per_film)
+    with app.app_context():
+        graph.reset()
+        started = time.perf_counter()
+        graph.build()
+        report('db build %d links' % graph.casts.links(), seconds='%.2f' % (time.perf_counter() - started))
+        bulk_link([(film_id, film_id % films + 1) for film_id in range(1, 101)])
+        started = time.perf_counter()
+        graph.refresh()
+        report('db catch-up 100 links', ms='%.1f' % (1000 * (time.perf_counter() - started)),
+               builds=graph.builds, catch_ups=graph.catch_ups)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('links', type=int, nargs='*', default=[1000000, 5000000])
+    parser.add_argument('--db', type=int, metavar='FILMS', help='also seed this many films and build from SQLite')
+    args = parser.parse_args()
+    for links in args.links:
+        bench(links)
+    if args.db:
+        bench_db(args.db)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Sync (gunicorn app:app) vs async (uvicorn asgi:app) serving, same worker count.
+
+Starts each server on the local benchmark database, drives the list endpoints
+(paged, searched, sorted and with include=cast) with concurrent keep-alive
+clients, and reports requests/sec, p50/p99 latency and the resident memory of
+the whole server process tree. The response cache is off and If-Modified-Since
+isn't sent, but the Flask app still looks up Last-Modified, which asgi.py doesn't.
+
+    python benchmarks/bench_serving_modes.py [workers] [concurrency] [seconds]
+"""
+import sys
+
+from common import auth_headers, fresh_app, seed, serve, drive, percentile, process_tree_rss, report
+
+MODES = {'sync': 'sync (gunicorn)', 'async': 'async (uvicorn)'}
+
+
+def main(workers=2, concurrency=32, seconds=10.0):
+    app = fresh_app()
+    seed(app, films=5000, actors=5000, cast_per_film=3)
+    headers = auth_headers()
+    requests = [('GET', '/films?limit=50', headers, None),
+                ('GET', '/actors?limit=50&min_age=30&max_age=40', headers, None),
+                ('GET', '/films?limit=20&after=1000', headers, None),
+                ('GET', '/actors?limit=50&sort=-film_count', headers, None),
+                ('GET', '/films?limit=20&include=cast', headers, None)]
+    # Skip the per-worker response cache, so both modes do the same database work
+    env = {'RESPONSE_CACHE_TTL': '0'}
+
+    for port, (mode, name) in enumerate(MODES.items(), start=8701):
+        with serve(mode, workers, port, env) as server:
+            drive('127.0.0.1', port, requests, concurrency, duration=2.0)   # warm up
+            result = drive('127.0.0.1', port, requests, concurrency, duration=seconds)
+            report(name, workers=workers, rps='%.0f' % result['rps'],
+                   p50_ms='%.1f' % (1000 * percentile(result['latencies'], 0.50)),
+                   p99_ms='%.1f' % (1000 * percentile(result['latencies'], 0.99)),
+                   errors=result['errors'], rss_mib='%.0f' % (process_tree_rss(server.pid) / 1024))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 2, int(args[1]) if len(args) > 1 else 32, float(args[2]) if len(args) > 2 else 10.0)
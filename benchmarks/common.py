@@ -0,0 +1,232 @@
+"""Shared set-up for the benchmarks: a local SQLite (or throwaway Postgres) database and locally signed tokens."""
+import os, shutil, subprocess, sys, tempfile, time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'fixtures')
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'casting_bench.db'))
+os.environ.setdefault('AUTH0_DOMAIN', 'casting-agency.test')
+os.environ.setdefault('API_AUDIENCE', 'agency')
+os.environ.setdefault('AUTH0_CLIENT_ID', 'benchmark')
+os.environ.setdefault('AUTH0_CALLBACK_URL', 'http://localhost:8080/login-results')
+os.environ.setdefault('AUTH0_JWKS_FILE', os.path.join(FIXTURES, 'jwks.json'))
+# Every benchmark request comes from one client; measure the server, not its rate limits
+os.environ.setdefault('RATE_LIMIT_DEFAULT', 'off')
+
+from jose import jwt
+
+ALL_PERMISSIONS = ['get:film', 'get:actor', 'post:film', 'post:actor',
+                   'patch:film', 'patch:actor', 'delete:film', 'delete:actor']
+
+
+def make_token(permissions=ALL_PERMISSIONS, kid='local-test-key', expires_in=3600, sub='auth0|benchmark'):
+    """Sign an RS256 token with the fixture key, accepted when AUTH0_JWKS_FILE is the fixture."""
+    with open(os.path.join(FIXTURES, 'jwks_private.pem')) as key_file:
+        private_key = key_file.read()
+    now = int(time.time())
+    claims = {
+        'iss': 'https://' + os.environ['AUTH0_DOMAIN'] + '/',
+        'sub': sub,
+        'aud': os.environ['API_AUDIENCE'],
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': list(permissions)
+    }
+    return jwt.encode(claims, private_key, algorithm='RS256', headers={'kid': kid})
+
+
+def auth_headers(permissions=ALL_PERMISSIONS):
+    return {'Authorization': 'Bearer ' + make_token(permissions)}
+
+
+def fresh_app():
+    """The app, with an empty schema."""
+    from app import app
+    from models import db
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+def seed(app, films=0, actors=0, cast_per_film=0):
+    """Bulk load synthetic films and actors, and link `cast_per_film` actors to each film."""
+    from sqlalchemy import func
+    from models import db, film_actors, Actor, Film
+    with app.app_context():
+        for start in range(0, films, 10000):
+            db.session.bulk_insert_mappings(Film, [
+                Film.prepare_row({'name': 'Film %d' % i, 'date_of_release': '01-Jan-%d' % (1920 + i % 100)})
+                for i in range(start, min(start + 10000, films))])
+        for start in range(0, actors, 10000):
+            db.session.bulk_insert_mappings(Actor, [
+                {'name': 'Actor %d' % i, 'gender': 'Female' if i % 2 else 'Male', 'age': 18 + i % 70}
+                for i in range(start, min(start + 10000, actors))])
+        db.session.commit()
+        if films and actors and cast_per_film:
+            # Fresh tables, so the ids are contiguous from the first one
+            first_film = db.session.query(func.min(Film.id)).scalar()
+            first_actor = db.session.query(func.min(Actor.id)).scalar()
+            per_film = min(cast_per_film, actors)
+            for start in range(0, films, 10000):
+                db.session.execute(film_actors.insert(), [
+                    {'film_id': first_film + i, 'actor_id': first_actor + (i * 7 + j) % actors}
+                    for i in range(start, min(start + 10000, films)) for j in range(per_film)])
+                db.session.commit()
+
+
+@contextmanager
+def ephemeral_postgres(port=55432):
+    """Run a throwaway Postgres cluster in a temporary directory and yield its URL.
+
+    Needs the server binaries (initdb, pg_ctl) on PATH or in `pg_config --bindir`.
+    """
+    bin_dir = os.path.dirname(shutil.which('initdb') or '')
+    if not bin_dir and shutil.which('pg_config'):
+        bin_dir = subprocess.check_output(['pg_config', '--bindir'], text=True).strip()
+    if not os.path.exists(os.path.join(bin_dir, 'initdb')):
+        raise RuntimeError('Postgres server binaries (initdb, pg_ctl) not found')
+    data_dir = tempfile.mkdtemp(prefix='casting_bench_pg_')
+    quiet = dict(stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        subprocess.check_call([os.path.join(bin_dir, 'initdb'), '-D', data_dir, '-U', 'postgres',
+                               '-A', 'trust'], **quiet)
+        subprocess.check_call([os.path.join(bin_dir, 'pg_ctl'), '-D', data_dir, '-w', '-l',
+                               os.path.join(data_dir, 'server.log'), '-o',
+                               '-p %d -k %s -c listen_addresses=127.0.0.1 -c fsync=off' % (port, data_dir),
+                               'start'], **quiet)
+        try:
+            yield 'postgresql://postgres@127.0.0.1:%d/postgres' % port
+        finally:
+            subprocess.call([os.path.join(bin_dir, 'pg_ctl'), '-D', data_dir, '-m', 'fast', 'stop'], **quiet)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def report(name, **values):
+    print(name.ljust(28) + '  '.join('%s=%s' % (key, value) for key, value in values.items()))
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def drive(host, port, requests, concurrency=16, duration=10.0):
+    """Replay (method, path, headers, body) tuples from `concurrency` keep-alive clients.
+
+    Returns the request count, requests/sec, latencies (seconds) and error count,
+    and the latencies of each request in `by_request` (indexed like `requests`).
+    """
+    import http.client, itertools, threading
+    latencies, errors = [], []
+    by_request = [[] for _ in requests]
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+
+    def client(offset):
+        connection = http.client.HTTPConnection(host, port, timeout=30)
+        mine, indexes, failed = [], [], 0
+        for index in itertools.count(offset):
+            if time.perf_counter() >= deadline:
+                break
+            index %= len(requests)
+            method, path, headers, body = requests[index]
+            started = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=30)
+            mine.append(time.perf_counter() - started)
+            indexes.append(index)
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            for index, latency in zip(indexes, mine):
+                by_request[index].append(latency)
+            errors.append(failed)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {'requests': len(latencies), 'rps': len(latencies) / elapsed,
+            'latencies': latencies, 'by_request': by_request, 'errors': sum(errors)}
+
+
+def process_rss(pid):
+    """Resident memory (KiB) of one process, from /proc."""
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def child_pids(pid):
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as children:
+            return [int(child) for child in children.read().split()]
+    except OSError:
+        return []
+
+
+def process_tree_rss(pid):
+    """Resident memory (KiB) of a process and all its descendants, from /proc."""
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        total += process_rss(current)
+        pending.extend(child_pids(current))
+    return total
+
+
+# Server command lines, formatted with the worker count and port
+SERVERS = {
+    'sync': ['gunicorn', '--workers', '{workers}', '--worker-class', 'sync', '--bind', '127.0.0.1:{port}', 'app:app'],
+    'async': ['uvicorn', '--workers', '{workers}', '--port', '{port}', '--log-level', 'warning', 'asgi:app'],
+}
+
+
+@contextmanager
+def serve(mode, workers, port, env=None):
+    """Start the app (`mode` is 'sync' or 'async') from the repository root and yield its process."""
+    bin_dir = os.path.dirname(sys.executable)
+    command = SERVERS[mode]
+    command = [os.path.join(bin_dir, command[0])] + [arg.format(workers=workers, port=port) for arg in command[1:]]
+    server = subprocess.Popen(command, cwd=ROOT, env=dict(os.environ, **(env or {})),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port('127.0.0.1', port)
+        yield server
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def wait_for_port(host, port, timeout=30.0):
+    import socket
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server on port %d did not start' % port)
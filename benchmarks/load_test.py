@@ -0,0 +1,106 @@
+"""Load test: a seeded catalogue, a running server and a concurrent read/write mix.
+
+Tokens are signed locally against fixtures/jwks.json, so no Auth0 tenant is needed,
+and the database is a local SQLite file or, with --postgres, a throwaway Postgres
+cluster started for the run.
+
+    python benchmarks/load_test.py --films 100000 --actors 100000 --cast 5 --workers 4 --concurrency 64
+    python benchmarks/load_test.py --postgres --films 1000000 --actors 1000000 --mode async
+
+Reports throughput, p50/p95/p99 latency per request type and overall, and the
+resident memory of each worker process.
+"""
+import argparse, json, os, time
+from contextlib import ExitStack
+
+from common import auth_headers, child_pids, drive, ephemeral_postgres, percentile, process_rss, report, serve
+
+
+def workload(films, actors, writes):
+    """(name, weight, (method, path, headers, body)) for each request type in the mix."""
+    headers = auth_headers()
+    post_headers = dict(headers, **{'Content-Type': 'application/json'})
+    middle = max(films, actors) // 2
+    mix = [
+        ('films', 4, ('GET', '/films?limit=50', headers, None)),
+        ('films deep page', 2, ('GET', '/films?limit=50&after=%d' % middle, headers, None)),
+        ('films+cast', 2, ('GET', '/films?limit=20&include=cast&after=%d' % (films // 3), headers, None)),
+        ('films by date', 1, ('GET', '/films?limit=50&released_after=1950-01-01&released_before=1960-01-01',
+                              headers, None)),
+        ('actors', 4, ('GET', '/actors?limit=50', headers, None)),
+        ('actors by age', 2, ('GET', '/actors?limit=50&min_age=30&max_age=40', headers, None)),
+        ('actor filmography', 1, ('GET', '/actors/%d/films' % max(1, actors // 2), headers, None)),
+    ]
+    if writes:
+        mix += [
+            ('POST /film', writes, ('POST', '/film', post_headers,
+                                    json.dumps({'name': 'Load test film', 'date_of_release': '01-Jan-2020'}))),
+            ('POST /actor', writes, ('POST', '/actor', post_headers,
+                                     json.dumps({'name': 'Load test actor', 'gender': 'Female', 'age': 40}))),
+        ]
+    return mix
+
+
+def latency_columns(latencies):
+    return {'p50_ms': '%.1f' % (1000 * percentile(latencies, 0.50)),
+            'p95_ms': '%.1f' % (1000 * percentile(latencies, 0.95)),
+            'p99_ms': '%.1f' % (1000 * percentile(latencies, 0.99))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--films', type=int, default=10000)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--cast', type=int, default=5, help='actors linked to each film')
+    parser.add_argument('--writes', type=int, default=1, help='weight of each POST in the mix (0 for read only)')
+    parser.add_argument('--mode', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=30.0)
+    parser.add_argument('--warmup', type=float, default=3.0)
+    parser.add_argument('--port', type=int, default=8711)
+    parser.add_argument('--postgres', action='store_true', help='run against a throwaway local Postgres')
+    parser.add_argument('--no-cache', action='store_true', help='disable the response cache')
+    parser.add_argument('--rate-limit', default='off', metavar='RATE/BURST',
+                        help='per-client rate limit for the server (RATE_LIMIT_DEFAULT); rejections count as errors')
+    args = parser.parse_args()
+
+    with ExitStack() as stack:
+        if args.postgres:
+            os.environ['DATABASE_URL'] = stack.enter_context(ephemeral_postgres())
+        env = {'RATE_LIMIT_DEFAULT': args.rate_limit}
+        if args.no_cache:
+            env['RESPONSE_CACHE_TTL'] = '0'
+
+        from common import fresh_app, seed
+        started = time.perf_counter()
+        seed(fresh_app(), films=args.films, actors=args.actors, cast_per_film=args.cast)
+        report('seed', films=args.films, actors=args.actors, cast_per_film=args.cast,
+               seconds='%.1f' % (time.perf_counter() - started), database=os.environ['DATABASE_URL'].split(':')[0])
+
+        mix = workload(args.films, args.actors, args.writes)
+        requests, names = [], []
+        for name, weight, request in mix:
+            requests += [request] * weight
+            names += [name] * weight
+
+        server = stack.enter_context(serve(args.mode, args.workers, args.port, env))
+        drive('127.0.0.1', args.port, requests, args.concurrency, duration=args.warmup)
+        result = drive('127.0.0.1', args.port, requests, args.concurrency, duration=args.seconds)
+
+        by_name = {}
+        for name, latencies in zip(names, result['by_request']):
+            by_name.setdefault(name, []).extend(latencies)
+        for name, latencies in by_name.items():
+            report(name, requests=len(latencies), rps='%.0f' % (len(latencies) / args.seconds),
+                   **latency_columns(latencies))
+        report('total', requests=result['requests'], rps='%.0f' % result['rps'], errors=result['errors'],
+               **latency_columns(result['latencies']))
+
+        workers = child_pids(server.pid) or [server.pid]
+        report('memory', master_mib='%.0f' % (process_rss(server.pid) / 1024),
+               worker_mib=','.join('%.0f' % (process_rss(pid) / 1024) for pid in workers))
+
+
+if __name__ == '__main__':
+    main()
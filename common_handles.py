@@ -1,11 +1,19 @@
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from replicas import RoutingSQLAlchemy
 # from flask_moment import Moment
 
 
 # Create "central" handles for database and migration, but don't instantiate yet
 
-db = SQLAlchemy()
-migrate = Migrate()
+# The one SQLAlchemy handle, bound to an app by models.setup_db(); reads may go to a replica
+db = RoutingSQLAlchemy()
 # moment = Moment()
 
+
+def __getattr__(name):
+    """`migrate` is created on first use, so serving never imports Flask-Migrate and Alembic."""
+    if name == 'migrate':
+        from flask_migrate import Migrate
+        global migrate
+        migrate = Migrate()
+        return migrate
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
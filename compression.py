@@ -0,0 +1,200 @@
+"""Negotiated gzip/brotli compression of responses.
+
+brotli is used when it is installed (pip install brotli); gzip always is.
+Bodies under COMPRESS_MIN_SIZE bytes go out as they are. The response cache
+stores each entry's compressed variants (see compress_all), so a cache hit
+sends stored bytes instead of compressing again.
+"""
+import os, threading, time, zlib
+from flask import request
+
+import metrics
+from metrics import phase
+
+try:
+    import brotli
+except ImportError:   # optional dependency - gzip only
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+
+# In order of preference, when the client accepts both equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/plain', 'text/html')
+
+
+## Statistics
+class CompressionStats:
+    """Bytes in and out, CPU seconds spent, and responses sent, per encoding."""
+
+    def __init__(self):
+        self.compressed = {}   # encoding -> [bodies, bytes in, bytes out, cpu seconds]
+        self.served = {}       # encoding -> [responses, bytes saved]
+        self._lock = threading.Lock()
+
+    def record_compressed(self, encoding, size_in, size_out, seconds):
+        with self._lock:
+            totals = self.compressed.setdefault(encoding, [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += size_in
+            totals[2] += size_out
+            totals[3] += seconds
+
+    def record_served(self, encoding, saved):
+        with self._lock:
+            totals = self.served.setdefault(encoding, [0, 0])
+            totals[0] += 1
+            totals[1] += saved
+
+    def exposition(self):
+        with self._lock:
+            compressed = {encoding: list(totals) for encoding, totals in self.compressed.items()}
+            served = {encoding: list(totals) for encoding, totals in self.served.items()}
+        return metrics.gauges(
+            'response_compression_seconds_total', 'CPU time spent compressing response bodies.',
+            {(('encoding', encoding),): '%.6f' % totals[3] for encoding, totals in compressed.items()},
+            kind='counter') + metrics.gauges(
+            'response_compression_input_bytes_total', 'Bytes of response bodies compressed.',
+            {(('encoding', encoding),): totals[1] for encoding, totals in compressed.items()},
+            kind='counter') + metrics.gauges(
+            'response_compression_output_bytes_total', 'Compressed bytes produced.',
+            {(('encoding', encoding),): totals[2] for encoding, totals in compressed.items()},
+            kind='counter') + metrics.gauges(
+            'response_compressed_total', 'Responses sent compressed, including cached variants.',
+            {(('encoding', encoding),): totals[0] for encoding, totals in served.items()},
+            kind='counter') + metrics.gauges(
+            'response_compression_bytes_saved_total', 'Bytes not sent thanks to compression.',
+            {(('encoding', encoding),): totals[1] for encoding, totals in served.items()},
+            kind='counter')
+
+
+stats = CompressionStats()
+metrics.collectors['compression'] = stats.exposition
+
+
+## Compressing
+def compressor(encoding):
+    """Fresh (process(chunk), flush(), finish()) functions for streaming `encoding`."""
+    if encoding == 'br':
+        engine = brotli.Compressor(quality=BROTLI_QUALITY)
+        return engine.process, engine.flush, engine.finish
+    engine = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)   # gzip framing
+    return engine.compress, lambda: engine.flush(zlib.Z_SYNC_FLUSH), engine.flush
+
+
+def compress(body, encoding):
+    """Compress a whole body, recording the CPU time it took."""
+    with phase('compress'):
+        started = time.thread_time()
+        if encoding == 'br':
+            data = brotli.compress(body, quality=BROTLI_QUALITY)
+        else:
+            engine = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = engine.compress(body) + engine.flush()
+        stats.record_compressed(encoding, len(body), len(data), time.thread_time() - started)
+    return data
+
+
+def compress_all(body, mimetype, encodings=ENCODINGS):
+    """Every worthwhile compressed variant of a body (of those in `encodings`), for storing with a cache entry."""
+    if len(body) < COMPRESS_MIN_SIZE or not compressible(mimetype):
+        return {}
+    variants = {}
+    for encoding in encodings:
+        data = compress(body, encoding)
+        if len(data) < len(body):
+            variants[encoding] = data
+    return variants
+
+
+def compressible(mimetype):
+    return mimetype in COMPRESSIBLE
+
+
+def negotiate(available=ENCODINGS):
+    """The encoding to send, of those `available`, per the request's Accept-Encoding (None for identity)."""
+    accepted = request.accept_encodings
+    best, best_quality = None, 0
+    for encoding in available:
+        quality = accepted[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+## Responses
+def use_variant(response, encoding, data, size):
+    """Send `data` (the body compressed with `encoding`) in place of the `size` byte body."""
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    stats.record_served(encoding, size - len(data))
+    return response
+
+
+def vary(response):
+    if 'Accept-Encoding' not in response.vary:
+        response.vary.add('Accept-Encoding')
+
+
+def compress_response(response):
+    """after_request hook: compress a response that isn't compressed already, if the client accepts it.
+
+    Responses that already vary on Accept-Encoding (cached entries, with their
+    stored variants) have been negotiated and are left alone.
+    """
+    if response.status_code != 200 or 'Content-Encoding' in response.headers \
+            or 'Accept-Encoding' in response.vary or not compressible(response.mimetype):
+        return response
+    vary(response)
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers['Content-Encoding'] = encoding
+        response.headers.pop('Content-Length', None)
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    data = compress(body, encoding)
+    if len(data) >= len(body):
+        return response
+    if response.get_etag()[0]:
+        etag, weak = response.get_etag()
+        response.set_etag(etag + '-' + encoding, weak)
+    return use_variant(response, encoding, data, len(body))
+
+
+def compress_stream(chunks, encoding):
+    """Compress a streamed body chunk by chunk, flushing each so the client isn't kept waiting."""
+    process, flush, finish = compressor(encoding)
+    size = compressed = 0
+    seconds = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            started = time.thread_time()
+            data = process(chunk) + flush()
+            seconds += time.thread_time() - started
+            size += len(chunk)
+            compressed += len(data)
+            if data:
+                yield data
+        data = finish()
+        compressed += len(data)
+        yield data
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+    stats.record_compressed(encoding, size, compressed, seconds)
+    stats.record_served(encoding, size - compressed)
+
+
+def init_app(app):
+    """Compress eligible responses that the response cache hasn't already."""
+    app.after_request(compress_response)
@@ -0,0 +1,290 @@
+"""In-memory co-star graph: who acted with whom, and how few films apart two actors are.
+
+Each worker keeps film_actors as two compressed sparse row (CSR) indexes - the
+films of every actor and the cast of every film - in flat `array`s of 32-bit ids,
+about 8 bytes per link plus 8 per film and actor id. It is built from one scan of
+film_actors on a background thread, started by the worker's warm-up (or the first
+request); until the build is done the co-star endpoints answer 503.
+
+After that it is caught up from the change log instead of rebuilt: every request
+first reads the latest change number, and if films or actors were written since,
+only their rows are reloaded into a small overlay on top of the arrays (casting
+touches the film and the actor, deleting either touches the other side). Only
+changes that can no longer be overtaken by an earlier one still committing are
+applied (see models.committed_changes); the rest wait for a later request. Once the
+overlay holds more than COSTAR_COMPACT_FRACTION of the rows it is merged back into
+the arrays; after more than COSTAR_REBUILD_AFTER changes the index is rebuilt in the
+background instead.
+"""
+import heapq, os, threading, time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import accumulate, chain
+from flask import current_app
+from sqlalchemy import func, select
+from werkzeug.exceptions import ServiceUnavailable
+
+import metrics
+from models import db, change_log, committed_changes, film_actors, projection, settled_change
+
+MAX_DEGREES = 6
+MAX_DEGREES_LIMIT = 12
+BUILD_BATCH_SIZE = 10000
+RELOAD_CHUNK_SIZE = 1000
+COSTAR_COMPACT_FRACTION = float(os.environ.get('COSTAR_COMPACT_FRACTION', 0.05))
+COSTAR_REBUILD_AFTER = int(os.environ.get('COSTAR_REBUILD_AFTER', 100000))
+# Seconds a client is told to wait while the index is being built
+COSTAR_RETRY_AFTER = int(os.environ.get('COSTAR_RETRY_AFTER', 5))
+
+EMPTY = array('i')
+
+
+## Adjacency
+class Adjacency:
+    """Neighbour ids of every node id: row i is indices[offsets[i]:offsets[i + 1]], unless replaced since."""
+
+    def __init__(self, offsets=None, indices=None):
+        self.offsets = offsets if offsets is not None else array('q', [0])
+        self.indices = indices if indices is not None else array('i')
+        self.replaced = {}   # id -> array of neighbour ids, newer than the CSR row
+
+    @classmethod
+    def from_sorted(cls, owners, neighbours, size):
+        """From parallel arrays of links sorted by owner id, for owner ids below `size`."""
+        offsets = array('q', (bisect_left(owners, id) for id in range(size + 1)))
+        return cls(offsets, neighbours)
+
+    def row(self, id):
+        row = self.replaced.get(id)
+        if row is not None:
+            return row
+        if 0 <= id < len(self.offsets) - 1:
+            return self.indices[self.offsets[id]:self.offsets[id + 1]]
+        return EMPTY
+
+    def replace(self, id, neighbours):
+        self.replaced[id] = array('i', sorted(neighbours))
+
+    def size(self):
+        return max(len(self.offsets) - 1, max(self.replaced, default=-1) + 1)
+
+    def compacted(self):
+        """A copy with the replaced rows merged into the arrays."""
+        offsets, indices = array('q', [0]), array('i')
+        for id in range(self.size()):
+            indices.extend(self.row(id))
+            offsets.append(len(indices))
+        return Adjacency(offsets, indices)
+
+    def links(self):
+        return len(self.indices) + sum(len(row) for row in self.replaced.values()) - \
+            sum(self.offsets[id + 1] - self.offsets[id] for id in self.replaced if id < len(self.offsets) - 1)
+
+    def nbytes(self):
+        return self.offsets.itemsize * len(self.offsets) + self.indices.itemsize * len(self.indices) + \
+            sum(row.itemsize * len(row) for row in self.replaced.values())
+
+
+## Co-star graph
+class CostarGraph:
+    """films (actor id -> film ids) and casts (film id -> actor ids), as of change number `seq`."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._starting = threading.Lock()
+        self.builder = None   # the thread running a full build, if one was started
+        self.reset()
+
+    def reset(self):
+        self.films = Adjacency()
+        self.casts = Adjacency()
+        self.seq = None
+        self.builds = 0
+        self.catch_ups = 0
+        self.build_seconds = 0.0
+
+    def load(self, pairs, seq=0):
+        """Build the index from (film_id, actor_id) pairs sorted by film id (then actor id)."""
+        started = time.perf_counter()
+        film_ids, actor_ids = array('i'), array('i')
+        for film_id, actor_id in pairs:
+            film_ids.append(film_id)
+            actor_ids.append(actor_id)
+        casts = Adjacency.from_sorted(film_ids, actor_ids, max(film_ids, default=-1) + 1)
+        # Counting sort by actor id; each actor's films stay in film id order
+        counts = array('q', bytes(8 * (max(actor_ids, default=-1) + 2)))
+        for actor_id in actor_ids:
+            counts[actor_id + 1] += 1
+        offsets = array('q', accumulate(counts))
+        fill = array('q', offsets)
+        films = array('i', bytes(4 * len(film_ids)))
+        for film_id, actor_id in zip(film_ids, actor_ids):
+            films[fill[actor_id]] = film_id
+            fill[actor_id] += 1
+        self.films, self.casts, self.seq = Adjacency(offsets, films), casts, seq
+        self.builds += 1
+        self.build_seconds = time.perf_counter() - started
+
+    def build(self):
+        """Load every link from the database, then catch up with what was written during the scan."""
+        # Read first: anything committed after the scan started is caught up from here
+        seq = settled_change()
+        query = select(film_actors.c.film_id, film_actors.c.actor_id) \
+            .order_by(film_actors.c.film_id, film_actors.c.actor_id)
+        batches = db.session.execute(query.execution_options(stream_results=True)).partitions(BUILD_BATCH_SIZE)
+        with self._lock:
+            self.load(chain.from_iterable(batches), seq)
+            self.catch_up()
+
+    def start_build(self, app):
+        """Run build() on a daemon thread, unless one is running already; returns the thread."""
+        with self._starting:
+            if self.builder is None or not self.builder.is_alive():
+                def work():
+                    with app.app_context():
+                        try:
+                            self.build()
+                        finally:
+                            db.session.remove()
+                self.builder = threading.Thread(target=work, name='costar-build', daemon=True)
+                self.builder.start()
+            return self.builder
+
+    def catch_up(self):
+        """Reload the films and actors written after self.seq (hold self._lock).
+
+        Past COSTAR_REBUILD_AFTER changes the index is dropped instead, for a full rebuild.
+        """
+        entries, more = committed_changes(self.seq, COSTAR_REBUILD_AFTER, change_log.c.kind, change_log.c.row_id)
+        if more:
+            self.seq = None
+            return
+        written = {'film': set(), 'actor': set()}
+        for _, _, kind, row_id in entries:
+            written[kind].add(row_id)
+        for adjacency, own_key, other_key, ids in ((self.films, film_actors.c.actor_id, film_actors.c.film_id,
+                                                    written['actor']),
+                                                   (self.casts, film_actors.c.film_id, film_actors.c.actor_id,
+                                                    written['film'])):
+            ids = sorted(ids)
+            for start in range(0, len(ids), RELOAD_CHUNK_SIZE):
+                chunk = ids[start:start + RELOAD_CHUNK_SIZE]
+                rows = {id: [] for id in chunk}
+                for owner_id, other_id in db.session.execute(select(own_key, other_key).where(own_key.in_(chunk))):
+                    rows[owner_id].append(other_id)
+                for id, neighbours in rows.items():
+                    adjacency.replace(id, neighbours)
+        if not entries:
+            return
+        self.seq = entries[-1].seq
+        self.catch_ups += 1
+        for name in ('films', 'casts'):
+            adjacency = getattr(self, name)
+            if len(adjacency.replaced) > max(RELOAD_CHUNK_SIZE, COSTAR_COMPACT_FRACTION * adjacency.size()):
+                setattr(self, name, adjacency.compacted())
+
+    def refresh(self):
+        """Bring the index up to date with the database (call inside a request or app context).
+
+        Raises ServiceUnavailable (503) while the index is being built.
+        """
+        if self.seq is not None and latest_change() > self.seq:
+            # Behind: catch up, or wait for an earlier change still committing
+            with self._lock:
+                if self.seq is not None:
+                    self.catch_up()
+        if self.seq is None:
+            self.start_build(current_app._get_current_object())
+            raise ServiceUnavailable(description="The co-star index is being built, retry shortly.",
+                                     retry_after=COSTAR_RETRY_AFTER)
+        return self
+
+    ## Queries
+    def costars(self, actor_id, limit):
+        """(number of co-stars, [(actor id, films shared)...]) for the `limit` actors who shared most films with
+        `actor_id`, ties broken by id."""
+        films, casts = self.films, self.casts
+        counts = Counter()
+        for film_id in films.row(actor_id):
+            counts.update(casts.row(film_id))
+        counts.pop(actor_id, None)
+        return len(counts), heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def path(self, source, target, max_degrees=MAX_DEGREES):
+        """([actor ids], [film ids]) of a shortest chain of co-stars from `source` to `target`, or None.
+
+        films[i] links actors[i] and actors[i + 1]. Searches breadth first from both
+        ends, widening the smaller frontier each round, for at most `max_degrees` films.
+        """
+        films, casts = self.films, self.casts
+        if source == target:
+            return [source], []
+        # Per end: actor reached -> (actor it was reached from, film), films already scanned, frontier
+        sides = [({source: None}, set(), [source]), ({target: None}, set(), [target])]
+        for _ in range(max_degrees):
+            side = 0 if len(sides[0][2]) <= len(sides[1][2]) else 1
+            reached, scanned, frontier = sides[side]
+            opposite = sides[1 - side][0]
+            widened = []
+            for actor_id in frontier:
+                for film_id in films.row(actor_id):
+                    if film_id in scanned:
+                        continue
+                    scanned.add(film_id)
+                    for costar in casts.row(film_id):
+                        if costar in reached:
+                            continue
+                        reached[costar] = (actor_id, film_id)
+                        if costar in opposite:
+                            return joined(costar, sides[0][0], sides[1][0])
+                        widened.append(costar)
+            if not widened:
+                return None
+            sides[side] = (reached, scanned, widened)
+        return None
+
+    def exposition(self):
+        return metrics.gauges(
+            'costar_graph_links', 'Casting links held by the in-memory co-star index.',
+            {(): self.casts.links()}) + metrics.gauges(
+            'costar_graph_bytes', 'Memory held by the co-star index arrays.',
+            {(): self.films.nbytes() + self.casts.nbytes()}) + metrics.gauges(
+            'costar_graph_build_seconds', 'Time the last full build of the co-star index took.',
+            {(): '%.3f' % self.build_seconds}) + metrics.gauges(
+            'costar_graph_updates_total', 'Full builds and incremental catch-ups of the co-star index.',
+            {(('kind', 'build'),): self.builds, (('kind', 'catch_up'),): self.catch_ups}, kind='counter')
+
+
+def joined(meeting, forward, backward):
+    actors, films = [meeting], []
+    actor_id = meeting
+    while forward[actor_id] is not None:
+        actor_id, film_id = forward[actor_id]
+        actors.append(actor_id)
+        films.append(film_id)
+    actors.reverse()
+    films.reverse()
+    actor_id = meeting
+    while backward[actor_id] is not None:
+        actor_id, film_id = backward[actor_id]
+        actors.append(actor_id)
+        films.append(film_id)
+    return actors, films
+
+
+def latest_change():
+    return db.session.execute(select(func.max(change_log.c.seq))).scalar() or 0
+
+
+def rows_by_id(model, ids):
+    """{id: public fields as a dict} for the rows of `model` with these ids, in one query."""
+    ids = list(ids)
+    if not ids:
+        return {}
+    fields, query = projection(model)
+    return {row[0]: dict(zip(fields, row)) for row in db.session.execute(query.where(model.id.in_(ids)))}
+
+
+graph = CostarGraph()
+metrics.collectors['costar_graph'] = graph.exposition
@@ -0,0 +1,172 @@
+import os, threading, time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+
+# Pool settings, each overridable from the environment (e.g. DB_POOL_SIZE=10)
+POOL_DEFAULTS = {
+    'pool_size': 5,          # connections kept open per worker
+    'max_overflow': 5,       # extra connections allowed under bursts
+    'pool_timeout': 10,      # seconds to wait for a free connection before erroring
+    'pool_recycle': 1800,    # replace connections older than this (seconds)
+    'pool_pre_ping': True    # test connections on checkout, so stale ones are replaced
+}
+POOL_ENV = {
+    'pool_size': ('DB_POOL_SIZE', int),
+    'max_overflow': ('DB_MAX_OVERFLOW', int),
+    'pool_timeout': ('DB_POOL_TIMEOUT', float),
+    'pool_recycle': ('DB_POOL_RECYCLE', int),
+    'pool_pre_ping': ('DB_POOL_PRE_PING', lambda value: value.lower() in ('1', 'true', 'yes'))
+}
+# Options that only make sense for a QueuePool (not SQLite's default pools)
+QUEUE_POOL_ONLY = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+def engine_options(database_path, **overrides):
+    """SQLAlchemy engine options for the connection pool: defaults, then env, then overrides."""
+    options = dict(POOL_DEFAULTS)
+    for option, (name, parse) in POOL_ENV.items():
+        if os.environ.get(name):
+            options[option] = parse(os.environ[name])
+    options.update(overrides)
+    if database_path.startswith('sqlite'):
+        for option in QUEUE_POOL_ONLY:
+            options.pop(option, None)
+    else:
+        options['poolclass'] = TimedQueuePool
+    return options
+
+
+## Pool Metrics
+class PoolMetrics:
+    """Checkout wait time, occupancy and connection errors for one engine's pool.
+
+    checkout_timeouts counts checkouts that gave up waiting for a free connection
+    (pool exhaustion); connect_errors only counts failures to open a new one.
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.connect_errors = 0
+        self.checkout_timeouts = 0
+        self.disconnects = 0
+        self.invalidated = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self, pool):
+        stats = {
+            'pool': type(pool).__name__,
+            'checkouts': self.checkouts,
+            'connects': self.connects,
+            'connect_errors': self.connect_errors,
+            'checkout_timeouts': self.checkout_timeouts,
+            'disconnects': self.disconnects,
+            'invalidated': self.invalidated,
+            'checkout_wait_avg_ms': round(1000 * self.wait_total / self.checkouts, 3) if self.checkouts else 0.0,
+            'checkout_wait_max_ms': round(1000 * self.wait_max, 3)
+        }
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'idle': pool.checkedin(),
+                'overflow': max(pool.overflow(), 0),
+                'max_overflow': pool._max_overflow,
+                'timeout': pool.timeout()
+            })
+        return stats
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that times how long each checkout waits for a connection."""
+
+    metrics = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            if self.metrics is not None:
+                self.metrics.count('checkout_timeouts')
+            raise
+        except Exception:   # anything else is the DBAPI failing to open a connection
+            if self.metrics is not None:
+                self.metrics.count('connect_errors')
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.record_wait(time.perf_counter() - started)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def instrument(engine):
+    """Attach a PoolMetrics to an engine (once) and return it."""
+    metrics = getattr(engine, 'pool_metrics', None)
+    if metrics is not None:
+        return metrics
+    metrics = engine.pool_metrics = PoolMetrics()
+    if isinstance(engine.pool, TimedQueuePool):
+        engine.pool.metrics = metrics
+    else:
+        @event.listens_for(engine, 'checkout')
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            metrics.count('checkouts')
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        metrics.count('connects')
+
+    @event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        metrics.count('invalidated')
+
+    @event.listens_for(engine, 'handle_error')
+    def on_error(context):
+        if context.is_disconnect:
+            metrics.count('disconnects')
+
+    return metrics
+
+
+## Forked workers
+# Pools replaced after a fork, kept referenced so their connections (the parent's) are never closed by this process
+inherited_pools = []
+
+
+def guard_fork(engine):
+    """Never hand out a connection opened by another process: one inherited across a fork is
+    discarded (without closing it - it's still the parent's) and replaced on checkout."""
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info.get('pid', os.getpid()) != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Connection opened by process %s, not this one' % connection_record.info['pid'])
+
+
+def after_fork(engine):
+    """Give a freshly forked worker an empty pool of its own, leaving the inherited connections open."""
+    inherited_pools.append(engine.pool)
+    engine.pool = engine.pool.recreate()
@@ -0,0 +1,36 @@
+"""gunicorn settings for serving the API (the Procfile's web process):
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Every setting can be overridden from the environment; see warmup.py for what the
+hooks do before and after the fork.
+"""
+import os
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '8000')
+# Heroku sets WEB_CONCURRENCY from the dyno size
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# 'gthread' serves `threads` requests at once per worker; 'sync' one at a time
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# Recycle each worker after this many requests (0 never does), staggered by up to the jitter
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 25))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# Import and warm the app once in the master; workers are forked from it
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+
+def when_ready(server):
+    """The app is loaded (when preloaded) and no worker is forked yet."""
+    if server.cfg.preload_app:
+        import warmup
+        warmup.warm_master(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    """In the new worker, before it accepts connections."""
+    import warmup
+    warmup.warm_worker(worker.app.wsgi())
@@ -0,0 +1,215 @@
+"""Idempotency-Key support for POST /film and /actor.
+
+A client retrying a POST with the same Idempotency-Key header gets the first
+response replayed (marked Idempotent-Replayed: true) instead of a second row.
+Keys are scoped to the caller (the token's sub), the method and the path, and are
+kept for IDEMPOTENCY_TTL seconds (default a day).
+
+The key is inserted into idempotency_keys in the same transaction as the row the
+request creates, so of two racing requests with one key (say on two gunicorn
+workers) only one commits; the other is answered with the stored response, or a
+409 while the first is still finishing. The response is stored once the handler has
+returned, in a second transaction; a key whose response never got stored (its
+worker died in between) is only held for IDEMPOTENCY_LEASE seconds (default 5
+minutes), after which a retry runs the request again. Each worker also keeps the
+responses it has seen in a small LRU, so most retries don't touch the database at all.
+A key reused with a different body is rejected with 422.
+"""
+import hashlib, os, threading, time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import Response, abort, make_response, request
+from sqlalchemy import and_, delete, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, idempotency_keys
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+# How long a key whose response hasn't been stored holds off retries; longer than any request takes
+IDEMPOTENCY_LEASE = int(os.environ.get('IDEMPOTENCY_LEASE', 300))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 4096))
+MAX_KEY_LENGTH = 255
+# Expired rows are deleted by a write at most this often (seconds), per worker
+PURGE_INTERVAL = 60
+
+# A finished response; `fingerprint` identifies the request body it answered
+Stored = namedtuple('Stored', 'fingerprint status body')
+
+
+## Per-worker store
+class KeyStore:
+    """Finished responses by scoped key, least recently used evicted first, each kept for `ttl` seconds."""
+
+    def __init__(self, max_entries=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key digest -> (expires_at, Stored)
+        self._lock = threading.Lock()
+        self.purged_at = 0.0
+
+    def get(self, digest):
+        with self._lock:
+            item = self._entries.get(digest)
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return item[1]
+
+    def set(self, digest, stored):
+        with self._lock:
+            self._entries[digest] = (time.monotonic() + self.ttl, stored)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def purge_due(self, interval):
+        """True at most once every `interval` seconds, for deleting expired keys from the database."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self.purged_at < interval:
+                return False
+            self.purged_at = now
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+store = KeyStore()
+
+
+## Keys and statements, shared with asgi.py
+def request_key(payload, method, path, key, body):
+    """(scoped key digest, body fingerprint) for a request's Idempotency-Key, or None without one."""
+    if key is None:
+        return None
+    if not key or len(key) > MAX_KEY_LENGTH:
+        abort(400, description="Idempotency-Key must be 1 to %d characters." % MAX_KEY_LENGTH)
+    scope = '\0'.join((str(payload.get('sub')), method, path, key))
+    return (hashlib.blake2b(scope.encode(), digest_size=16).hexdigest(),
+            hashlib.blake2b(body, digest_size=8).hexdigest())
+
+
+def expires_before():
+    return datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_TTL)
+
+
+def lease_expired_before():
+    return datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_LEASE)
+
+
+def stale():
+    """Keys past their TTL, and keys whose response wasn't stored within the lease."""
+    return or_(idempotency_keys.c.created_at < expires_before(),
+               and_(idempotency_keys.c.status.is_(None), idempotency_keys.c.created_at < lease_expired_before()))
+
+
+def lookup(digest):
+    return select(idempotency_keys.c.fingerprint, idempotency_keys.c.status, idempotency_keys.c.body,
+                  idempotency_keys.c.created_at).where(idempotency_keys.c.key == digest)
+
+
+def reserve(digest, fingerprint):
+    return insert(idempotency_keys).values(key=digest, fingerprint=fingerprint, created_at=datetime.utcnow())
+
+
+def finish(digest, status, body):
+    return update(idempotency_keys).where(idempotency_keys.c.key == digest).values(status=status, body=body)
+
+
+def expired(digest):
+    """Delete `digest`'s row if it has expired or its lease has run out, so the key can be reserved again."""
+    return delete(idempotency_keys).where(idempotency_keys.c.key == digest, stale())
+
+
+def purge():
+    """Delete every expired key, or None if this worker has done so in the last PURGE_INTERVAL seconds."""
+    if not store.purge_due(PURGE_INTERVAL):
+        return None
+    return delete(idempotency_keys).where(stale())
+
+
+def stored_response(row, fingerprint):
+    """The Stored response for a looked up row; None if the key has expired.
+
+    Aborts with 422 if the key came with a different body, and 409 if the first
+    request hasn't stored its response yet and its lease hasn't run out.
+    """
+    if row is None or row.created_at < expires_before():
+        return None
+    if row.status is None and row.created_at < lease_expired_before():
+        return None
+    if row.status is None and row.fingerprint == fingerprint:
+        abort(409, description="A request with this Idempotency-Key is still in progress.")
+    return check_fingerprint(Stored(row.fingerprint, row.status, bytes(row.body or b'')), fingerprint)
+
+
+def check_fingerprint(stored, fingerprint):
+    if stored.fingerprint != fingerprint:
+        abort(422, description="Idempotency-Key was already used with a different request.")
+    return stored
+
+
+## Flask
+def replay(stored):
+    return Response(stored.body, status=stored.status, mimetype='application/json',
+                    headers={'Idempotent-Replayed': 'true'})
+
+
+def fetch(digest, fingerprint):
+    stored = stored_response(db.session.execute(lookup(digest)).first(), fingerprint)
+    if stored is not None:
+        store.set(digest, stored)
+    return stored
+
+
+def idempotent(f):
+    """Route decorator (under @RequiresAuth): replay the response to a repeated Idempotency-Key.
+
+    The handler must commit its write with db.session, which commits the reserved key with it.
+    """
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        claim = request_key(payload, request.method, request.path,
+                            request.headers.get('Idempotency-Key'), request.get_data())
+        if claim is None:
+            return f(payload, *args, **kwargs)
+        digest, fingerprint = claim
+        stored = store.get(digest)
+        if stored is not None:
+            return replay(check_fingerprint(stored, fingerprint))
+        stored = fetch(digest, fingerprint)
+        if stored is not None:
+            return replay(stored)
+        try:
+            db.session.execute(expired(digest))
+            db.session.execute(reserve(digest, fingerprint))
+        except IntegrityError:
+            # Another worker committed this key since the lookup
+            db.session.rollback()
+            stored = fetch(digest, fingerprint)
+            if stored is None:
+                abort(409, description="A request with this Idempotency-Key is still in progress.")
+            return replay(stored)
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            raise
+        body = response.get_data()
+        db.session.execute(finish(digest, response.status_code, body))
+        statement = purge()
+        if statement is not None:
+            db.session.execute(statement)
+        db.session.commit()
+        store.set(digest, Stored(fingerprint, response.status_code, body))
+        return response
+    return wrapper
@@ -0,0 +1,406 @@
+"""Background imports: catalogue files are uploaded, then loaded by a separate worker.
+
+POST /imports/films, /imports/actors or /imports/casting with a CSV (a header row,
+then one record per line) or NDJSON body stores the file as an import job and
+answers 202 with the job straight away; GET /imports/<id> reports its progress.
+A worker process (`python import_worker.py`, the Procfile's worker) loads each job
+IMPORT_CHUNK_ROWS rows at a time. Every chunk is written in one transaction with the
+job's checkpoint - the byte offset reached and the counts so far - so a worker that
+stops or dies partway leaves a job the next one resumes where it left off.
+
+    IMPORT_QUEUE=database       # default: workers claim queued jobs from import_jobs, any number of them
+    IMPORT_QUEUE=local          # jobs run on a thread of the web process (development; no worker needed)
+    IMPORT_CHUNK_ROWS=1000
+    IMPORT_MAX_BYTES=104857600
+    IMPORT_LEASE_SECONDS=120    # a running job not checkpointed for this long is taken over
+    IMPORT_MAX_ATTEMPTS=5       # runs of a job that may fail before it is marked failed
+    IMPORT_RETRY_SECONDS=10     # back-off after the first failure, doubled after each one after that
+
+Rows that fail validation, or link a film or actor that doesn't exist, are skipped
+and counted; the first IMPORT_MAX_ERRORS are reported with their row numbers. A run
+that fails otherwise - the database went away, say - puts the job back in the queue
+to be resumed from its checkpoint after a back-off. It is marked failed after
+IMPORT_MAX_ATTEMPTS such runs, or at once on an error retrying can't fix.
+"""
+import csv, json, logging, os, queue as queues, threading, time
+from datetime import datetime, timedelta
+from flask import Response, abort, request
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.exc import DataError, IntegrityError, ProgrammingError
+
+from models import db, film_actors, import_jobs, insert_chunk, link_chunk, cast_tags, missing_ids, notify_write, \
+    Actor, Film
+from params import validate_row
+from serialise import dumps
+
+IMPORT_CHUNK_ROWS = int(os.environ.get('IMPORT_CHUNK_ROWS', 1000))
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 100 * 2 ** 20))
+IMPORT_LEASE_SECONDS = int(os.environ.get('IMPORT_LEASE_SECONDS', 120))
+IMPORT_MAX_ATTEMPTS = int(os.environ.get('IMPORT_MAX_ATTEMPTS', 5))
+IMPORT_RETRY_SECONDS = float(os.environ.get('IMPORT_RETRY_SECONDS', 10))
+IMPORT_POLL_SECONDS = 1.0
+IMPORT_MAX_ERRORS = 20
+
+KINDS = {'films': Film, 'actors': Actor, 'casting': film_actors}
+FORMATS = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson'}
+# What GET /imports/<id> reports (everything but the payload)
+STATUS_FIELDS = ('id', 'kind', 'format', 'status', 'size', 'position', 'processed', 'created', 'rejected',
+                 'errors', 'attempts', 'retry_at', 'created_at', 'updated_at', 'finished_at')
+# Failures that would only happen again: the job's own data, or a bug
+NOT_RETRYABLE = (IntegrityError, DataError, ProgrammingError, LookupError, TypeError, ValueError)
+
+logger = logging.getLogger('imports')
+
+
+## Job store
+def create_job(kind, fmt, payload, owner=None):
+    """Store an uploaded file as a queued job and return its id."""
+    now = datetime.utcnow()
+    result = db.session.execute(import_jobs.insert().values(
+        kind=kind, format=fmt, owner=owner, status='queued', payload=payload, size=len(payload),
+        position=0, processed=0, created=0, rejected=0, created_at=now, updated_at=now))
+    db.session.commit()
+    job_id = result.inserted_primary_key[0]
+    queue.push(job_id)
+    return job_id
+
+
+def job_status(job_id, owner=None):
+    """The progress of a job as a dict, or None if there is none (or it isn't `owner`'s)."""
+    columns = [import_jobs.c[field] for field in STATUS_FIELDS] + [import_jobs.c.owner]
+    row = db.session.execute(select(*columns).where(import_jobs.c.id == job_id)).first()
+    if row is None or (owner is not None and row.owner != owner):
+        return None
+    job = dict(zip(STATUS_FIELDS, row))
+    job['errors'] = json.loads(job['errors'] or '[]')
+    job['progress'] = round(job['position'] / job['size'], 4) if job['size'] else 1.0
+    return job
+
+
+def stale_before():
+    return datetime.utcnow() - timedelta(seconds=IMPORT_LEASE_SECONDS)
+
+
+def claimable():
+    """Jobs a worker may take: queued ones (once any back-off is over), and running ones whose worker has gone quiet."""
+    return or_(and_(import_jobs.c.status == 'queued',
+                    or_(import_jobs.c.retry_at.is_(None), import_jobs.c.retry_at <= datetime.utcnow())),
+               and_(import_jobs.c.status == 'running', import_jobs.c.updated_at < stale_before()))
+
+
+def retry_delay(attempts):
+    """Seconds to wait before the next run of a job that has failed `attempts` times."""
+    return IMPORT_RETRY_SECONDS * 2 ** (attempts - 1)
+
+
+def claim(job_id):
+    """Mark a job as running in this worker; False if another worker has it."""
+    result = db.session.execute(update(import_jobs).where(import_jobs.c.id == job_id, claimable())
+                                .values(status='running', updated_at=datetime.utcnow()))
+    db.session.commit()
+    return result.rowcount == 1
+
+
+## Queues
+class DatabaseQueue:
+    """The import_jobs table is the queue: workers poll it for the oldest job they can claim."""
+
+    def __init__(self, poll=IMPORT_POLL_SECONDS):
+        self.poll = poll
+
+    def push(self, job_id, delay=0):
+        pass   # the committed row is the queue entry
+
+    def pop(self, timeout):
+        """The id of a claimable job, or None after `timeout` seconds without one."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job_id = db.session.execute(select(import_jobs.c.id).where(claimable())
+                                        .order_by(import_jobs.c.id).limit(1)).scalar()
+            db.session.commit()
+            if job_id is not None or time.monotonic() >= deadline:
+                return job_id
+            time.sleep(min(self.poll, max(0.0, deadline - time.monotonic())))
+
+
+class LocalQueue:
+    """Job ids in this process's memory, for tests and for running imports inside the web process."""
+
+    def __init__(self):
+        self._queue = queues.Queue()
+        self.thread = None
+
+    def push(self, job_id, delay=0):
+        if delay > 0:
+            timer = threading.Timer(delay, self._queue.put, (job_id,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._queue.put(job_id)
+
+    def pop(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+        except queues.Empty:
+            return None
+
+    def start(self, app):
+        """Run a Worker on a daemon thread of this process."""
+        if self.thread is None:
+            def work():
+                with app.app_context():
+                    Worker(self).run_forever()
+            self.thread = threading.Thread(target=work, name='import-worker', daemon=True)
+            self.thread.start()
+
+
+def local_imports():
+    return os.environ.get('IMPORT_QUEUE', 'database') == 'local'
+
+
+def queue_from_env():
+    """DatabaseQueue by default; IMPORT_QUEUE=local runs imports in the web process instead."""
+    return LocalQueue() if local_imports() else DatabaseQueue()
+
+
+queue = queue_from_env()
+
+
+def init_app(app):
+    """With IMPORT_QUEUE=local, start this process's own worker thread."""
+    if local_imports():
+        queue.start(app)
+
+
+## Reading files
+def lines(payload, position):
+    """(offset after the line, line) for each line of `payload` from byte `position`."""
+    while position < len(payload):
+        end = payload.find(b'\n', position)
+        end = len(payload) if end < 0 else end + 1
+        yield end, payload[position:end]
+        position = end
+
+
+def csv_rows(payload, position):
+    """(offset after the row, values) for each CSV row of `payload` from byte `position`, or the
+    ValueError that stopped the row being read. One reader runs over all the lines, so a quoted
+    field may span several of them; the offset is that of the row's last line."""
+    read = {'end': position, 'error': None}
+
+    def text():
+        for end, line in lines(payload, position):
+            try:
+                decoded = line.decode('utf-8-sig' if end == len(line) else 'utf-8')
+            except UnicodeDecodeError as error:
+                read['error'] = read['error'] or error
+                decoded = line.decode('utf-8', 'replace')
+            read['end'] = end
+            yield decoded
+
+    reader = csv.reader(text())
+    while True:
+        try:
+            values = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as error:
+            values = ValueError(str(error))
+        if read['error'] is not None:
+            values, read['error'] = ValueError(str(read['error'])), None
+        yield read['end'], values
+
+
+def records(payload, fmt, position):
+    """(offset after the record, record) from byte `position` on; a record is a dict, or the ValueError
+    that stopped it being read. Blank lines are skipped; CSV files start with a header row."""
+    if fmt == 'csv':
+        header_end, header = next(csv_rows(payload, 0), (0, []))
+        header = [] if isinstance(header, ValueError) else [name.strip() for name in header]
+        for end, values in csv_rows(payload, max(position, header_end)):
+            if not isinstance(values, ValueError):
+                if not ''.join(values).strip():
+                    continue
+                if len(values) != len(header):
+                    values = ValueError("expected %d columns, got %d" % (len(header), len(values)))
+                else:
+                    values = dict(zip(header, values))
+            yield end, values
+        return
+    for end, line in lines(payload, position):
+        try:
+            text = line.decode('utf-8-sig' if position == 0 else 'utf-8').strip()
+            if text:
+                yield end, json.loads(text)
+        except ValueError as error:   # includes bad UTF-8 and bad JSON
+            yield end, ValueError(str(error))
+        finally:
+            position = end
+
+
+def load_chunk(model, numbered, text=False):
+    """Write the valid records of a chunk in the current transaction (`text` for CSV records).
+
+    Returns (rows written, [rejection messages], cache tags to invalidate).
+    """
+    rows, rejected = [], []
+    for number, record in numbered:
+        try:
+            if isinstance(record, ValueError):
+                raise record
+            rows.append((number, validate_row(model, record, text)))
+        except ValueError as error:
+            rejected.append((number, str(error)))
+    if model is film_actors:
+        unknown = {field: missing_ids(other, {row[field] for _, row in rows})
+                   for other, field in ((Film, 'film_id'), (Actor, 'actor_id'))}
+        for number, row in rows:
+            for field, ids in unknown.items():
+                if row[field] in ids:
+                    rejected.append((number, "unknown %s %d" % (field, row[field])))
+        rows = [(number, row) for number, row in rows if all(row[field] not in ids for field, ids in unknown.items())]
+        links = link_chunk([(row['film_id'], row['actor_id']) for _, row in rows]) if rows else []
+        return len(links), sorted(rejected), cast_tags(links) if links else ()
+    ids = insert_chunk(model, [row for _, row in rows]) if rows else []
+    return len(ids), sorted(rejected), (model.__tablename__,) if ids else ()
+
+
+## Worker
+class Worker:
+    """Claims jobs from a queue and loads them chunk by chunk (call inside an app context).
+
+    stop() lets the current chunk commit, then puts the job back in the queue. A run
+    that fails puts it back too, for a retry after a back-off (see failed()).
+    """
+
+    def __init__(self, queue, chunk_rows=IMPORT_CHUNK_ROWS, poll=IMPORT_POLL_SECONDS):
+        self.queue = queue
+        self.chunk_rows = chunk_rows
+        self.poll = poll
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run_forever(self):
+        while not self.stopping.is_set():
+            self.run_once(self.poll)
+
+    def run_once(self, timeout=0):
+        """Load the next job, if one turns up within `timeout` seconds; True if there was one."""
+        job_id = self.queue.pop(timeout)
+        if job_id is None or not claim(job_id):
+            return False
+        try:
+            self.run(job_id)
+        except Exception as error:
+            db.session.rollback()
+            try:
+                self.failed(job_id, error)
+            except Exception:
+                # Likely the same outage: the job is taken over once its lease runs out
+                db.session.rollback()
+                logger.exception("import job %d could not be requeued", job_id)
+        finally:
+            db.session.remove()
+        return True
+
+    def failed(self, job_id, error):
+        """Requeue a job whose run raised `error`, to be retried after a back-off; or mark it failed, after
+        IMPORT_MAX_ATTEMPTS runs or on an error retrying can't fix."""
+        attempts = db.session.execute(select(import_jobs.c.attempts).where(import_jobs.c.id == job_id)).scalar() + 1
+        message = "%s: %s" % (type(error).__name__, error)
+        now = datetime.utcnow()
+        if isinstance(error, NOT_RETRYABLE) or attempts >= IMPORT_MAX_ATTEMPTS:
+            logger.exception("import job %d failed (attempt %d)", job_id, attempts)
+            values = dict(status='failed', errors=json.dumps([message]), finished_at=now)
+            delay = None
+        else:
+            delay = retry_delay(attempts)
+            logger.warning("import job %d failed (attempt %d), retrying in %.0f s: %s",
+                           job_id, attempts, delay, message, exc_info=True)
+            values = dict(status='queued', retry_at=now + timedelta(seconds=delay))
+        db.session.execute(update(import_jobs).where(import_jobs.c.id == job_id).values(
+            attempts=attempts, updated_at=now, **values))
+        db.session.commit()
+        if delay is not None:
+            self.queue.push(job_id, delay)
+
+    def run(self, job_id):
+        job = db.session.execute(select(import_jobs).where(import_jobs.c.id == job_id)).first()
+        db.session.commit()
+        model = KINDS[job.kind]
+        progress = {'position': job.position, 'processed': job.processed, 'created': job.created,
+                    'rejected': job.rejected, 'errors': json.loads(job.errors or '[]')}
+        chunk, end, text = [], job.position, job.format == 'csv'
+        for end, record in records(bytes(job.payload), job.format, job.position):
+            chunk.append((progress['processed'] + len(chunk) + 1, record))
+            if len(chunk) == self.chunk_rows:
+                if not self.checkpoint(job_id, model, chunk, end, progress, text):
+                    return
+                chunk = []
+                if self.stopping.is_set():
+                    self.finish(job_id, 'queued')
+                    return
+        if chunk or end != progress['position']:
+            if not self.checkpoint(job_id, model, chunk, end, progress, text):
+                return
+        self.finish(job_id, 'done')
+
+    def checkpoint(self, job_id, model, chunk, end, progress, text=False):
+        """Write a chunk and move the job's checkpoint past it, in one transaction.
+
+        False (and nothing written) if the job's checkpoint moved meanwhile - another
+        worker took the job over after this one went quiet for too long.
+        """
+        created, rejected, tags = load_chunk(model, chunk, text)
+        errors = (progress['errors'] + ["row %d: %s" % item for item in rejected])[:IMPORT_MAX_ERRORS]
+        result = db.session.execute(
+            update(import_jobs).where(import_jobs.c.id == job_id, import_jobs.c.position == progress['position'],
+                                      import_jobs.c.status == 'running')
+            .values(position=end, processed=progress['processed'] + len(chunk),
+                    created=progress['created'] + created, rejected=progress['rejected'] + len(rejected),
+                    errors=json.dumps(errors), updated_at=datetime.utcnow()))
+        if result.rowcount != 1:
+            db.session.rollback()
+            logger.warning("import job %d was taken over by another worker", job_id)
+            return False
+        db.session.commit()
+        if tags:
+            notify_write(*tags)
+        progress.update(position=end, processed=progress['processed'] + len(chunk),
+                        created=progress['created'] + created, rejected=progress['rejected'] + len(rejected),
+                        errors=errors)
+        return True
+
+    def finish(self, job_id, status):
+        """Mark a job done (the whole file read), or queued again for another worker."""
+        values = dict(status=status, updated_at=datetime.utcnow())
+        if status == 'done':
+            values.update(position=import_jobs.c.size, finished_at=datetime.utcnow())
+        db.session.execute(update(import_jobs).where(import_jobs.c.id == job_id).values(**values))
+        db.session.commit()
+
+
+## Flask
+def upload_format():
+    """csv or ndjson, from ?format= or the Content-Type."""
+    fmt = request.args.get('format') or FORMATS.get(request.mimetype)
+    if fmt not in FORMATS.values():
+        abort(400, description="Send the file as text/csv or application/x-ndjson (or with ?format=csv|ndjson).")
+    return fmt
+
+
+def start_import(payload, kind):
+    """Store the request body as an import job of `kind` and queue it: a 202 with the job and its URL."""
+    fmt = upload_format()
+    if (request.content_length or 0) > IMPORT_MAX_BYTES:
+        abort(400, description="Files of at most %d bytes can be imported." % IMPORT_MAX_BYTES)
+    body = request.get_data()
+    if not body.strip():
+        abort(400, description="The file is empty.")
+    if len(body) > IMPORT_MAX_BYTES:
+        abort(400, description="Files of at most %d bytes can be imported." % IMPORT_MAX_BYTES)
+    job_id = create_job(kind, fmt, body, payload.get('sub'))
+    return Response(dumps({"Success": "True", "job": job_status(job_id)}), status=202,
+                    mimetype='application/json', headers={'Location': '/imports/%d' % job_id})
@@ -0,0 +1,26 @@
+"""The import worker: loads the queued catalogue imports (see import_jobs.py).
+
+    python import_worker.py
+
+Run as many as needed; each claims one job at a time. SIGTERM (sent when a Heroku
+dyno restarts) lets the current chunk commit, puts the job back in the queue and
+exits, and the next worker resumes it from that checkpoint.
+"""
+import logging, signal
+
+import import_jobs
+from app import create_app
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    app = create_app()
+    worker = import_jobs.Worker(import_jobs.queue)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: worker.stop())
+    with app.app_context():
+        worker.run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import asyncio, json, re, threading, time
+from urllib.request import urlopen
+from jose import jwk
+from jose.exceptions import JWKError
+
+
+DEFAULT_TTL = 600            # seconds to keep a key set when Cache-Control gives no max-age
+MIN_TTL = 30                 # never refetch more often than this, whatever the IdP says
+MIN_REFETCH_INTERVAL = 30    # rate limit for refetches triggered by an unknown kid
+REFRESH_AHEAD = 0.8          # refresh in the background once this fraction of the TTL has passed
+FETCH_TIMEOUT = 5
+
+MAX_AGE = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)"?', re.IGNORECASE)
+
+
+def ttl_from_cache_control(header, default=DEFAULT_TTL):
+    """Work out how long a key set may be cached for from a Cache-Control header."""
+    if not header:
+        return default
+    directives = header.lower()
+    if 'no-store' in directives or 'no-cache' in directives:
+        return MIN_TTL
+    match = MAX_AGE.search(directives)
+    if not match:
+        return default
+    return max(int(match.group(1)), MIN_TTL)
+
+
+## JWKS Key Store
+class JWKSKeyStore:
+    """Process-wide cache of signing keys, indexed by Key ID (kid).
+
+    Keys are held as prebuilt jose Key objects, so verifying a token never has
+    to parse the JWK again. Keys come either from the IdP's jwks.json URL or
+    from a local file (handy for tests and offline development).
+    """
+
+    def __init__(self, url=None, path=None, algorithm='RS256',
+                 default_ttl=DEFAULT_TTL, min_refetch_interval=MIN_REFETCH_INTERVAL):
+        self.url = url
+        self.path = path
+        self.algorithm = algorithm
+        self.default_ttl = default_ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.keys = {}
+        self.expires_at = 0.0
+        self.fetched_at = 0.0
+        self.last_attempt = 0.0
+        self.rotation_listeners = []
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._stop = threading.Event()
+        if path:
+            self.load_file(path)
+
+    def load_keys(self, jwks, ttl=None):
+        """Replace the cached keys with those in a JWK Set dictionary."""
+        keys = {}
+        for key in jwks.get('keys', []):
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig' or 'kid' not in key:
+                continue
+            try:
+                keys[key['kid']] = jwk.construct(key, self.algorithm)
+            except JWKError:
+                continue
+        now = time.monotonic()
+        retired = set(self.keys) - set(keys)
+        self.keys = keys
+        self.fetched_at = now
+        self.expires_at = now + (self.default_ttl if ttl is None else ttl)
+        if retired:
+            for listener in self.rotation_listeners:
+                listener(retired)
+        return keys
+
+    def on_rotate(self, listener):
+        """Register a callback taking the set of kids dropped by the IdP."""
+        self.rotation_listeners.append(listener)
+        return listener
+
+    def load_file(self, path):
+        """Load the key set from a local JSON file. File keys never expire."""
+        with open(path) as jwks_file:
+            jwks = json.load(jwks_file)
+        self.path = path
+        return self.load_keys(jwks, ttl=float('inf'))
+
+    def fetch(self):
+        """Fetch the key set from the IdP, honouring its Cache-Control max-age."""
+        self.last_attempt = time.monotonic()
+        with urlopen(self.url, timeout=FETCH_TIMEOUT) as response:
+            ttl = ttl_from_cache_control(response.headers.get('Cache-Control'), self.default_ttl)
+            jwks = json.loads(response.read())
+        return self.load_keys(jwks, ttl=ttl)
+
+    def refresh(self, force=False):
+        """Refetch the key set if it has expired (or if forced).
+
+        Only one thread fetches at a time; the others keep using the current
+        keys. A failed fetch leaves the previous (stale) keys in place.
+        """
+        if not self.url:
+            return False
+        if not self._lock.acquire(blocking=not self.keys):
+            return False
+        try:
+            if not force and time.monotonic() < self.expires_at:
+                return False
+            try:
+                self.fetch()
+            except Exception:
+                if not self.keys:
+                    raise
+                return False
+            return True
+        finally:
+            self._lock.release()
+
+    def get_key(self, kid):
+        """Return the Key object for a kid, or None if the IdP doesn't know it."""
+        now = time.monotonic()
+        if now >= self.expires_at:
+            self.refresh()
+        self.start_background_refresh()
+        key = self.keys.get(kid)
+        if key is None and self.url and now - self.last_attempt >= self.min_refetch_interval:
+            # Unknown kid: the IdP may have rotated its keys, so refetch - but
+            # rate limited, so a stream of forged kids can't hammer the IdP.
+            self.refresh(force=True)
+            key = self.keys.get(kid)
+        return key
+
+    async def get_key_async(self, kid):
+        """get_key for async callers: cached keys are returned directly, and any
+        fetch from the IdP happens in a worker thread, off the event loop."""
+        key = self.keys.get(kid)
+        if key is not None and time.monotonic() < self.expires_at:
+            self.start_background_refresh()
+            return key
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_key, kid)
+
+    ## Background refresh
+    def start_background_refresh(self):
+        """Keep the key set fresh from a daemon thread, ahead of its expiry."""
+        if not self.url or (self._refresher is not None and self._refresher.is_alive()):
+            return
+        self._stop.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop,
+                                           name='jwks-refresh', daemon=True)
+        self._refresher.start()
+
+    def stop_background_refresh(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            ttl = self.expires_at - self.fetched_at
+            wake_at = self.fetched_at + ttl * REFRESH_AHEAD
+            delay = max(wake_at - time.monotonic(), MIN_TTL * REFRESH_AHEAD)
+            if self._stop.wait(delay):
+                return
+            try:
+                self.refresh(force=True)
+            except Exception:
+                pass  # no keys yet and the IdP is down - try again next round
@@ -1,14 +1,13 @@
 from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+from flask_migrate import MigrateCommand
 
-from app import app
-from models import db
+from app import create_app, init_cli
 
-migrate = Migrate(app, db)
+app = init_cli(create_app())
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
 
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
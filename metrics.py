@@ -0,0 +1,147 @@
+import threading, time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, has_request_context, json, request
+from sqlalchemy import event
+
+
+# Latency buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+## Histograms
+class Histogram:
+    """A Prometheus-style histogram, one series per combination of label values."""
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}    # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = sorted(self.series.items())
+        for label_values, values in series:
+            labels = ','.join('%s="%s"' % (label, escape(value)) for label, value in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%g"} %d' % (self.name, labels, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, labels, values[-1]))
+            lines.append('%s_sum{%s} %.6f' % (self.name, labels, values[-2]))
+            lines.append('%s_count{%s} %d' % (self.name, labels, values[-1]))
+        return lines
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def gauges(name, help, samples, kind='gauge'):
+    """Exposition lines for a family of plain values: {((label, value), ...): sample}."""
+    lines = ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind)]
+    for labels, value in samples.items():
+        if labels:
+            lines.append('%s{%s} %s' % (name, ','.join('%s="%s"' % (k, escape(v)) for k, v in labels), value))
+        else:
+            lines.append('%s %s' % (name, value))
+    return lines
+
+
+request_latency = Histogram('http_request_duration_seconds',
+                            'Time spent handling each request, by endpoint.',
+                            ('endpoint', 'method', 'status'))
+phase_latency = Histogram('http_request_phase_seconds',
+                          'Time spent in each phase of a request (auth, db, serialise), by endpoint.',
+                          ('endpoint', 'phase'))
+query_latency = Histogram('db_query_duration_seconds',
+                          'Time spent executing each SQL statement, by engine (primary or replica).',
+                          ('engine',))
+
+# Extra metric families, e.g. cache and pool stats: name -> function returning exposition lines
+collectors = {}
+
+
+## Per-request phase timing
+@contextmanager
+def phase(name):
+    """Time a block and add it to the named phase of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(name, time.perf_counter() - started)
+
+
+def add_phase_time(name, seconds):
+    if has_request_context():
+        phases = g.setdefault('phases', {})
+        phases[name] = phases.get(name, 0.0) + seconds
+
+
+class TimedJSONEncoder(json.JSONEncoder):
+    """The app's JSON encoder, counting encoding time towards the 'serialise' phase."""
+
+    def encode(self, o):
+        with phase('serialise'):
+            return super().encode(o)
+
+
+def init_app(app):
+    """Record the latency of every request, and of each phase within it."""
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_latency(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            request_latency.observe(time.perf_counter() - started, endpoint, request.method,
+                                    str(response.status_code))
+            for name, seconds in g.pop('phases', {}).items():
+                phase_latency.observe(seconds, endpoint, name)
+        return response
+
+
+def track_queries(engine, name='primary'):
+    """Count time spent executing SQL towards the 'db' phase of the current request, and `name`'s latency."""
+    if getattr(engine, 'query_timing', False):
+        return
+    engine.query_timing = True
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context._query_started
+        add_phase_time('db', seconds)
+        query_latency.observe(seconds, name)
+
+
+def exposition():
+    """Every metric, in the Prometheus text format."""
+    lines = request_latency.exposition() + phase_latency.exposition() + query_latency.exposition()
+    for collect in collectors.values():
+        lines.extend(collect())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,77 @@
+"""Model: search indexes on actor and film, real release date column on film.
+
+Revision ID: 0f26eac75fba
+Revises: 87f71143578e
+Create Date: 2026-10-18 10:12:40.318201
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0f26eac75fba'
+down_revision = '87f71143578e'
+branch_labels = None
+depends_on = None
+
+# Same formats as models.RELEASE_DATE_FORMATS, copied so the migration stays fixed
+RELEASE_DATE_FORMATS = ('%d-%b-%Y', '%Y-%m-%d', '%d/%m/%Y', '%d %B %Y', '%d %b %Y', '%B %d, %Y', '%Y')
+BATCH_SIZE = 1000
+
+
+def parse_release_date(text):
+    for date_format in RELEASE_DATE_FORMATS:
+        try:
+            return datetime.strptime(text.strip(), date_format).date()
+        except (AttributeError, ValueError):
+            continue
+    return None
+
+
+def upgrade():
+    bind = op.get_bind()
+    postgres = bind.dialect.name == 'postgresql'
+
+    op.add_column('film', sa.Column('released_on', sa.Date(), nullable=True))
+
+    # Backfill released_on from the free-form date_of_release text
+    film = sa.table('film',
+        sa.column('id', sa.Integer),
+        sa.column('date_of_release', sa.String),
+        sa.column('released_on', sa.Date))
+    last_id = 0
+    while True:
+        rows = bind.execute(sa.select(film.c.id, film.c.date_of_release)
+                            .where(film.c.id > last_id).order_by(film.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        updates = [{'film_id': id, 'released_on': parse_release_date(text)} for id, text in rows]
+        updates = [update for update in updates if update['released_on'] is not None]
+        if updates:
+            bind.execute(film.update().where(film.c.id == sa.bindparam('film_id'))
+                         .values(released_on=sa.bindparam('released_on')), updates)
+        last_id = rows[-1][0]
+
+    op.create_index('ix_film_released_on', 'film', ['released_on'])
+    op.create_index('ix_actor_age', 'actor', ['age'])
+    op.create_index('ix_actor_gender', 'actor', ['gender'])
+
+    # Trigram indexes make name ILIKE '%term%' searches index backed on Postgres
+    if postgres:
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_actor_name_trgm', 'actor', ['name'],
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_film_name_trgm', 'film', ['name'],
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_film_name_trgm', table_name='film')
+    op.drop_index('ix_actor_name_trgm', table_name='actor')
+    op.drop_index('ix_actor_gender', table_name='actor')
+    op.drop_index('ix_actor_age', table_name='actor')
+    op.drop_index('ix_film_released_on', table_name='film')
+    op.drop_column('film', 'released_on')
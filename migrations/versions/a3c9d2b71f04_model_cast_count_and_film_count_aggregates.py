@@ -0,0 +1,82 @@
+"""Model: materialised cast_count on film and film_count on actor, kept by triggers.
+
+Revision ID: a3c9d2b71f04
+Revises: 0f26eac75fba
+Create Date: 2026-10-18 14:02:11.507318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c9d2b71f04'
+down_revision = '0f26eac75fba'
+branch_labels = None
+depends_on = None
+
+# Same statements as models.CAST_COUNT_TRIGGERS, copied so the migration stays fixed
+TRIGGERS = {
+    'postgresql': [
+        """CREATE OR REPLACE FUNCTION film_actors_inserted() RETURNS trigger AS $$
+        BEGIN
+          UPDATE film SET cast_count = cast_count + added.n
+            FROM (SELECT film_id, count(*) AS n FROM new_links GROUP BY film_id) AS added WHERE film.id = added.film_id;
+          UPDATE actor SET film_count = film_count + added.n
+            FROM (SELECT actor_id, count(*) AS n FROM new_links GROUP BY actor_id) AS added WHERE actor.id = added.actor_id;
+          RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        """CREATE OR REPLACE FUNCTION film_actors_deleted() RETURNS trigger AS $$
+        BEGIN
+          UPDATE film SET cast_count = cast_count - removed.n
+            FROM (SELECT film_id, count(*) AS n FROM old_links GROUP BY film_id) AS removed WHERE film.id = removed.film_id;
+          UPDATE actor SET film_count = film_count - removed.n
+            FROM (SELECT actor_id, count(*) AS n FROM old_links GROUP BY actor_id) AS removed WHERE actor.id = removed.actor_id;
+          RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        """CREATE TRIGGER film_actors_inserted AFTER INSERT ON film_actors REFERENCING NEW TABLE AS new_links
+        FOR EACH STATEMENT EXECUTE PROCEDURE film_actors_inserted()""",
+        """CREATE TRIGGER film_actors_deleted AFTER DELETE ON film_actors REFERENCING OLD TABLE AS old_links
+        FOR EACH STATEMENT EXECUTE PROCEDURE film_actors_deleted()""",
+    ],
+    'sqlite': [
+        """CREATE TRIGGER film_actors_inserted AFTER INSERT ON film_actors BEGIN
+          UPDATE film SET cast_count = cast_count + 1 WHERE id = NEW.film_id;
+          UPDATE actor SET film_count = film_count + 1 WHERE id = NEW.actor_id;
+        END""",
+        """CREATE TRIGGER film_actors_deleted AFTER DELETE ON film_actors BEGIN
+          UPDATE film SET cast_count = cast_count - 1 WHERE id = OLD.film_id;
+          UPDATE actor SET film_count = film_count - 1 WHERE id = OLD.actor_id;
+        END""",
+    ],
+}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    op.add_column('film', sa.Column('cast_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('actor', sa.Column('film_count', sa.Integer(), nullable=False, server_default='0'))
+
+    # Backfill from the existing links, then let the triggers keep the counts
+    op.execute('UPDATE film SET cast_count = (SELECT count(*) FROM film_actors WHERE film_actors.film_id = film.id)')
+    op.execute('UPDATE actor SET film_count = (SELECT count(*) FROM film_actors WHERE film_actors.actor_id = actor.id)')
+    for statement in TRIGGERS.get(dialect, []):
+        op.execute(statement)
+
+    op.create_index('ix_film_cast_count', 'film', ['cast_count', 'id'])
+    op.create_index('ix_actor_film_count', 'actor', ['film_count', 'id'])
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    op.drop_index('ix_actor_film_count', table_name='actor')
+    op.drop_index('ix_film_cast_count', table_name='film')
+    op.execute('DROP TRIGGER IF EXISTS film_actors_deleted' + (' ON film_actors' if dialect == 'postgresql' else ''))
+    op.execute('DROP TRIGGER IF EXISTS film_actors_inserted' + (' ON film_actors' if dialect == 'postgresql' else ''))
+    if dialect == 'postgresql':
+        op.execute('DROP FUNCTION IF EXISTS film_actors_deleted()')
+        op.execute('DROP FUNCTION IF EXISTS film_actors_inserted()')
+    op.drop_column('actor', 'film_count')
+    op.drop_column('film', 'cast_count')
@@ -0,0 +1,26 @@
+"""Model: attempts and retry_at on import_jobs, for retrying failed imports with a back-off.
+
+Revision ID: a9c3e5f17d42
+Revises: f2a7c4d85b19
+Create Date: 2026-10-18 21:12:05.318447
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9c3e5f17d42'
+down_revision = 'f2a7c4d85b19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('import_jobs', sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('import_jobs', sa.Column('retry_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('import_jobs', 'retry_at')
+    op.drop_column('import_jobs', 'attempts')
@@ -0,0 +1,39 @@
+"""Model: film_actors links deleted with their film or actor, and indexed by film_id.
+
+Revision ID: b6d1f0c9e872
+Revises: e4b8f3a2c610
+Create Date: 2026-10-18 19:12:40.218364
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d1f0c9e872'
+down_revision = 'e4b8f3a2c610'
+branch_labels = None
+depends_on = None
+
+# Postgres' default names for the constraints created in 87f71143578e
+FOREIGN_KEYS = {'film_actors_actor_id_fkey': ('actor_id', 'actor'), 'film_actors_film_id_fkey': ('film_id', 'film')}
+
+
+def replace_foreign_keys(ondelete):
+    for name, (column, table) in FOREIGN_KEYS.items():
+        op.drop_constraint(name, 'film_actors', type_='foreignkey')
+        op.create_foreign_key(name, 'film_actors', table, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    op.create_index('ix_film_actors_film_id', 'film_actors', ['film_id'])
+    # SQLite can't alter a constraint in place (and rebuilding the table would drop its triggers);
+    # there the cascade applies to databases created from the models
+    if op.get_bind().dialect.name == 'postgresql':
+        replace_foreign_keys('CASCADE')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        replace_foreign_keys(None)
+    op.drop_index('ix_film_actors_film_id', table_name='film_actors')
@@ -0,0 +1,55 @@
+"""Model: updated_at and version on film and actor, and the change_log table.
+
+Revision ID: c71e5a0d9b23
+Revises: a3c9d2b71f04
+Create Date: 2026-10-18 15:26:47.120954
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c71e5a0d9b23'
+down_revision = 'a3c9d2b71f04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    now = datetime.utcnow()
+
+    change_log = op.create_table('change_log',
+        sa.Column('seq', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('row_id', sa.Integer(), nullable=False),
+        sa.Column('deleted', sa.Boolean(), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('seq'))
+    op.create_index('ix_change_log_kind_changed_at', 'change_log', ['kind', 'changed_at'])
+
+    for table in ('film', 'actor'):
+        op.add_column(table, sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+        # Existing rows count as written now; the column is made NOT NULL once filled in
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+        rows = sa.table(table, sa.column('id', sa.Integer), sa.column('updated_at', sa.DateTime))
+        op.execute(rows.update().values(updated_at=now))
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('updated_at', existing_type=sa.DateTime(), nullable=False)
+        op.create_index('ix_%s_updated_at' % table, table, ['updated_at'])
+
+        # One change per existing row, so /changes?since=0 starts with the whole catalogue
+        op.execute(change_log.insert().from_select(
+            ['kind', 'row_id', 'deleted', 'changed_at'],
+            sa.select(sa.literal(table), rows.c.id, sa.false(), sa.literal(now, sa.DateTime)).order_by(rows.c.id)))
+
+
+def downgrade():
+    for table in ('actor', 'film'):
+        op.drop_index('ix_%s_updated_at' % table, table_name=table)
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'version')
+    op.drop_index('ix_change_log_kind_changed_at', table_name='change_log')
+    op.drop_table('change_log')
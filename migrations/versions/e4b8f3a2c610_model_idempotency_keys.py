@@ -0,0 +1,32 @@
+"""Model: idempotency_keys, for retry-safe POST /film and /actor.
+
+Revision ID: e4b8f3a2c610
+Revises: c71e5a0d9b23
+Create Date: 2026-10-18 17:41:05.331872
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b8f3a2c610'
+down_revision = 'c71e5a0d9b23'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('idempotency_keys',
+        sa.Column('key', sa.String(length=32), nullable=False),
+        sa.Column('fingerprint', sa.String(length=16), nullable=False),
+        sa.Column('status', sa.Integer(), nullable=True),
+        sa.Column('body', sa.LargeBinary(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('key'))
+    op.create_index('ix_idempotency_keys_created_at', 'idempotency_keys', ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_keys_created_at', table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
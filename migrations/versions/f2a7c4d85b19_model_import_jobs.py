@@ -0,0 +1,42 @@
+"""Model: import_jobs, the background catalogue imports and their checkpoints.
+
+Revision ID: f2a7c4d85b19
+Revises: b6d1f0c9e872
+Create Date: 2026-10-18 20:03:27.640915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a7c4d85b19'
+down_revision = 'b6d1f0c9e872'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('import_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('format', sa.String(), nullable=False),
+        sa.Column('owner', sa.String(), nullable=True),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('payload', sa.LargeBinary(), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('processed', sa.Integer(), nullable=False),
+        sa.Column('created', sa.Integer(), nullable=False),
+        sa.Column('rejected', sa.Integer(), nullable=False),
+        sa.Column('errors', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_import_jobs_status_id', 'import_jobs', ['status', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_import_jobs_status_id', table_name='import_jobs')
+    op.drop_table('import_jobs')
@@ -1,42 +1,359 @@
 import json, os
+from datetime import datetime, timedelta
 # from dataclasses import dataclass
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey, Column, String, create_engine
-from common_handles import db, migrate
+from sqlalchemy import ForeignKey, Column, String, DDL, create_engine, delete, event, func, insert, inspect, select, tuple_, \
+  update
+from sqlalchemy.orm import validates
+from common_handles import db
+from db_pool import engine_options, guard_fork, instrument
+from metrics import track_queries
 
-database_path = os.environ['DATABASE_URL']
-if database_path.startswith("postgres://"):
-  database_path = database_path.replace("postgres://", "postgresql://", 1)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+BULK_CHUNK_SIZE = 1000
+# The longest a write transaction is expected to stay open after logging a change (see committed_changes)
+CHANGES_COMMIT_LAG = float(os.environ.get('CHANGES_COMMIT_LAG', 60))
+
+# Formats date_of_release has been entered in, e.g. "26-Nov-1942"
+RELEASE_DATE_FORMATS = ('%d-%b-%Y', '%Y-%m-%d', '%d/%m/%Y', '%d %B %Y', '%d %b %Y', '%B %d, %Y', '%Y')
+
+'''
+on_write(listener)
+    registers a callback that is passed the cache tags touched by each committed write
+'''
+write_listeners = []
+
+def on_write(listener):
+  write_listeners.append(listener)
+  return listener
+
+def notify_write(*tags):
+  """Tell listeners (e.g. the response cache) which records a write changed."""
+  for listener in write_listeners:
+    listener(tags)
+
+
+def sqlalchemy_url(url):
+  """Heroku's postgres:// URLs, renamed to the postgresql:// SQLAlchemy expects."""
+  if url.startswith("postgres://"):
+    url = url.replace("postgres://", "postgresql://", 1)
+  return url
+
+
+def database_url():
+  """DATABASE_URL, read when an app or engine is created rather than at import."""
+  return sqlalchemy_url(os.environ['DATABASE_URL'])
+
+
+def replica_urls():
+  """DATABASE_REPLICA_URLS (comma separated) by bind key, for the read replicas (see replicas.py)."""
+  urls = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+  return {'replica_%d' % number: sqlalchemy_url(url) for number, url in enumerate(urls)}
 
-db = SQLAlchemy()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, to DATABASE_URL unless given a database_path
+    and to the read replicas in DATABASE_REPLICA_URLS unless given replica_paths
+    pool settings come from DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE and DB_POOL_PRE_PING, or keyword overrides (e.g. pool_size=10)
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None, replica_paths=None, **pool_options):
+    database_path = database_path or database_url()
+    if replica_paths is None:
+        replicas = replica_urls()
+    else:
+        replicas = {'replica_%d' % number: path for number, path in enumerate(replica_paths)}
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_BINDS"] = replicas
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path, **pool_options)
+    app.extensions['replicas'] = sorted(replicas)
     db.app = app
     db.init_app(app)
-    migrate.init_app(app,db)
+    with app.app_context():
+        for name, engine in engines().items():
+            instrument(engine)
+            guard_fork(engine)
+            track_queries(engine, name)
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', enforce_foreign_keys)
+
+
+def enforce_foreign_keys(dbapi_connection, connection_record):
+  """SQLite checks foreign keys, and cascades deletes to film_actors, only when asked on each connection."""
+  dbapi_connection.execute('PRAGMA foreign_keys = ON')
+
+
+def engines():
+  """The primary engine and each replica's, by name ('primary', 'replica_0', ...)."""
+  app = db.get_app()
+  named = {'primary': db.get_engine(app)}
+  for bind in app.extensions.get('replicas', ()):
+    named[bind] = db.get_engine(app, bind=bind)
+  return named
+
+
+def pool_status(name='primary'):
+  """Connection pool occupancy, checkout wait time and connection errors, of the primary or a replica."""
+  engine = engines()[name]
+  return instrument(engine).snapshot(engine.pool)
+
+
+def parse_release_date(text):
+  """Turn a free-form date_of_release into a date, or None if it can't be read."""
+  for date_format in RELEASE_DATE_FORMATS:
+    try:
+      return datetime.strptime(text.strip(), date_format).date()
+    except (AttributeError, ValueError):
+      continue
+  return None
+
+
+def like_pattern(term):
+  """A case-insensitive substring pattern, with LIKE wildcards in `term` escaped."""
+  term = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+  return '%' + term + '%'
+
+
+def filter_clauses(model, criteria):
+  """SQL conditions for the search criteria of a list endpoint (all index backed)."""
+  clauses = []
+  if 'name' in criteria:
+    clauses.append(model.name.ilike(like_pattern(criteria['name']), escape='\\'))
+  if 'gender' in criteria:
+    clauses.append(model.gender == criteria['gender'])
+  if 'min_age' in criteria:
+    clauses.append(model.age >= criteria['min_age'])
+  if 'max_age' in criteria:
+    clauses.append(model.age <= criteria['max_age'])
+  if 'released_after' in criteria:
+    clauses.append(model.released_on >= criteria['released_after'])
+  if 'released_before' in criteria:
+    clauses.append(model.released_on <= criteria['released_before'])
+  return clauses
+
+
+def projection(model, fields=None, after=None, criteria=None, order=None):
+  """Build a column-only SELECT for `model`, ordered by id and starting after `after`.
+
+    With `order` = (field, descending) rows are ordered by that field, then id,
+    and `after` is the (value, id) of the last row of the previous page. A sort
+    field not among `fields` is selected after them, for the next cursor, and
+    is not in the returned fields, so the row encoders leave it out.
+    A plain Core statement, so the async app can run it on its own engine too.
+  """
+  fields = list(fields or model.default_fields)
+  if 'id' not in fields:
+    fields.insert(0, 'id')
+  if order is None:
+    query = select(*[getattr(model, field) for field in fields]).order_by(model.id)
+    if after is not None:
+      query = query.where(model.id > after)
+  else:
+    field, descending = order
+    key = tuple_(getattr(model, field), model.id)
+    selected = fields if field in fields else fields + [field]
+    query = select(*[getattr(model, name) for name in selected])
+    if descending:
+      query = query.order_by(getattr(model, field).desc(), model.id.desc())
+      if after is not None:
+        query = query.where(key < tuple_(*after))
+    else:
+      query = query.order_by(getattr(model, field), model.id)
+      if after is not None:
+        query = query.where(key > tuple_(*after))
+  if criteria:
+    query = query.where(*filter_clauses(model, criteria))
+  return fields, query
+
+
+def page_result(rows, limit, order=None):
+  """Trim the limit + 1 rows fetched for a page to (rows, next_cursor).
+
+    The cursor is the last id, or "value.id" for a page sorted by another field.
+  """
+  next_cursor = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    if order is None:
+      next_cursor = rows[-1].id
+    else:
+      next_cursor = '%d.%d' % (getattr(rows[-1], order[0]), rows[-1].id)
+  return rows, next_cursor
+
+
+'''
+keyset_page(model, fields, after, limit)
+    fetches one page of rows ordered by id, selecting only the given columns
+'''
+def keyset_page(model, fields=None, after=None, limit=DEFAULT_PAGE_SIZE, criteria=None, order=None):
+  """Fetch the rows of `model` with id > after, as plain dicts.
+
+    Only the requested columns are selected, so no ORM objects are built.
+    Returns (rows, next_cursor), where next_cursor is None on the last page.
+  """
+  fields, rows, next_cursor = keyset_rows(model, fields, after, limit, criteria, order)
+  return [dict(zip(fields, row)) for row in rows], next_cursor
+
+
+def keyset_rows(model, fields=None, after=None, limit=DEFAULT_PAGE_SIZE, criteria=None, order=None):
+  """keyset_page without the dicts: (fields, Rows, next_cursor), for the row encoders."""
+  fields, query = projection(model, fields, after, criteria, order)
+  rows, next_cursor = page_result(db.session.execute(query.limit(limit + 1)).all(), limit, order)
+  return fields, rows, next_cursor
+
+
+def stream_rows(model, fields=None, after=None, criteria=None, batch_size=STREAM_BATCH_SIZE, order=None):
+  """Yield every row of `model` as a dict, from a server-side cursor.
+
+    Rows are fetched `batch_size` at a time from the connection's cursor, so the
+    first batch arrives without the whole result having been read.
+  """
+  fields, batches = stream_batches(model, fields, after, criteria, batch_size, order)
+  for rows in batches:
+    for row in rows:
+      yield dict(zip(fields, row))
+
+
+def stream_batches(model, fields=None, after=None, criteria=None, batch_size=STREAM_BATCH_SIZE, order=None):
+  """(fields, iterator of lists of Rows) from a server-side cursor, for the row encoders.
+
+    The query runs on the session's Core connection: Session.execute() buffers
+    every row of an ORM select before returning its first one.
+  """
+  fields, query = projection(model, fields, after, criteria, order)
+  result = db.session.connection().execute(query.execution_options(stream_results=True))
+  return fields, result.partitions(batch_size)
 
 
 """Table that defines which actors are cast in a film"""
 film_actors = db.Table( "film_actors",
 #    db.Model.metadata,
-    Column("actor_id", db.Integer, ForeignKey("actor.id"), primary_key=True),
-    Column("film_id", db.Integer, ForeignKey("film.id"), primary_key=True),
+    # Deleting a film or actor deletes its links in the same statement
+    Column("actor_id", db.Integer, ForeignKey("actor.id", ondelete="CASCADE"), primary_key=True),
+    Column("film_id", db.Integer, ForeignKey("film.id", ondelete="CASCADE"), primary_key=True),
+    # The primary key leads with actor_id; this serves lookups (and cascaded deletes) by film
+    db.Index("ix_film_actors_film_id", "film_id"),
 )
 
+"""Log of every write to the film and actor tables, read by /changes.
+
+   One entry per row written, numbered by `seq`; entries with deleted=True are
+   the tombstones of deleted rows."""
+change_log = db.Table("change_log",
+    Column("seq", db.Integer, primary_key=True),
+    Column("kind", db.String, nullable=False),
+    Column("row_id", db.Integer, nullable=False),
+    Column("deleted", db.Boolean, nullable=False, default=False),
+    Column("changed_at", db.DateTime, nullable=False, default=datetime.utcnow),
+    db.Index("ix_change_log_kind_changed_at", "kind", "changed_at"),
+)
+
+
+'''
+idempotency_keys
+    one row per Idempotency-Key used on a write, reserved in the write's own
+    transaction; the primary key stops two workers both acting on a key (see idempotency.py)
+'''
+idempotency_keys = db.Table("idempotency_keys",
+    Column("key", db.String(32), primary_key=True),   # digest of the caller, method, path and key
+    Column("fingerprint", db.String(16), nullable=False),   # digest of the request body
+    Column("status", db.Integer),   # NULL until the response is stored
+    Column("body", db.LargeBinary),
+    Column("created_at", db.DateTime, nullable=False, default=datetime.utcnow),
+    db.Index("ix_idempotency_keys_created_at", "created_at"),
+)
+
+'''
+import_jobs
+    one row per uploaded catalogue file, processed in the background (see import_jobs.py);
+    position and the counts are the checkpoint, committed with each chunk of rows written;
+    a run that fails is retried from there, after a back-off, up to IMPORT_MAX_ATTEMPTS times
+'''
+import_jobs = db.Table("import_jobs",
+    Column("id", db.Integer, primary_key=True),
+    Column("kind", db.String, nullable=False),   # films, actors or casting
+    Column("format", db.String, nullable=False),   # csv or ndjson
+    Column("owner", db.String),   # the uploader's token sub
+    Column("status", db.String, nullable=False, default='queued'),   # queued, running, done or failed
+    Column("payload", db.LargeBinary, nullable=False),
+    Column("size", db.Integer, nullable=False),
+    Column("position", db.Integer, nullable=False, default=0),   # bytes of the payload processed
+    Column("processed", db.Integer, nullable=False, default=0),   # rows read
+    Column("created", db.Integer, nullable=False, default=0),   # rows written
+    Column("rejected", db.Integer, nullable=False, default=0),   # rows that failed validation
+    Column("errors", db.Text),   # JSON list of the first rejections
+    Column("attempts", db.Integer, nullable=False, default=0),   # runs that failed with a retryable error
+    Column("retry_at", db.DateTime),   # a queued job that failed isn't claimed again before this
+    Column("created_at", db.DateTime, nullable=False, default=datetime.utcnow),
+    Column("updated_at", db.DateTime, nullable=False, default=datetime.utcnow),   # also the worker's heartbeat
+    Column("finished_at", db.DateTime),
+    db.Index("ix_import_jobs_status_id", "status", "id"),
+)
+
+
+def change_rows(kind, ids, deleted=False):
+  """change_log entries for rows of `kind` ('film' or 'actor'), for inserting with the write itself."""
+  now = datetime.utcnow()
+  return [{'kind': kind, 'row_id': id, 'deleted': deleted, 'changed_at': now} for id in ids]
+
+
+def record_changes(kind, ids, deleted=False):
+  """Log a write to rows of `kind`, in the current transaction."""
+  rows = change_rows(kind, ids, deleted)
+  if rows:
+    db.session.execute(change_log.insert(), rows)
+
+
+def bump(model):
+  """An UPDATE of `model` setting a new version and updated_at, to add a WHERE (and any other values) to."""
+  return update(model.__table__).values(updated_at=datetime.utcnow(), version=model.version + 1)
+
+
+def touch(model, ids):
+  """Bump updated_at and version of rows changed without going through the ORM, and log them."""
+  ids = list(ids)
+  if ids:
+    db.session.execute(bump(model).where(model.id.in_(ids)))
+    record_changes(model.__tablename__, ids)
+
+
+def linked_changes(instance, relationship):
+  """The rows linked to or unlinked from `instance` through a relationship since it was loaded (read before flushing)."""
+  history = inspect(instance).attrs[relationship].history
+  return [*(history.added or ()), *(history.deleted or ())]
+
+
+def touch_linked(instance, other, changed):
+  """After a flush that linked or unlinked the `other` rows in `changed`: bump and log them, as
+  their counts moved, and return the cache tags of those links."""
+  ids = {row.id for row in changed}
+  touch(other, ids)
+  own_key, other_key = instance.__tablename__ + '_id', other.__tablename__ + '_id'
+  return cast_tags([{own_key: instance.id, other_key: id} for id in ids]) if ids else ()
+
+
 # @dataclass
 class Actor(db.Model):
   """Actor class for data in the "actor" table."""
   __tablename__ = 'actor'
+  # Columns a client may ask for with fields=; lists return default_fields, the same keys as format()
+  public_fields = ('id', 'name', 'gender', 'age', 'film_count', 'version', 'updated_at')
+  default_fields = ('id', 'name', 'gender', 'age')
+  __table_args__ = (
+    db.Index('ix_actor_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+    db.Index('ix_actor_film_count', 'film_count', 'id'),
+  )
   id = Column(db.Integer, primary_key=True)
   name = Column(db.String, nullable=False)
-  gender = Column(db.String, nullable=False)
-  age = Column(db.Integer, nullable=False)
+  gender = Column(db.String, nullable=False, index=True)
+  age = Column(db.Integer, nullable=False, index=True)
+  # Number of films the actor is cast in, maintained by triggers on film_actors
+  film_count = Column(db.Integer, nullable=False, default=0, server_default='0')
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+  version = Column(db.Integer, nullable=False, default=1, server_default='1')
   film = db.relationship("Film", secondary="film_actors",
 #   backref=db.backref('films', lazy=True),
          back_populates="actor")
@@ -72,24 +389,55 @@ class Actor(db.Model):
   
   def insert(self):
     """Insert this Actor into the database."""
+    changed = linked_changes(self, 'film')
     db.session.add(self)
+    db.session.flush()
+    record_changes('actor', [self.id])
+    tags = touch_linked(self, Film, changed)
     db.session.commit()
+    notify_write('actor', *tags)
 
   def delete(self):
     """Delete this Actor from the database."""
+    id = self.id
+    # Unlinking changes the cast counts of the other side
+    linked = [other.id for other in self.film]
+    touch(Film, linked)
     db.session.delete(self)
+    record_changes('actor', [id], deleted=True)
     db.session.commit()
+    notify_write('actor', 'actor:%d' % id, 'cast', *['film:%d' % other_id for other_id in linked])
 
   def update(self):
     """Update this Actor from the database."""
+    changed = linked_changes(self, 'film')
+    self.version += 1
+    self.updated_at = datetime.utcnow()
+    db.session.flush()
+    record_changes('actor', [self.id])
+    # Links added or removed through the relationship change the cast of both sides
+    tags = touch_linked(self, Film, changed)
     db.session.commit()
+    notify_write('actor', 'actor:%d' % self.id, *tags)
 
 class Film(db.Model):
   """Film class for data in the "film" table."""
   __tablename__ = 'film'
+  # Columns a client may ask for with fields=; lists return default_fields, the same keys as format()
+  public_fields = ('id', 'name', 'date_of_release', 'cast_count', 'version', 'updated_at')
+  default_fields = ('id', 'name', 'date_of_release')
+  __table_args__ = (
+    db.Index('ix_film_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+    db.Index('ix_film_cast_count', 'cast_count', 'id'),
+  )
   id = Column(db.Integer, primary_key=True)
   name = Column(db.String, nullable=False)
   date_of_release = Column(db.String, nullable=False)
+  released_on = Column(db.Date, nullable=True, index=True)
+  # Number of actors cast in the film, maintained by triggers on film_actors
+  cast_count = Column(db.Integer, nullable=False, default=0, server_default='0')
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+  version = Column(db.Integer, nullable=False, default=1, server_default='1')
   actor = db.relationship("Actor", secondary="film_actors",
 #   backref=db.backref('actors', lazy=True), 
    back_populates="film")
@@ -103,6 +451,19 @@ class Film(db.Model):
     """
     self.name = name
     self.date_of_release = date_of_release
+
+  @validates('date_of_release')
+  def validate_date_of_release(self, key, date_of_release):
+    """Keep the indexed released_on date in step with the free-form text."""
+    self.released_on = parse_release_date(date_of_release)
+    return date_of_release
+
+  @staticmethod
+  def prepare_row(row):
+    """Fill in released_on for a row inserted or updated in bulk (bypassing the ORM)."""
+    if 'date_of_release' not in row:
+      return dict(row)
+    return dict(row, released_on=parse_release_date(row['date_of_release']))
   
   def format(self):
     """Serialize this Film record."""
@@ -118,14 +479,371 @@ class Film(db.Model):
   
   def insert(self):
     """Insert this Film record into the database."""
+    changed = linked_changes(self, 'actor')
     db.session.add(self)
+    db.session.flush()
+    record_changes('film', [self.id])
+    tags = touch_linked(self, Actor, changed)
     db.session.commit()
+    notify_write('film', *tags)
 
   def delete(self):
     """Remove this Film record."""
+    id = self.id
+    # Unlinking changes the cast counts of the other side
+    linked = [other.id for other in self.actor]
+    touch(Actor, linked)
     db.session.delete(self)
+    record_changes('film', [id], deleted=True)
     db.session.commit()
+    notify_write('film', 'film:%d' % id, 'cast', *['actor:%d' % other_id for other_id in linked])
 
   def update(self):
     """Update this Film record."""
+    changed = linked_changes(self, 'actor')
+    self.version += 1
+    self.updated_at = datetime.utcnow()
+    db.session.flush()
+    record_changes('film', [self.id])
+    # Links added or removed through the relationship change the cast of both sides
+    tags = touch_linked(self, Actor, changed)
     db.session.commit()
+    notify_write('film', 'film:%d' % self.id, *tags)
+
+
+# Name search uses trigram indexes on Postgres, which need the pg_trgm extension
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+# Film.cast_count and Actor.film_count follow every insert into and delete from
+# film_actors, whichever code path made it (bulk_link, the ORM relationships, a
+# cascade from deleting a film or actor). The migration creates the same triggers.
+CAST_COUNT_TRIGGERS = {
+  'postgresql': [
+    """CREATE OR REPLACE FUNCTION film_actors_inserted() RETURNS trigger AS $$
+    BEGIN
+      UPDATE film SET cast_count = cast_count + added.n
+        FROM (SELECT film_id, count(*) AS n FROM new_links GROUP BY film_id) AS added WHERE film.id = added.film_id;
+      UPDATE actor SET film_count = film_count + added.n
+        FROM (SELECT actor_id, count(*) AS n FROM new_links GROUP BY actor_id) AS added WHERE actor.id = added.actor_id;
+      RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION film_actors_deleted() RETURNS trigger AS $$
+    BEGIN
+      UPDATE film SET cast_count = cast_count - removed.n
+        FROM (SELECT film_id, count(*) AS n FROM old_links GROUP BY film_id) AS removed WHERE film.id = removed.film_id;
+      UPDATE actor SET film_count = film_count - removed.n
+        FROM (SELECT actor_id, count(*) AS n FROM old_links GROUP BY actor_id) AS removed WHERE actor.id = removed.actor_id;
+      RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER film_actors_inserted AFTER INSERT ON film_actors REFERENCING NEW TABLE AS new_links
+    FOR EACH STATEMENT EXECUTE PROCEDURE film_actors_inserted()""",
+    """CREATE TRIGGER film_actors_deleted AFTER DELETE ON film_actors REFERENCING OLD TABLE AS old_links
+    FOR EACH STATEMENT EXECUTE PROCEDURE film_actors_deleted()""",
+  ],
+  'sqlite': [
+    """CREATE TRIGGER film_actors_inserted AFTER INSERT ON film_actors BEGIN
+      UPDATE film SET cast_count = cast_count + 1 WHERE id = NEW.film_id;
+      UPDATE actor SET film_count = film_count + 1 WHERE id = NEW.actor_id;
+    END""",
+    """CREATE TRIGGER film_actors_deleted AFTER DELETE ON film_actors BEGIN
+      UPDATE film SET cast_count = cast_count - 1 WHERE id = OLD.film_id;
+      UPDATE actor SET film_count = film_count - 1 WHERE id = OLD.actor_id;
+    END""",
+  ],
+}
+for dialect, statements in CAST_COUNT_TRIGGERS.items():
+  for statement in statements:
+    event.listen(film_actors, 'after_create', DDL(statement).execute_if(dialect=dialect))
+
+
+'''
+cast_of(model, ids)
+    loads the other side of film_actors for a set of films or actors, in one query
+'''
+def cast_of(model, ids, fields=None):
+  """Map each id of `model` (Film or Actor) to the linked Actors (or Films), as dicts.
+
+    A single join through film_actors, selecting only the needed columns, so
+    the number of queries doesn't grow with the number of ids.
+  """
+  related = {id: [] for id in ids}
+  if not related:
+    return related
+  fields, query = cast_select(model, related, fields)
+  return group_cast(related, fields, db.session.execute(query))
+
+
+def cast_select(model, ids, fields=None):
+  """The SELECT behind cast_of: (owner id, linked columns...) for every link of `ids`."""
+  if model is Film:
+    own_key, other, other_key = film_actors.c.film_id, Actor, film_actors.c.actor_id
+  else:
+    own_key, other, other_key = film_actors.c.actor_id, Film, film_actors.c.film_id
+  fields = list(fields or other.default_fields)
+  query = select(own_key, *[getattr(other, field) for field in fields]) \
+    .join(other, other.id == other_key) \
+    .where(own_key.in_(list(ids))) \
+    .order_by(own_key, other.id)
+  return fields, query
+
+
+def group_cast(related, fields, rows):
+  for owner_id, *row in rows:
+    related[owner_id].append(dict(zip(fields, row)))
+  return related
+
+
+'''
+bulk_insert(model, rows) / bulk_link(pairs)
+    insert many rows, one transaction (and one statement) per chunk
+'''
+def bulk_insert(model, rows, chunk_size=BULK_CHUNK_SIZE):
+  """Insert already-validated row dicts for `model`, returning the new ids in order.
+
+    Each chunk is a single multi-row INSERT ... RETURNING id, committed on its
+    own. Databases without RETURNING (SQLite) fall back to bulk_insert_mappings.
+  """
+  ids = []
+  for start in range(0, len(rows), chunk_size):
+    try:
+      new_ids = insert_chunk(model, rows[start:start + chunk_size])
+      db.session.commit()
+    except Exception:
+      db.session.rollback()
+      raise
+    ids.extend(new_ids)
+    notify_write(model.__tablename__)
+  return ids
+
+
+def insert_chunk(model, rows):
+  """Insert validated row dicts in the current transaction and log them; returns the new ids in order."""
+  prepare = getattr(model, 'prepare_row', None)
+  if prepare is not None:
+    rows = [prepare(row) for row in rows]
+  if db.engine.dialect.full_returning:
+    result = db.session.execute(insert(model.__table__).values(rows).returning(model.id))
+    new_ids = [row[0] for row in result]
+  else:
+    rows = [dict(row) for row in rows]
+    db.session.bulk_insert_mappings(model, rows, return_defaults=True)
+    new_ids = [row['id'] for row in rows]
+  record_changes(model.__tablename__, new_ids)
+  return new_ids
+
+
+def bulk_link(pairs, chunk_size=BULK_CHUNK_SIZE):
+  """Cast actors in films from (film_id, actor_id) pairs, skipping links that already exist.
+
+    Returns the number of links created.
+  """
+  created = 0
+  pairs = list(dict.fromkeys(pairs))
+  for start in range(0, len(pairs), chunk_size):
+    try:
+      new = link_chunk(pairs[start:start + chunk_size])
+      db.session.commit()
+    except Exception:
+      db.session.rollback()
+      raise
+    created += len(new)
+    if new:
+      notify_write(*cast_tags(new))
+  return created
+
+
+def link_chunk(pairs):
+  """Insert the (film_id, actor_id) links that don't exist yet, in the current transaction; returns them."""
+  existing = set(db.session.query(film_actors.c.film_id, film_actors.c.actor_id)
+    .filter(film_actors.c.film_id.in_({film_id for film_id, _ in pairs}))
+    .filter(film_actors.c.actor_id.in_({actor_id for _, actor_id in pairs})))
+  new = [{'film_id': film_id, 'actor_id': actor_id}
+         for film_id, actor_id in dict.fromkeys(pairs) if (film_id, actor_id) not in existing]
+  if new:
+    db.session.execute(film_actors.insert(), new)
+    # The triggers changed the cast counts; mark those films and actors as updated
+    touch(Film, {link['film_id'] for link in new})
+    touch(Actor, {link['actor_id'] for link in new})
+  return new
+
+
+def cast_tags(links):
+  """The cache tags a write of these film_actors links invalidates."""
+  films, actors = {link['film_id'] for link in links}, {link['actor_id'] for link in links}
+  return ('cast', *['cast:film:%d' % id for id in films], *['cast:actor:%d' % id for id in actors],
+          *['film:%d' % id for id in films], *['actor:%d' % id for id in actors])
+
+
+'''
+update_rows(model, changes, ids or criteria) / delete_rows(model, ids or criteria)
+    set-based writes: one UPDATE or DELETE ... RETURNING per chunk of ids, without loading a row
+'''
+def id_chunks(model, ids=None, criteria=None, chunk_size=BULK_CHUNK_SIZE):
+  """Yield lists of ids to write: `ids` in order, or those of the rows matching `criteria`, read a chunk at a time."""
+  if ids is not None:
+    ids = sorted(set(ids))
+    for start in range(0, len(ids), chunk_size):
+      yield ids[start:start + chunk_size]
+    return
+  after = None
+  while True:
+    _, query = projection(model, ['id'], after, criteria)
+    chunk = [id for id, in db.session.execute(query.limit(chunk_size))]
+    if chunk:
+      yield chunk
+    if len(chunk) < chunk_size:
+      return
+    after = chunk[-1]
+
+
+def written_rows(statement, model, ids, fields=('id',)):
+  """Run an UPDATE or DELETE `statement` on the rows of `model` with these ids (a list or a SELECT of ids).
+
+    Returns the `fields` of the rows it wrote, from RETURNING; databases without it
+    (SQLite) read them in the same transaction, before a delete or after an update.
+  """
+  columns = [model.__table__.c[field] for field in fields]
+  statement = statement.where(model.id.in_(ids))
+  if db.engine.dialect.full_returning:
+    return db.session.execute(statement.returning(*columns)).all()
+  read = select(*columns).where(model.id.in_(ids)).order_by(model.id)
+  if statement.is_delete:
+    rows = db.session.execute(read).all()
+    db.session.execute(statement)
+  else:
+    db.session.execute(statement)
+    rows = db.session.execute(read).all()
+  return rows
+
+
+def update_rows(model, changes, ids=None, criteria=None, fields=('id',), chunk_size=BULK_CHUNK_SIZE):
+  """Set the validated column values in `changes` on rows of `model`, given by `ids` or matching `criteria`.
+
+    Only those columns are written, with a new version and updated_at. Each chunk is
+    one UPDATE ... RETURNING in its own transaction, so no lock is held for long.
+    Returns the `fields` (id first) of the updated rows, in id order.
+  """
+  prepare = getattr(model, 'prepare_row', None)
+  statement = bump(model).values(prepare(changes) if prepare is not None else changes)
+  fields = ['id'] + [field for field in fields if field != 'id']
+  updated = []
+  for chunk in id_chunks(model, ids, criteria, chunk_size):
+    try:
+      rows = written_rows(statement, model, chunk, fields)
+      record_changes(model.__tablename__, [row[0] for row in rows])
+      db.session.commit()
+    except Exception:
+      db.session.rollback()
+      raise
+    updated.extend(rows)
+    if rows:
+      notify_write(model.__tablename__, *['%s:%d' % (model.__tablename__, row[0]) for row in rows])
+  return updated
+
+
+def delete_rows(model, ids=None, criteria=None, chunk_size=BULK_CHUNK_SIZE):
+  """Delete rows of `model` (Film or Actor), given by `ids` or matching `criteria`; returns the deleted ids.
+
+    Per chunk, in its own transaction: the films (or actors) linked to the chunk are
+    bumped, as their counts change, then one DELETE ... RETURNING removes the rows and
+    the database cascades it to their film_actors links.
+  """
+  if model is Film:
+    own_key, other, other_key = film_actors.c.film_id, Actor, film_actors.c.actor_id
+  else:
+    own_key, other, other_key = film_actors.c.actor_id, Film, film_actors.c.film_id
+  deleted = []
+  for chunk in id_chunks(model, ids, criteria, chunk_size):
+    try:
+      linked = [id for id, in written_rows(bump(other), other, select(other_key).where(own_key.in_(chunk)))]
+      record_changes(other.__tablename__, linked)
+      gone = [id for id, in written_rows(delete(model.__table__), model, chunk)]
+      record_changes(model.__tablename__, gone, deleted=True)
+      db.session.commit()
+    except Exception:
+      db.session.rollback()
+      raise
+    deleted.extend(gone)
+    if gone:
+      notify_write(model.__tablename__, 'cast', *['%s:%d' % (model.__tablename__, id) for id in gone],
+                   *['%s:%d' % (other.__tablename__, id) for id in linked])
+  return deleted
+
+
+def missing_ids(model, ids):
+  """Return the ids (of a set) that don't exist in `model`'s table."""
+  ids = set(ids)
+  found = set()
+  ordered = sorted(ids)
+  for start in range(0, len(ordered), BULK_CHUNK_SIZE):
+    chunk = ordered[start:start + BULK_CHUNK_SIZE]
+    found.update(id for id, in db.session.query(model.id).filter(model.id.in_(chunk)))
+  return ids - found
+
+
+'''
+changes_since(since, limit) / last_modified(model)
+    incremental sync for pollers, from the change log
+'''
+def committed_changes(since, limit, *columns):
+  """The change_log entries (seq, changed_at, *columns) after change number `since`, in order, and whether
+  there are more.
+
+    seq is handed out when an entry is inserted but the entry only shows once its
+    transaction commits, so a later change can be visible before an earlier one.
+    The entries stop at the first gap in seq that is younger than CHANGES_COMMIT_LAG:
+    the missing change may still commit, and is returned from the same `since` once
+    it has. Past that the gap is taken to be a rollback and passed over, so a
+    rollback holds back the changes after it for up to the lag.
+  """
+  entries = db.session.execute(
+    select(change_log.c.seq, change_log.c.changed_at, *columns)
+      .where(change_log.c.seq > since).order_by(change_log.c.seq).limit(limit + 1)).all()
+  settled = datetime.utcnow() - timedelta(seconds=CHANGES_COMMIT_LAG)
+  expected = since + 1
+  for count, entry in enumerate(entries[:limit]):
+    if entry.seq != expected and entry.changed_at > settled:
+      return entries[:count], False
+    expected = entry.seq + 1
+  return entries[:limit], len(entries) > limit
+
+
+def settled_change():
+  """A change number no change still committing can be below: the latest entry older than CHANGES_COMMIT_LAG."""
+  settled = datetime.utcnow() - timedelta(seconds=CHANGES_COMMIT_LAG)
+  return db.session.execute(
+    select(change_log.c.seq).where(change_log.c.changed_at <= settled)
+      .order_by(change_log.c.seq.desc()).limit(1)).scalar() or 0
+
+
+def changes_since(since=0, limit=DEFAULT_PAGE_SIZE):
+  """The films and actors written after change number `since`, at most `limit` changes at a time.
+
+    Returns ({model: current rows as dicts}, {model: deleted ids}, next, more):
+    pass `next` back as `since` to continue; `more` is true until caught up.
+    Only committed changes with no earlier change still pending are included.
+  """
+  entries, more = committed_changes(since, limit, change_log.c.kind, change_log.c.row_id, change_log.c.deleted)
+  latest = {}
+  for _, _, kind, row_id, deleted in entries:
+    latest[kind, row_id] = deleted   # the last write to a row wins
+  changed, deleted = {Film: [], Actor: []}, {Film: [], Actor: []}
+  models = {'film': Film, 'actor': Actor}
+  for (kind, row_id), gone in latest.items():
+    (deleted if gone else changed)[models[kind]].append(row_id)
+  for model, ids in changed.items():
+    if ids:
+      # Whole rows, with version and updated_at, for a client keeping a copy in sync
+      fields, query = projection(model, model.public_fields)
+      # A row missing here was deleted by a later change, which a later page reports
+      changed[model] = [dict(zip(fields, row)) for row in db.session.execute(query.where(model.id.in_(ids)))]
+  return changed, deleted, entries[-1].seq if entries else since, more
+
+
+def last_modified(model):
+  """When a row of `model` was last written or deleted, or None if never."""
+  written = db.session.execute(select(func.max(model.updated_at))).scalar()
+  logged = db.session.execute(select(func.max(change_log.c.changed_at))
+                              .where(change_log.c.kind == model.__tablename__)).scalar()
+  return max([time for time in (written, logged) if time is not None], default=None)
@@ -0,0 +1,209 @@
+"""Parsing and validation of list-endpoint query parameters and write payloads.
+
+Shared by the Flask app and the async (ASGI) app; errors are raised as a 400 via abort().
+"""
+import json
+from datetime import date
+from flask import abort
+
+from models import film_actors, Actor, Film, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from costar_graph import MAX_DEGREES, MAX_DEGREES_LIMIT
+
+
+NDJSON = 'application/x-ndjson'
+MAX_BATCH_ROWS = 50000
+
+# The columns a client supplies for each model, and the JSON type each must have
+INPUT_FIELDS = {
+    Film: {'name': str, 'date_of_release': str},
+    Actor: {'name': str, 'gender': str, 'age': int},
+    film_actors: {'film_id': int, 'actor_id': int}
+}
+
+# Search parameters accepted by each list endpoint, and how to parse them
+FILTERS = {
+    Film: {'name': str, 'released_after': date.fromisoformat, 'released_before': date.fromisoformat},
+    Actor: {'name': str, 'gender': str, 'min_age': int, 'max_age': int}
+}
+
+# Fields a list endpoint can be sorted on (besides id), each backed by an index on (field, id)
+SORTS = {
+    Film: ('cast_count',),
+    Actor: ('film_count',)
+}
+
+
+def page_args(model, args):
+    """ Read the limit, after and fields query parameters of a list endpoint. """
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        after = parse_cursor(args.get('after'))
+    except ValueError:
+        abort(400, description="limit and after must be whole numbers.")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        abort(400, description=f"limit must be between 1 and {MAX_PAGE_SIZE}.")
+    fields = None
+    if args.get('fields'):
+        fields = args['fields'].split(',')
+        unknown = [field for field in fields if field not in model.public_fields]
+        if unknown:
+            abort(400, description="Unknown field(s): " + ", ".join(unknown))
+    return fields, after, limit
+
+
+def parse_cursor(value):
+    """ An `after` cursor: an id, or "value.id" from a sorted page. """
+    if not value:
+        return None
+    if '.' in value:
+        sort_value, id = value.split('.', 1)
+        return int(sort_value), int(id)
+    return int(value)
+
+
+def sort_args(model, args, after):
+    """ Read sort=field (ascending) or sort=-field (descending); None means id order. """
+    sort = args.get('sort')
+    if not sort or sort == 'id':
+        if isinstance(after, tuple):
+            abort(400, description="after is a sorted-page cursor, but no sort was given.")
+        return None
+    descending = sort.startswith('-')
+    field = sort[1:] if descending else sort
+    if field not in SORTS[model]:
+        abort(400, description="Can't sort by %s; sortable fields: %s" % (field, ", ".join(('id',) + SORTS[model])))
+    if after is not None and not isinstance(after, tuple):
+        abort(400, description="after must be the next cursor of the previous page with the same sort.")
+    return field, descending
+
+
+def changes_args(args):
+    """ Read the since and limit query parameters of /changes. """
+    try:
+        since = int(args.get('since') or 0)
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400, description="since and limit must be whole numbers.")
+    if since < 0 or not 1 <= limit <= MAX_PAGE_SIZE:
+        abort(400, description=f"since must not be negative, and limit must be between 1 and {MAX_PAGE_SIZE}.")
+    return since, limit
+
+
+def graph_args(args):
+    """ Read the limit and max_degrees query parameters of the co-star endpoints. """
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        max_degrees = int(args.get('max_degrees', MAX_DEGREES))
+    except ValueError:
+        abort(400, description="limit and max_degrees must be whole numbers.")
+    if not 1 <= limit <= MAX_PAGE_SIZE or not 1 <= max_degrees <= MAX_DEGREES_LIMIT:
+        abort(400, description=f"limit must be between 1 and {MAX_PAGE_SIZE}, "
+                               f"and max_degrees between 1 and {MAX_DEGREES_LIMIT}.")
+    return limit, max_degrees
+
+
+def filter_args(model, args):
+    """ Read the search parameters of a list endpoint, e.g. gender=Female&min_age=30. """
+    criteria = {}
+    for name, parse in FILTERS[model].items():
+        value = args.get(name)
+        if value:
+            try:
+                criteria[name] = parse(value)
+            except ValueError:
+                abort(400, description=f"Invalid value for {name}: {value}")
+    return criteria
+
+
+def coerce(kind, value):
+    """ A client-supplied JSON value, which must already be a `kind` (true and false aren't ints);
+        ValueError if it's missing or of another type. Nothing is converted, so 3.7 isn't stored as 3. """
+    if isinstance(value, bool) or not isinstance(value, kind):
+        raise ValueError(value)
+    return value
+
+
+def parse_text(kind, value):
+    """ A value read from a text format (a CSV cell) as `kind`; ValueError if it isn't one, e.g. "3.7" for an int. """
+    if kind is int and isinstance(value, str):
+        return int(value.strip())
+    return coerce(kind, value)
+
+
+def validate_row(model, item, text=False):
+    """ Check one item (with `text`, a CSV record, whose numbers are still strings); ValueError saying what's wrong. """
+    if not isinstance(item, dict):
+        raise ValueError("not a JSON object")
+    row = {}
+    for field, kind in INPUT_FIELDS[model].items():
+        try:
+            row[field] = (parse_text if text else coerce)(kind, item.get(field))
+        except (TypeError, ValueError):
+            raise ValueError(f"'{field}' is missing or not a valid {kind.__name__}") from None
+    return row
+
+
+def ndjson_items(text):
+    """ The items of an NDJSON batch body, one per non-blank line. """
+    try:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    except ValueError:
+        abort(400, description="Every line of an NDJSON body must be a JSON object.")
+
+
+def batch_items(items, key, max_rows):
+    """ The items of a batch request body: a JSON array, or {"<key>": [...]}, of at most `max_rows`. """
+    if isinstance(items, dict):
+        items = items.get(key)
+    if not isinstance(items, list) or not items:
+        abort(400, description=f"Expected a non-empty array of {key}.")
+    if len(items) > max_rows:
+        abort(400, description=f"At most {max_rows} {key} can be sent in one request.")
+    return items
+
+
+def validate_rows(model, items):
+    """ Check every item of a batch before anything is written. """
+    rows = []
+    for index, item in enumerate(items):
+        try:
+            rows.append(validate_row(model, item))
+        except ValueError as error:
+            abort(400, description=f"Item {index}: {error}.")
+    return rows
+
+
+def validate_changes(model, item):
+    """ Check the fields a PATCH sets: only those supplied, at least one. """
+    if not isinstance(item, dict) or not item:
+        abort(400, description="Expected a JSON object of the fields to change.")
+    unknown = [field for field in item if field not in INPUT_FIELDS[model]]
+    if unknown:
+        abort(400, description="Unknown or read-only field(s): " + ", ".join(unknown))
+    changes = {}
+    for field, value in item.items():
+        kind = INPUT_FIELDS[model][field]
+        try:
+            changes[field] = coerce(kind, value)
+        except (TypeError, ValueError):
+            abort(400, description=f"'{field}' is not a valid {kind.__name__}.")
+    return changes
+
+
+def target_args(model, args, body, max_ids):
+    """ The rows a bulk PATCH or DELETE applies to: (ids, None) from the body's "ids",
+        or (None, criteria) from the list endpoint's search parameters. """
+    ids = body.get('ids') if isinstance(body, dict) else None
+    criteria = filter_args(model, args)
+    if ids is None:
+        if not criteria:
+            abort(400, description="Give the ids to change, or search parameters to match (e.g. gender=Female).")
+        return None, criteria
+    if criteria:
+        abort(400, description="Give either ids or search parameters, not both.")
+    if not isinstance(ids, list) or not ids or \
+            not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+        abort(400, description="ids must be a non-empty array of whole numbers.")
+    if len(ids) > max_ids:
+        abort(400, description=f"At most {max_ids} ids can be sent in one request.")
+    return ids, None
@@ -0,0 +1,249 @@
+"""Per-client rate limits, and a concurrency cap on the expensive list endpoints.
+
+Every route behind @RequiresAuth draws from a token bucket per client (the token's
+sub - "<client id>@clients" for machine tokens) and required scope. Buckets are
+charged once the token is verified, which is cached, so a forged token can't spend
+another client's budget. A request over the limit gets a 429 with Retry-After.
+
+    RATE_LIMIT_DEFAULT=20/40                    # 20 requests a second, bursts of up to 40
+    RATE_LIMITS=post:film=2/5,post:actor=2/5    # per scope; a route takes its strictest scope
+    RATE_LIMIT_URL=redis://...                  # share the buckets between workers
+
+RATE_LIMIT_DEFAULT=off turns limiting off, and a scope can be set to off likewise.
+
+The list endpoints also need one of LIST_CONCURRENCY slots in their worker while
+they query and serialise. A request that gets none within LIST_QUEUE_TIMEOUT seconds
+is answered with a 503 and Retry-After, instead of queueing for as long as it takes.
+"""
+import asyncio, math, os, threading, time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import wraps
+from flask import make_response
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+import metrics
+
+DEFAULT_LIMIT = '50/100'
+DEFAULT_MAX_KEYS = 10000
+LIST_CONCURRENCY = int(os.environ.get('LIST_CONCURRENCY', 8))
+LIST_QUEUE_TIMEOUT = float(os.environ.get('LIST_QUEUE_TIMEOUT', 0.25))
+LIST_RETRY_AFTER = 1
+
+
+## Statistics
+class LimitStats:
+    """Requests turned away, by scope (rate limited) and by endpoint (no free slot)."""
+
+    def __init__(self):
+        self.limited = {}
+        self.shed = {}
+        self._lock = threading.Lock()
+
+    def record(self, counts, label):
+        with self._lock:
+            counts[label] = counts.get(label, 0) + 1
+
+    def exposition(self):
+        with self._lock:
+            limited, shed = dict(self.limited), dict(self.shed)
+        return metrics.gauges(
+            'rate_limited_total', 'Requests rejected with a 429 for exceeding a rate limit.',
+            {(('scope', scope),): count for scope, count in limited.items()}, kind='counter') + metrics.gauges(
+            'load_shed_total', 'Requests rejected with a 503 for want of a free slot.',
+            {(('endpoint', endpoint),): count for endpoint, count in shed.items()}, kind='counter')
+
+
+stats = LimitStats()
+metrics.collectors['rate_limit'] = stats.exposition
+
+
+## Token buckets
+class LocalBackend:
+    """Token buckets in this worker's memory; beyond `max_keys` the least recently used is forgotten."""
+
+    def __init__(self, max_keys=DEFAULT_MAX_KEYS):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()   # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        """Spend `cost` tokens from `key`'s bucket: 0.0 if they were there, else the seconds until they will be."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+# Same arithmetic as LocalBackend.take, run atomically in Redis on the server's clock
+TOKEN_BUCKET = """
+redis.replicate_commands()
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = math.min(burst, (tonumber(bucket[1]) or burst) + (now - (tonumber(bucket[2]) or now)) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class SharedBackend:
+    """Token buckets in a shared store, so a client's budget covers every worker.
+
+    `client` needs redis-py's register_script: each take is one TOKEN_BUCKET call,
+    so two workers can't both spend a bucket's last token. A local stand-in can
+    emulate it with a LocalBackend.
+    """
+
+    def __init__(self, client, prefix='casting:ratelimit:v1:'):
+        self.script = client.register_script(TOKEN_BUCKET)
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, cost=1):
+        return float(self.script(keys=[self.prefix + key], args=[rate, burst, cost]))
+
+
+def backend_from_env():
+    """LocalBackend by default; RATE_LIMIT_URL=redis://... shares the buckets between workers."""
+    url = os.environ.get('RATE_LIMIT_URL')
+    if url:
+        import redis   # optional dependency, only needed for the shared backend
+        return SharedBackend(redis.Redis.from_url(url))
+    return LocalBackend()
+
+
+def parse_limit(value):
+    """'20/40' -> (20.0, 40.0), requests a second and the burst (the rate if left out); None for 'off'."""
+    value = value.strip().lower()
+    if value in ('', 'off', '0'):
+        return None
+    rate, _, burst = value.partition('/')
+    return float(rate), float(burst) if burst else max(float(rate), 1.0)
+
+
+def parse_limits(value):
+    """'post:film=2/5,post:actor=2/5' -> {scope: limit}."""
+    limits = {}
+    for item in value.split(','):
+        if item.strip():
+            scope, _, limit = item.partition('=')
+            limits[scope.strip()] = parse_limit(limit)
+    return limits
+
+
+## Rate Limiter
+class RateLimiter:
+    """Token buckets per client and scope, with limits from RATE_LIMIT_DEFAULT and RATE_LIMITS."""
+
+    def __init__(self, backend=None, default=None, limits=None):
+        self.backend = backend
+        self.default = default
+        self.limits = limits
+
+    def init_backend(self):
+        if self.backend is None:
+            self.backend = backend_from_env()
+        if self.limits is None:
+            self.default = parse_limit(os.environ.get('RATE_LIMIT_DEFAULT', DEFAULT_LIMIT))
+            self.limits = parse_limits(os.environ.get('RATE_LIMITS', ''))
+        return self.backend
+
+    def limit_for(self, required):
+        """The slowest-refilling limit among the scopes a route requires (None if all are off)."""
+        scopes = (required.all_of | required.any_of) or {''}
+        limits = [limit for limit in (self.limits.get(scope, self.default) for scope in scopes) if limit]
+        return min(limits) if limits else None
+
+    def check(self, required, payload, address=None):
+        """Charge the caller's bucket for a route requiring `required`; 429 if it's empty."""
+        backend = self.init_backend()
+        limit = self.limit_for(required)
+        if limit is None:
+            return
+        client = payload.get('sub') or payload.get('azp') or address or 'anonymous'
+        wait = backend.take(client + '|' + required.name, *limit)
+        if wait:
+            stats.record(stats.limited, required.name)
+            raise TooManyRequests(description="Rate limit exceeded, retry after %d second(s)." % math.ceil(wait),
+                                  retry_after=math.ceil(wait))
+
+
+limiter = RateLimiter()
+
+
+## Admission control
+class ConcurrencyLimit:
+    """At most `slots` requests at once in this worker; the rest wait up to `timeout` seconds, then get a 503.
+
+    Use as a decorator on Flask views, or `async with limit.admitted(endpoint)` in the async app.
+    """
+
+    def __init__(self, slots=LIST_CONCURRENCY, timeout=LIST_QUEUE_TIMEOUT):
+        self.slots = slots
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(slots) if slots > 0 else None
+        self._async_semaphore = None
+
+    def reject(self, endpoint):
+        stats.record(stats.shed, endpoint)
+        raise ServiceUnavailable(description="Server busy, retry shortly.", retry_after=LIST_RETRY_AFTER)
+
+    def __call__(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if self._semaphore is None:
+                return f(*args, **kwargs)
+            if not self._semaphore.acquire(timeout=self.timeout):
+                self.reject(f.__name__)
+            try:
+                response = make_response(f(*args, **kwargs))
+            except BaseException:
+                self._semaphore.release()
+                raise
+            # A streamed export keeps its slot until the last row is sent, or the stream is closed
+            if response.is_streamed:
+                response.response = release_after(response.response, self._semaphore.release)
+            else:
+                self._semaphore.release()
+            return response
+        return wrapper
+
+    @asynccontextmanager
+    async def admitted(self, endpoint):
+        if self.slots <= 0:
+            yield
+            return
+        if self._async_semaphore is None:
+            self._async_semaphore = asyncio.Semaphore(self.slots)
+        try:
+            await asyncio.wait_for(self._async_semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.reject(endpoint)
+        try:
+            yield
+        finally:
+            self._async_semaphore.release()
+
+
+def release_after(chunks, release):
+    try:
+        yield from chunks
+    finally:
+        release()
+
+
+list_slots = ConcurrencyLimit()
@@ -0,0 +1,196 @@
+"""Read replicas: GET requests read from a replica, writes and recent writers stay on the primary.
+
+    DATABASE_REPLICA_URLS=postgresql://replica-1/casting,postgresql://replica-2/casting   # see models.setup_db
+    READ_YOUR_WRITES_SECONDS=5        # how long a client that wrote keeps reading from the primary
+    READ_YOUR_WRITES_URL=redis://...  # remember that across workers
+    READ_YOUR_WRITES_SECRET=...       # or sign it into a cookie the client sends back
+
+SELECTs in GET and HEAD requests go to a replica (one per request, round robin).
+Anything else - INSERT/UPDATE/DELETE, flushes, SELECT ... FOR UPDATE, and every
+statement in other requests - goes to the primary. So does every read by a client
+(the token's sub) for READ_YOUR_WRITES_SECONDS after it wrote, so it never reads a
+replica that hasn't caught up with its own write yet. Without replica URLs
+everything uses the primary, as before.
+
+A pin kept only in the worker that served the write would miss the client's next
+request on any other worker. So pins are either kept in Redis, or carried by the
+client: a short-lived cookie holding the pin's expiry, signed with
+READ_YOUR_WRITES_SECRET. With neither, replicas aren't read from at all.
+"""
+import hashlib, hmac, itertools, logging, math, os, threading, time
+from collections import OrderedDict
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql import CompoundSelect, Select
+
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+READ_YOUR_WRITES_SECRET = os.environ.get('READ_YOUR_WRITES_SECRET')
+PIN_COOKIE = 'read_your_writes'
+DEFAULT_MAX_WRITERS = 10000
+READ_METHODS = ('GET', 'HEAD')
+
+logger = logging.getLogger('replicas')
+
+
+## Recent writers
+class RecentWriters:
+    """Clients that wrote in the last `window` seconds, in this worker or (with a `client`) in any.
+
+    `client` needs the redis-py methods get and set(ex=) - a Redis connection, or a local stand-in.
+    """
+
+    def __init__(self, window=READ_YOUR_WRITES_SECONDS, client=None, max_writers=DEFAULT_MAX_WRITERS,
+                 prefix='casting:writer:v1:'):
+        self.window = window
+        self.client = client
+        self.max_writers = max_writers
+        self.prefix = prefix
+        self.writers = OrderedDict()   # sub -> pinned until (monotonic)
+        self._lock = threading.Lock()
+
+    def pin(self, writer):
+        if self.client is not None:
+            self.client.set(self.prefix + writer, b'1', ex=max(1, round(self.window)))
+            return
+        with self._lock:
+            self.writers[writer] = time.monotonic() + self.window
+            self.writers.move_to_end(writer)
+            while len(self.writers) > self.max_writers:
+                self.writers.popitem(last=False)
+
+    @property
+    def shared(self):
+        return self.client is not None
+
+    def pinned(self, writer):
+        if self.client is not None:
+            return self.client.get(self.prefix + writer) is not None
+        with self._lock:
+            until = self.writers.get(writer)
+            if until is None:
+                return False
+            if until <= time.monotonic():
+                del self.writers[writer]
+                return False
+            return True
+
+
+def writers_from_env():
+    url = os.environ.get('READ_YOUR_WRITES_URL')
+    if url:
+        import redis   # optional dependency, only needed to share pins between workers
+        return RecentWriters(client=redis.Redis.from_url(url))
+    return RecentWriters()
+
+
+recent_writers = writers_from_env()
+
+
+def request_writer():
+    """The verified client making the current request, or None (set by auth.current_claims)."""
+    from auth import verified_claims
+    payload = verified_claims()
+    if payload is None:
+        return None
+    return payload.get('sub') or payload.get('azp')
+
+
+def pin_signature(writer, until):
+    message = ('%s\0%d' % (writer, until)).encode()
+    return hmac.new(READ_YOUR_WRITES_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+
+def pin_cookie(writer, until):
+    """The cookie value pinning `writer` to the primary until `until` (Unix time, in ms)."""
+    return '%d.%s' % (until, pin_signature(writer, until))
+
+
+def cookie_pinned(writer):
+    """Whether the request carries a valid, unexpired pin for `writer`."""
+    value = request.cookies.get(PIN_COOKIE)
+    if not value or not READ_YOUR_WRITES_SECRET:
+        return False
+    until, _, signature = value.partition('.')
+    if not until.isdigit() or not hmac.compare_digest(signature, pin_signature(writer, int(until))):
+        return False
+    now = 1000 * time.time()
+    return now < int(until) <= now + 1000 * recent_writers.window
+
+
+def pin_writer(tags):
+    """models.on_write listener: keep the client that just wrote on the primary for a while."""
+    if has_request_context():
+        writer = request_writer()
+        if writer is not None:
+            recent_writers.pin(writer)
+            if not recent_writers.shared and READ_YOUR_WRITES_SECRET:
+                g.pinned_writer = writer
+
+
+def set_pin_cookie(response):
+    """after_request: hand the client the pin of a write made by this request."""
+    writer = g.pop('pinned_writer', None)
+    if writer is not None:
+        until = int(1000 * (time.time() + recent_writers.window))
+        response.set_cookie(PIN_COOKIE, pin_cookie(writer, until), max_age=math.ceil(recent_writers.window),
+                            httponly=True)
+    return response
+
+
+def pins_reach_every_worker():
+    return recent_writers.shared or bool(READ_YOUR_WRITES_SECRET)
+
+
+def init_app(app):
+    """Send pin cookies; without a way to share pins, warn that the replicas won't be read."""
+    app.after_request(set_pin_cookie)
+    if app.extensions.get('replicas') and not pins_reach_every_worker():
+        logger.warning('Read replicas are configured but neither READ_YOUR_WRITES_URL nor READ_YOUR_WRITES_SECRET '
+                       'is set: reading from the primary only')
+
+
+## Routing
+_next_replica = itertools.count()
+
+
+def read_bind(app):
+    """The replica bind key for the current request's reads, or None for the primary (decided once per request)."""
+    if not has_request_context():
+        return None
+    if 'replica_bind' not in g:
+        replicas = app.extensions.get('replicas')
+        writer = request_writer()
+        if not replicas or request.method not in READ_METHODS or not pins_reach_every_worker() or \
+                (writer is not None and (recent_writers.pinned(writer) or cookie_pinned(writer))):
+            g.replica_bind = None
+        else:
+            g.replica_bind = replicas[next(_next_replica) % len(replicas)]
+    return g.replica_bind
+
+
+def is_read(clause):
+    return isinstance(clause, (Select, CompoundSelect)) and getattr(clause, '_for_update_arg', None) is None
+
+
+class RoutingSession(SignallingSession):
+    """Session sending plain SELECTs to the request's replica, if it has one, and the rest to the primary."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if is_read(clause) and not self._flushing:
+            bind = read_bind(self.app)
+            if bind is not None:
+                g.replica_read = True
+                return self.db.get_engine(self.app, bind=bind)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """flask_sqlalchemy.SQLAlchemy with a RoutingSession."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
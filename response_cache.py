@@ -0,0 +1,258 @@
+import hashlib, os, threading, time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from flask import g, request, Response, make_response
+from werkzeug.http import parse_date
+
+from compression import ENCODINGS, compress_all, compressible, negotiate, use_variant, vary
+from replicas import READ_YOUR_WRITES_SECONDS
+
+
+DEFAULT_MAX_ENTRIES = 512
+DEFAULT_TTL = 60
+
+# A cached, serialised response; last_modified is the Last-Modified header value, if any,
+# and variants the body compressed with each worthwhile encoding: {'gzip': bytes, ...}
+Entry = namedtuple('Entry', ['body', 'etag', 'mimetype', 'last_modified', 'variants'], defaults=(None, {}))
+
+
+def make_etag(body):
+    """Strong ETag for a response body."""
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+## Backends
+class LRUBackend:
+    """In-process LRU of responses, with a tag -> keys index for invalidation.
+
+    Each gunicorn worker has its own copy and only sees its own writes, so
+    entries also expire after `ttl` seconds to bound staleness across workers.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()   # key -> (entry, tags, expires_at)
+        self.tags = {}                 # tag -> set of keys
+        self.epoch = 0                 # bumped by every invalidation
+        self.invalidated_at = 0.0      # time.time() of the last one
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if time.monotonic() >= item[2]:
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+            return item[0]
+
+    def will_store(self, epoch):
+        """Whether set() with this epoch would keep the entry."""
+        return self.ttl > 0 and epoch == self.epoch
+
+    def set(self, key, entry, tags, epoch):
+        with self._lock:
+            if not self.will_store(epoch):
+                return   # not kept at all, or something was written while this response was being built
+            self._drop(key)
+            self.entries[key] = (entry, tags, time.monotonic() + self.ttl)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            self.epoch += 1
+            self.invalidated_at = time.time()
+            for tag in tags:
+                for key in self.tags.pop(tag, ()):
+                    self._drop(key)
+
+    def current_epoch(self):
+        return self.epoch
+
+    def last_invalidated(self):
+        return self.invalidated_at
+
+    def clear(self):
+        with self._lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.tags.clear()
+
+    def _drop(self, key):
+        item = self.entries.pop(key, None)
+        if item is not None:
+            for tag in item[1]:
+                keys = self.tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.tags[tag]
+
+
+class SharedBackend:
+    """Responses kept in a shared key-value store, so every worker sees every invalidation.
+
+    `client` needs the redis-py methods get, set(ex=), delete, sadd, smembers,
+    expire and incr - a Redis connection, or any local stand-in with those.
+    """
+
+    def __init__(self, client, ttl=DEFAULT_TTL, prefix='casting:response:v3:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        etag, mimetype, last_modified, sizes, data = value.split(b'\n', 4)
+        # data is the body then each variant, with their lengths in sizes: b'identity:N,gzip:M'
+        parts, offset = {}, 0
+        for part in sizes.decode().split(','):
+            name, size = part.split(':')
+            parts[name] = data[offset:offset + int(size)]
+            offset += int(size)
+        body = parts.pop('identity')
+        return Entry(body, etag.decode(), mimetype.decode(), last_modified.decode() or None, parts)
+
+    def will_store(self, epoch):
+        return self.ttl > 0 and epoch == self.current_epoch()
+
+    def set(self, key, entry, tags, epoch):
+        if not self.will_store(epoch):
+            return
+        parts = [('identity', entry.body)] + sorted(entry.variants.items())
+        value = b'\n'.join([entry.etag.encode(), entry.mimetype.encode(), (entry.last_modified or '').encode(),
+                            ','.join('%s:%d' % (name, len(data)) for name, data in parts).encode(),
+                            b''.join(data for _, data in parts)])
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+        for tag in tags:
+            self.client.sadd(self.prefix + 'tag:' + tag, key)
+            self.client.expire(self.prefix + 'tag:' + tag, self.ttl)
+
+    def invalidate(self, tags):
+        self.client.incr(self.prefix + 'epoch')
+        self.client.set(self.prefix + 'invalidated_at', str(time.time()).encode(), ex=self.ttl)
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = [self.prefix + (key.decode() if isinstance(key, bytes) else key)
+                    for key in self.client.smembers(tag_key)]
+            self.client.delete(tag_key, *keys)
+
+    def current_epoch(self):
+        return int(self.client.get(self.prefix + 'epoch') or 0)
+
+    def last_invalidated(self):
+        return float(self.client.get(self.prefix + 'invalidated_at') or 0)
+
+
+def backend_from_env():
+    """LRU by default; RESPONSE_CACHE_URL=redis://... shares the cache between workers."""
+    ttl = int(os.environ.get('RESPONSE_CACHE_TTL', DEFAULT_TTL))
+    url = os.environ.get('RESPONSE_CACHE_URL')
+    if url:
+        import redis   # optional dependency, only needed for the shared backend
+        return SharedBackend(redis.Redis.from_url(url), ttl=ttl)
+    return LRUBackend(int(os.environ.get('RESPONSE_CACHE_SIZE', DEFAULT_MAX_ENTRIES)), ttl=ttl)
+
+
+## Response Cache
+class ResponseCache:
+    """Read-through cache of serialised GET responses, invalidated by tag on writes."""
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def init_backend(self):
+        if self.backend is None:
+            self.backend = backend_from_env()
+        return self.backend
+
+    def invalidate(self, tags):
+        if self.backend is not None:
+            self.backend.invalidate(tags)
+
+    def cached(self, *tags, bypass=None):
+        """Decorator for GET views: serve from the cache, keyed by path and query string.
+
+        `tags` name what the response depends on; the view can add more with
+        cache_tags(). Writes invalidate every entry holding a tag they touch.
+        Requests for which `bypass()` is true skip the cache entirely.
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if bypass is not None and bypass():
+                    return f(*args, **kwargs)
+                backend = self.init_backend()
+                key = request.full_path
+                entry = backend.get(key)
+                if entry is None:
+                    self.misses += 1
+                    epoch = backend.current_epoch()
+                    g.cache_tags = set(tags)
+                    response = make_response(f(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    if g.pop('replica_read', False) and \
+                            time.time() - backend.last_invalidated() < READ_YOUR_WRITES_SECONDS:
+                        return response   # the replica may not have the latest write yet; don't keep it
+                    body = response.get_data()
+                    # An entry that won't be kept is only compressed for this client
+                    store = backend.will_store(epoch)
+                    encodings = ENCODINGS if store else [encoding for encoding in [negotiate()] if encoding]
+                    entry = Entry(body, make_etag(body), response.mimetype, response.headers.get('Last-Modified'),
+                                  compress_all(body, response.mimetype, encodings))
+                    if store:
+                        backend.set(key, entry, frozenset(g.cache_tags), epoch)
+                else:
+                    self.hits += 1
+                return entry_response(entry)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def cache_tags(*tags):
+    """Record extra tags the response being built depends on."""
+    if 'cache_tags' in g:
+        g.cache_tags.update(tags)
+
+
+def entry_response(entry):
+    """Build the response for a cache entry, or a 304 if the client already has it.
+
+    The body is sent as the stored variant the client prefers, if any; each
+    variant has its own ETag (the entry's, suffixed with the encoding).
+    """
+    encoding = negotiate([encoding for encoding in ENCODINGS if encoding in entry.variants])
+    etag = entry.etag + '-' + encoding if encoding else entry.etag
+    if request.if_none_match.contains(etag) or (
+            not request.if_none_match and entry.last_modified and request.if_modified_since
+            and parse_date(entry.last_modified) <= request.if_modified_since):
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, mimetype=entry.mimetype)
+        if encoding:
+            use_variant(response, encoding, entry.variants[encoding], len(entry.body))
+    response.set_etag(etag)
+    if compressible(entry.mimetype):
+        vary(response)
+    if entry.last_modified:
+        response.headers['Last-Modified'] = entry.last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# Process-wide cache used by the app's GET endpoints
+cache = ResponseCache()
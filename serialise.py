@@ -0,0 +1,128 @@
+"""JSON encoding for API responses, with a fast path for fixed-schema rows.
+
+orjson is used when it is installed (JSON_ENCODER=stdlib forces the standard
+library); it encodes rows from plain dicts faster than anything built in Python.
+Without it, rows whose columns are known up front skip the per-row dict entirely:
+each is formatted straight from the SQLAlchemy Row tuple into a %-template built
+once per column set.
+"""
+import json, os
+from datetime import date, datetime
+from json.encoder import encode_basestring_ascii
+from sqlalchemy import Date, DateTime, Integer, String
+
+from metrics import phase
+
+try:
+    import orjson
+except ImportError:   # optional dependency - fall back to the standard library
+    orjson = None
+
+if os.environ.get('JSON_ENCODER') == 'stdlib':
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'stdlib'
+
+
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serialisable' % (value,))
+
+
+def dumps(obj):
+    """Encode any JSON document to compact UTF-8 bytes."""
+    with phase('serialise'):
+        if orjson is not None:
+            return orjson.dumps(obj, default=_default)
+        return json.dumps(obj, separators=(',', ':'), default=_default).encode()
+
+
+def dumps_value(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=_default).decode()
+    return json.dumps(value, default=_default)
+
+
+## Fixed-schema row encoders
+_encoders = {}
+
+
+def _or_null(convert):
+    return lambda value: 'null' if value is None else convert(value)
+
+
+def _column_format(column):
+    """(placeholder, converter) formatting one column into a row template.
+
+    The converter, if any, runs on the value before the template is applied.
+    Nullable columns get a converter that writes the whole JSON value, or null.
+    """
+    kind = column.type
+    if isinstance(kind, Integer):
+        placeholder, convert = '%d', None
+    elif isinstance(kind, String):
+        placeholder, convert = '%s', encode_basestring_ascii
+    elif isinstance(kind, DateTime):
+        placeholder, convert = '"%s"', datetime.isoformat
+    elif isinstance(kind, Date):
+        placeholder, convert = '"%s"', date.isoformat
+    else:
+        return '%s', dumps_value
+    if not column.nullable:
+        return placeholder, convert
+    if convert is None:
+        return '%s', _or_null(str)
+    if placeholder == '%s':
+        return '%s', _or_null(convert)
+    return '%s', _or_null(lambda value: placeholder % convert(value))
+
+
+def row_encoder(model, fields):
+    """Return a function turning a Row of `fields` from `model` into a JSON object string.
+
+    With orjson this encodes the row's dict. Otherwise integers, strings, dates
+    and datetimes are written by the template itself (%d, the C string escaper,
+    isoformat), with null for an empty nullable column; anything else goes
+    through dumps_value. The function is built once per (model, fields) and cached.
+    Columns of the Row beyond `fields` (a sort key selected for the cursor) are ignored.
+    """
+    key = (model, tuple(fields))
+    encoder = _encoders.get(key)
+    if encoder is not None:
+        return encoder
+    if orjson is not None:
+        names = tuple(fields)
+        encoder = _encoders[key] = lambda row: orjson.dumps(dict(zip(names, row)), default=_default).decode()
+        return encoder
+    template, converters = [], []
+    for index, field in enumerate(fields):
+        placeholder, convert = _column_format(model.__table__.c[field])
+        if convert is not None:
+            converters.append((index, convert))
+        template.append(encode_basestring_ascii(field).replace('%', '%%') + ':' + placeholder)
+    template, converters, width = '{' + ','.join(template) + '}', tuple(converters), len(fields)
+
+    def encoder(row):
+        values = list(row[:width])
+        for index, convert in converters:
+            values[index] = convert(values[index])
+        return template % tuple(values)
+
+    _encoders[key] = encoder
+    return encoder
+
+
+def encode_rows(model, fields, rows):
+    """The JSON array for a list of Rows; without orjson, no dict is built per row."""
+    with phase('serialise'):
+        if orjson is not None:
+            return orjson.dumps([dict(zip(fields, row)) for row in rows], default=_default).decode()
+        encoder = row_encoder(model, fields)
+        return '[' + ','.join([encoder(row) for row in rows]) + ']'
+
+
+def list_document(key, rows_json, next_cursor):
+    """The list endpoint response body around an already-encoded array of rows."""
+    return ('{"Success":"True",%s:%s,"next":%s}' % (
+        encode_basestring_ascii(key), rows_json, dumps_value(next_cursor))).encode()
@@ -0,0 +1,185 @@
+import os, unittest, json, time
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+JWKS_FILE = os.path.join(FIXTURES, 'jwks.json')
+PRIVATE_KEY_FILE = os.path.join(FIXTURES, 'jwks_private.pem')
+
+# The auth settings of the apps under test, with signing keys from the local JWKS fixture
+AUTH_CONFIG = {'AUTH0_DOMAIN': 'casting-agency.test', 'API_AUDIENCE': 'agency', 'AUTH0_JWKS_FILE': JWKS_FILE}
+
+import subprocess, sys
+from jose import jwt
+
+import auth
+from flask import Flask
+
+from auth import AuthError, Claims, Permissions, RequiresAuth, check_permissions, verify_decode_jwt, verify_token
+from jwks import JWKSKeyStore, ttl_from_cache_control, MIN_TTL
+from token_cache import TokenCache
+
+
+def make_token(permissions=(), kid='local-test-key', expires_in=3600):
+    """Sign an RS256 token with the fixture key, as Auth0 would."""
+    with open(PRIVATE_KEY_FILE) as key_file:
+        private_key = key_file.read()
+    now = int(time.time())
+    claims = {
+        'iss': 'https://' + AUTH_CONFIG['AUTH0_DOMAIN'] + '/',
+        'sub': 'auth0|local-test-user',
+        'aud': AUTH_CONFIG['API_AUDIENCE'],
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': list(permissions)
+    }
+    return jwt.encode(claims, private_key, algorithm='RS256', headers={'kid': kid})
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """Tests for the cached JWKS key store, using the offline fixture."""
+
+    def test_load_file_indexes_keys_by_kid(self):
+        store = JWKSKeyStore(path=JWKS_FILE)
+        self.assertIn('local-test-key', store.keys)
+        self.assertIs(store.get_key('local-test-key'), store.keys['local-test-key'])
+
+    def test_unknown_kid_without_url_is_not_fetched(self):
+        store = JWKSKeyStore(path=JWKS_FILE)
+        self.assertIsNone(store.get_key('no-such-key'))
+        self.assertEqual(store.last_attempt, 0.0)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        store = JWKSKeyStore(url='https://idp.test/.well-known/jwks.json')
+        with open(JWKS_FILE) as jwks_file:
+            jwks = json.load(jwks_file)
+        fetches = []
+        def fake_fetch():
+            fetches.append(time.monotonic())
+            store.last_attempt = time.monotonic()
+            return store.load_keys(jwks, ttl=600)
+        store.fetch = fake_fetch
+        store.start_background_refresh = lambda: None
+        self.assertIsNotNone(store.get_key('local-test-key'))
+        self.assertIsNone(store.get_key('rotated-key'))
+        self.assertIsNone(store.get_key('rotated-key'))
+        self.assertEqual(len(fetches), 1)
+
+    def test_ttl_respects_cache_control(self):
+        self.assertEqual(ttl_from_cache_control('public, max-age=3600'), 3600)
+        self.assertEqual(ttl_from_cache_control('max-age=1'), MIN_TTL)
+        self.assertEqual(ttl_from_cache_control('no-store'), MIN_TTL)
+        self.assertEqual(ttl_from_cache_control(None, default=42), 42)
+
+    def test_verify_decode_jwt_with_fixture_key(self):
+        payload = verify_decode_jwt(make_token(['get:film']), AUTH_CONFIG)
+        self.assertEqual(payload['permissions'], ['get:film'])
+
+    def test_key_store_comes_from_the_app_config(self):
+        app = Flask(__name__)
+        app.config.update(AUTH_CONFIG)
+        with app.app_context():
+            self.assertIs(auth.get_key_store(), auth.key_stores[JWKS_FILE])
+            self.assertEqual(verify_decode_jwt(make_token(['get:film']))['sub'], 'auth0|local-test-user')
+        app.config['API_AUDIENCE'] = None
+        with app.app_context(), self.assertRaises(RuntimeError):
+            verify_decode_jwt(make_token(['get:film']))
+
+    def test_import_needs_no_auth_settings(self):
+        env = {name: value for name, value in os.environ.items()
+               if name not in auth.AUTH_SETTINGS + ('AUTH0_CLIENT_ID', 'AUTH0_CALLBACK_URL')}
+        root = os.path.dirname(os.path.abspath(__file__))
+        subprocess.run([sys.executable, '-c', 'import app, asgi'], cwd=root, env=env, check=True)
+
+    def test_verify_decode_jwt_unknown_kid(self):
+        with self.assertRaises(AuthError) as context:
+            verify_decode_jwt(make_token(kid='no-such-key'), AUTH_CONFIG)
+        self.assertEqual(context.exception.status_code, 401)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """Tests for the verified-token LRU cache."""
+
+    def test_repeated_token_is_verified_once(self):
+        auth.token_cache.clear()
+        token = make_token(['get:actor'])
+        hits = auth.token_cache.hits
+        first = verify_token(token, AUTH_CONFIG)
+        second = verify_token(token, AUTH_CONFIG)
+        self.assertIs(first, second)
+        self.assertEqual(auth.token_cache.hits, hits + 1)
+
+    def test_entry_expires_with_token(self):
+        cache = TokenCache()
+        cache.put('token', {'exp': time.time() - 1}, 'kid')
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_lru_is_bounded(self):
+        cache = TokenCache(max_size=2)
+        for token in ('a', 'b', 'c'):
+            cache.put(token, {'exp': time.time() + 60}, 'kid')
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def test_rotated_key_evicts_entries(self):
+        store = JWKSKeyStore(path=JWKS_FILE)
+        cache = TokenCache()
+        store.on_rotate(cache.evict_kids)
+        cache.put('token', {'exp': time.time() + 60}, 'local-test-key')
+        store.load_keys({'keys': []})
+        self.assertIsNone(cache.get('token'))
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """Tests for the precompiled permission checks."""
+
+    def test_claims_precompile_permissions(self):
+        auth.token_cache.clear()
+        token = make_token(['get:film', 'get:actor'])
+        payload = verify_token(token, AUTH_CONFIG)
+        self.assertIsInstance(payload, Claims)
+        self.assertEqual(payload.permissions, frozenset(['get:film', 'get:actor']))
+        self.assertIs(verify_token(token, AUTH_CONFIG).permissions, payload.permissions)
+
+    def test_all_of_and_any_of(self):
+        payload = Claims({'permissions': ['get:film', 'patch:film']})
+        self.assertTrue(check_permissions(Permissions(['get:film', 'patch:film']), payload))
+        self.assertTrue(check_permissions(Permissions(any_of=['patch:actor', 'patch:film']), payload))
+        for required in (Permissions(['get:film', 'get:actor']), Permissions(any_of=['post:film', 'post:actor'])):
+            with self.assertRaises(AuthError) as context:
+                check_permissions(required, payload)
+            self.assertEqual(context.exception.status_code, 403)
+
+    def test_missing_permissions_claim_is_unauthorised(self):
+        with self.assertRaises(AuthError) as context:
+            check_permissions('get:film', {'sub': 'auth0|someone'})
+        self.assertEqual(context.exception.status_code, 401)
+
+    def test_requires_auth_verifies_once_per_request(self):
+        app = Flask(__name__)
+        app.config.update(AUTH_CONFIG)
+
+        @RequiresAuth('get:film')
+        def outer(payload):
+            return inner()
+
+        @RequiresAuth(any_of=('get:actor', 'post:actor'))
+        def inner(payload):
+            return payload
+
+        lookups = auth.token_cache.hits + auth.token_cache.misses
+        headers = {'Authorization': 'Bearer ' + make_token(['get:film', 'get:actor'])}
+        with app.test_request_context(headers=headers):
+            payload = outer()
+        self.assertEqual(payload['sub'], 'auth0|local-test-user')
+        self.assertEqual(auth.token_cache.hits + auth.token_cache.misses, lookups + 1)
+
+    def test_requires_auth_without_permissions_is_rejected(self):
+        for args, kwargs in (((), {}), (('',), {}), ((), {'any_of': ('',)})):
+            with self.assertRaises(ValueError):
+                RequiresAuth(*args, **kwargs)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
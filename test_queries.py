@@ -0,0 +1,1506 @@
+import asyncio, gzip, json, os, sqlite3, tempfile, time, unittest
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+# Run against a throwaway SQLite database, with tokens signed by the local JWKS fixture
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'casting_test_queries.db'))
+
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from test_auth import AUTH_CONFIG, make_token
+from auth import Permissions
+from app import create_app
+from models import db, change_log, change_rows, film_actors, idempotency_keys, notify_write, on_write, write_listeners, \
+    projection, Actor, Film, CHANGES_COMMIT_LAG
+from response_cache import cache, LRUBackend, SharedBackend, Entry
+from serialise import encode_rows, list_document, row_encoder
+import asgi, compression, costar_graph, db_pool, idempotency, import_jobs, metrics, rate_limit, replicas, serialise, warmup
+
+try:
+    import aiosqlite
+except ImportError:   # the async app's driver is optional (requirements-async.txt)
+    aiosqlite = None
+
+ALL_PERMISSIONS = ['get:film', 'get:actor', 'post:film', 'post:actor',
+                   'patch:film', 'patch:actor', 'delete:film', 'delete:actor']
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """The app on an empty schema, with helpers to seed it and count the SQL a request runs."""
+
+    def setUp(self):
+        cache.backend = LRUBackend()
+        rate_limit.limiter.backend = rate_limit.LocalBackend()
+        costar_graph.graph.reset()
+        self.app = create_app()
+        self.app.config.update(AUTH_CONFIG)
+        self.client = self.app.test_client
+        self.headers = {'Authorization': 'Bearer ' + make_token(ALL_PERMISSIONS)}
+        with self.app.app_context():
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        if costar_graph.graph.builder is not None:
+            costar_graph.graph.builder.join()
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def seed(self, films, actors_per_film):
+        with self.app.app_context():
+            for _ in range(films):
+                film = Film("Film", "01-Jan-2000")
+                film.actor = [Actor("Actor", "Female", 30) for _ in range(actors_per_film)]
+                db.session.add(film)
+            db.session.commit()
+            notify_write('film', 'actor', 'cast')
+
+    def count_statements(self, url):
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            res = self.client().get(url, headers=self.headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(res.status_code, 200)
+        return len(statements), res.get_json()
+
+
+class QueryCountTestCase(DatabaseTestCase):
+    """The cast endpoints must not issue one query per row (N+1)."""
+    def test_film_list_with_cast_has_fixed_query_count(self):
+        self.seed(films=2, actors_per_film=2)
+        few, body = self.count_statements('/films?include=cast')
+        self.assertEqual(len(body['films'][0]['actors']), 2)
+        self.seed(films=20, actors_per_film=5)
+        many, body = self.count_statements('/films?include=cast')
+        self.assertEqual(len(body['films']), 22)
+        self.assertEqual(few, many)
+
+    def test_actor_list_with_filmography_has_fixed_query_count(self):
+        self.seed(films=1, actors_per_film=2)
+        few, _ = self.count_statements('/actors?include=cast')
+        self.seed(films=10, actors_per_film=10)
+        many, body = self.count_statements('/actors?include=cast')
+        self.assertEqual(len(body['actors'][-1]['films']), 1)
+        self.assertEqual(few, many)
+
+    def test_film_actors_endpoint(self):
+        self.seed(films=1, actors_per_film=3)
+        count, body = self.count_statements('/films/1/actors')
+        self.assertEqual(len(body['actors']), 3)
+        self.assertEqual(count, 2)
+        res = self.client().get('/films/999/actors', headers=self.headers)
+        self.assertEqual(res.status_code, 404)
+
+
+    def test_cached_list_is_served_without_queries(self):
+        self.seed(films=3, actors_per_film=1)
+        first, body = self.count_statements('/films')
+        self.assertGreater(first, 0)
+        second, cached = self.count_statements('/films')
+        self.assertEqual(second, 0)
+        self.assertEqual(body, cached)
+
+    def test_if_none_match_returns_304(self):
+        self.seed(films=1, actors_per_film=1)
+        res = self.client().get('/films', headers=self.headers)
+        etag = res.headers['ETag']
+        res = self.client().get('/films', headers={**self.headers, 'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+    def test_write_invalidates_affected_entries(self):
+        self.seed(films=1, actors_per_film=1)
+        self.count_statements('/films')
+        self.count_statements('/actors/1/films')
+        with self.app.app_context():
+            Actor("Unrelated", "Male", 40).insert()
+        self.assertEqual(self.count_statements('/films')[0], 0)
+        with self.app.app_context():
+            film = Film.query.get(1)
+            film.name = "Renamed"
+            film.update()
+        count, body = self.count_statements('/actors/1/films')
+        self.assertGreater(count, 0)
+        self.assertEqual(body['films'][0]['name'], "Renamed")
+
+    def test_relationship_edits_invalidate_both_sides(self):
+        self.seed(films=2, actors_per_film=1)   # film 1: actor 1; film 2: actor 2
+        for url in ('/actors/2/films', '/films/1/actors', '/actors?fields=film_count'):
+            self.count_statements(url)
+        with self.app.app_context():
+            film = Film.query.get(1)
+            film.actor.append(Actor.query.get(2))
+            film.update()
+        self.assertEqual([film['id'] for film in self.count_statements('/actors/2/films')[1]['films']], [1, 2])
+        self.assertEqual([actor['id'] for actor in self.count_statements('/films/1/actors')[1]['actors']], [1, 2])
+        actors = self.count_statements('/actors?fields=film_count,version')[1]['actors']
+        self.assertEqual([(actor['film_count'], actor['version']) for actor in actors], [(1, 1), (2, 2)])
+        with self.app.app_context():
+            actor = Actor.query.get(2)
+            actor.film.remove(Film.query.get(1))
+            actor.update()
+        self.assertEqual([actor['id'] for actor in self.count_statements('/films/1/actors')[1]['actors']], [1])
+
+
+class PaginationTestCase(DatabaseTestCase):
+    """The list endpoints are keyset paginated on id, and select only the requested fields."""
+
+    def get(self, url):
+        return self.client().get(url, headers=self.headers)
+
+    def test_next_cursor_round_trip(self):
+        self.seed(films=5, actors_per_film=0)
+        pages, url = [], '/films?limit=2'
+        while url:
+            body = self.get(url).get_json()
+            pages.append([film['id'] for film in body['films']])
+            url = '/films?limit=2&after=%s' % body['next'] if body['next'] is not None else None
+        self.assertEqual(pages, [[1, 2], [3, 4], [5]])
+        self.assertEqual(self.get('/films?after=5').get_json(), {'Success': 'True', 'films': [], 'next': None})
+
+    def test_default_page_size(self):
+        self.seed(films=101, actors_per_film=0)
+        body = self.get('/films').get_json()
+        self.assertEqual((len(body['films']), body['next']), (100, 100))
+
+    def test_fields_projection(self):
+        self.seed(films=1, actors_per_film=2)
+        actors = self.get('/actors?fields=name,age').get_json()['actors']
+        self.assertEqual(actors, [{'id': 1, 'name': 'Actor', 'age': 30}, {'id': 2, 'name': 'Actor', 'age': 30}])
+        films = self.get('/films?fields=name&include=cast').get_json()['films']
+        self.assertEqual(set(films[0]), {'id', 'name', 'actors'})
+
+    def test_default_fields_match_format(self):
+        self.seed(films=1, actors_per_film=1)
+        with self.app.app_context():
+            film, actor = Film.query.get(1).format(), Actor.query.get(1).format()
+        self.assertEqual(self.get('/films').get_json()['films'], [film])
+        self.assertEqual(self.get('/actors').get_json()['actors'], [actor])
+        self.assertEqual(self.get('/films/1/actors').get_json()['actors'], [actor])
+
+    def test_bad_page_arguments(self):
+        for query in ('limit=0', 'limit=1001', 'limit=ten', 'after=x', 'after=1.x', 'fields=name,salary'):
+            res = self.get('/actors?' + query)
+            self.assertEqual(res.status_code, 400, query)
+            self.assertEqual(res.get_json()['Error'], 400)
+
+
+class ExportTestCase(DatabaseTestCase):
+    """?stream=ndjson and ?stream=json export the whole (filtered) table, in chunks."""
+
+    def get(self, url, **headers):
+        res = self.client().get(url, headers={**self.headers, **headers})
+        self.assertEqual(res.status_code, 200)
+        return res
+
+    def test_ndjson(self):
+        self.seed(films=3, actors_per_film=1)
+        for url, headers in (('/actors?stream=ndjson&fields=name', {}),
+                             ('/actors?fields=name', {'Accept': 'application/x-ndjson'})):
+            res = self.get(url, **headers)
+            self.assertEqual(res.mimetype, 'application/x-ndjson')
+            lines = res.get_data(as_text=True).split('\n')
+            self.assertEqual(lines[-1], '')
+            self.assertEqual([json.loads(line) for line in lines[:-1]],
+                             [{'id': id, 'name': 'Actor'} for id in (1, 2, 3)])
+
+    def test_chunked_json(self):
+        self.seed(films=5, actors_per_film=0)
+        with mock.patch('app.STREAM_CHUNK_ROWS', 2):
+            res = self.get('/films?stream=json&fields=name&after=1')
+            self.assertTrue(res.is_streamed)
+            body = json.loads(res.get_data())
+        self.assertEqual(body, {'Success': 'True', 'films': [{'id': id, 'name': 'Film'} for id in (2, 3, 4, 5)]})
+
+    def test_empty_and_filtered(self):
+        self.assertEqual(json.loads(self.get('/actors?stream=json').get_data()), {'Success': 'True', 'actors': []})
+        self.assertEqual(self.get('/actors?stream=ndjson').get_data(), b'')
+        self.seed(films=1, actors_per_film=2)
+        with self.app.app_context():
+            Actor.query.get(2).age = 60
+            db.session.commit()
+        lines = self.get('/actors?stream=ndjson&min_age=50').get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [2])
+
+
+class BatchInsertTestCase(DatabaseTestCase):
+    """POST /films, /actors and /casting check the whole batch, then insert it in bulk."""
+
+    def post(self, url, body, **kwargs):
+        return self.client().post(url, headers=self.headers, json=body, **kwargs)
+
+    def count(self, model):
+        with self.app.app_context():
+            return db.session.query(model).count()
+
+    def test_ids_in_input_order(self):
+        self.seed(films=1, actors_per_film=0)
+        names = ["Third", "First", "Second"]
+        res = self.post('/films', {'films': [{'name': name, 'date_of_release': '2001'} for name in names]})
+        self.assertEqual(res.get_json(), {'Success': 'True', 'created': 3, 'ids': [2, 3, 4]})
+        with self.app.app_context():
+            self.assertEqual([Film.query.get(id).name for id in (2, 3, 4)], names)
+
+    def test_ndjson_body(self):
+        body = '{"name": "A", "gender": "Female", "age": 30}\n\n{"name": "B", "gender": "Male", "age": 40}\n'
+        res = self.client().post('/actors', headers=self.headers, data=body, content_type='application/x-ndjson')
+        self.assertEqual(res.get_json()['ids'], [1, 2])
+        res = self.client().post('/actors', headers=self.headers, data='{"name": "C"\n',
+                                 content_type='application/x-ndjson')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.count(Actor), 2)
+
+    def test_invalid_item_rejects_the_batch(self):
+        valid = {'name': 'A', 'gender': 'Female', 'age': 30}
+        for invalid in ({'name': 'B', 'gender': 'Male', 'age': 3.7}, {'name': 5, 'gender': 'Male', 'age': 30},
+                        {'name': 'B', 'gender': 'Male', 'age': True}, {'name': 'B', 'gender': 'Male'}, 'B'):
+            res = self.post('/actors', [valid, invalid])
+            self.assertEqual(res.status_code, 400, invalid)
+            self.assertTrue(res.get_json()['Message'].startswith('Item 1:'))
+        self.assertEqual(self.count(Actor), 0)
+        self.assertEqual(self.post('/actors', {'actors': []}).status_code, 400)
+
+    def test_batch_size_cap(self):
+        with mock.patch('app.MAX_BATCH_ROWS', 2):
+            res = self.post('/films', [{'name': 'F', 'date_of_release': '2001'}] * 3)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(self.post('/films', [{'name': 'F', 'date_of_release': '2001'}] * 2).status_code, 200)
+
+    def test_casting_skips_duplicates(self):
+        self.seed(films=2, actors_per_film=1)   # film 1: actor 1; film 2: actor 2
+        res = self.post('/casting', {'links': [{'film_id': 1, 'actor_id': 2}, {'film_id': 1, 'actor_id': 2},
+                                               {'film_id': 1, 'actor_id': 1}]})
+        self.assertEqual(res.get_json(), {'Success': 'True', 'created': 1})
+        self.assertEqual(self.count(film_actors), 3)
+
+    def test_casting_rejects_unknown_ids(self):
+        self.seed(films=1, actors_per_film=1)
+        res = self.post('/casting', [{'film_id': 1, 'actor_id': 1}, {'film_id': 1, 'actor_id': 99}])
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.get_json()['Message'], "Unknown actor_id(s): 99")
+        self.assertEqual(self.post('/casting', [{'film_id': 7, 'actor_id': 1}]).status_code, 400)
+        self.assertEqual(self.count(film_actors), 1)
+
+
+class AggregateTestCase(DatabaseTestCase):
+    """cast_count and film_count follow the film_actors links, and sort the list endpoints."""
+
+    def get(self, url):
+        res = self.client().get(url, headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_counts_follow_links(self):
+        self.seed(films=2, actors_per_film=2)
+        res = self.client().post('/casting', headers=self.headers,
+                                 json=[{'film_id': 1, 'actor_id': 3}, {'film_id': 2, 'actor_id': 1}])
+        self.assertEqual(res.status_code, 200)
+        films = self.get('/films?fields=cast_count')['films']
+        self.assertEqual([film['cast_count'] for film in films], [3, 3])
+        actors = self.get('/actors?fields=film_count')['actors']
+        self.assertEqual([actor['film_count'] for actor in actors], [2, 1, 2, 1])
+        with self.app.app_context():
+            Film.query.get(1).delete()
+        actors = self.get('/actors?fields=film_count')['actors']
+        self.assertEqual([actor['film_count'] for actor in actors], [1, 0, 1, 1])
+
+    def test_sorted_pages(self):
+        self.seed(films=3, actors_per_film=1)
+        self.client().post('/casting', headers=self.headers,
+                           json=[{'film_id': film, 'actor_id': 2} for film in (1, 3)] +
+                                [{'film_id': 2, 'actor_id': 1}])
+        first = self.get('/actors?sort=-film_count&limit=2')
+        self.assertEqual([actor['id'] for actor in first['actors']], [2, 1])
+        self.assertEqual(first['next'], '2.1')
+        rest = self.get('/actors?sort=-film_count&limit=2&after=' + first['next'])
+        self.assertEqual([actor['id'] for actor in rest['actors']], [3])
+        self.assertIsNone(rest['next'])
+        ascending = self.get('/actors?sort=film_count&fields=name')['actors']
+        self.assertEqual([actor['id'] for actor in ascending], [3, 1, 2])
+        # The sort column is selected for the cursor, but only returned when asked for
+        self.assertEqual(ascending[0], {'id': 3, 'name': 'Actor'})
+        self.assertEqual(self.get('/actors?sort=film_count&limit=1')['actors'],
+                         [{'id': 3, 'name': 'Actor', 'gender': 'Female', 'age': 30}])
+        exported = self.client().get('/actors?sort=-film_count&fields=name&stream=ndjson', headers=self.headers)
+        self.assertEqual([json.loads(line) for line in exported.get_data(as_text=True).splitlines()],
+                         [{'id': id, 'name': 'Actor'} for id in (2, 1, 3)])
+
+    def test_bad_sort_is_rejected(self):
+        for url in ('/actors?sort=age', '/actors?sort=film_count&after=3', '/actors?after=2.1'):
+            res = self.client().get(url, headers=self.headers)
+            self.assertEqual(res.status_code, 400)
+
+
+class ChangesTestCase(DatabaseTestCase):
+    """Pollers can fetch only what changed, from /changes or with If-Modified-Since."""
+
+    def get(self, url, **headers):
+        return self.client().get(url, headers={**self.headers, **headers})
+
+    def test_changes_feed(self):
+        for name in ("First", "Second"):
+            self.client().post('/film', headers=self.headers, json={'name': name, 'date_of_release': '2001'})
+        self.client().post('/actor', headers=self.headers, json={'name': 'Gone', 'gender': 'Male', 'age': 50})
+        everything = self.get('/changes').get_json()
+        self.assertEqual([film['name'] for film in everything['films']], ["First", "Second"])
+        self.assertEqual(everything['films'][0]['version'], 1)
+        self.assertFalse(everything['more'])
+
+        with self.app.app_context():
+            film = Film.query.get(1)
+            film.name = "Renamed"
+            film.update()
+            Actor.query.get(1).delete()
+        delta = self.get('/changes?since=%d' % everything['next']).get_json()
+        self.assertEqual([(film['name'], film['version']) for film in delta['films']], [("Renamed", 2)])
+        self.assertEqual(delta['actors'], [])
+        self.assertEqual(delta['deleted'], {'films': [], 'actors': [1]})
+        caught_up = self.get('/changes?since=%d' % delta['next']).get_json()
+        self.assertEqual((caught_up['films'], caught_up['next']), ([], delta['next']))
+
+    def test_changes_are_paged(self):
+        self.client().post('/films', headers=self.headers,
+                           json=[{'name': 'Film %d' % i, 'date_of_release': '2001'} for i in range(3)])
+        first = self.get('/changes?limit=2').get_json()
+        self.assertEqual(len(first['films']), 2)
+        self.assertTrue(first['more'])
+        rest = self.get('/changes?limit=2&since=%d' % first['next']).get_json()
+        self.assertEqual([film['name'] for film in rest['films']], ['Film 2'])
+        self.assertFalse(rest['more'])
+        self.assertEqual(self.get('/changes?since=-1').status_code, 400)
+
+    def test_writers_committing_out_of_order(self):
+        for name in ("First", "Second"):
+            self.client().post('/film', headers=self.headers, json={'name': name, 'date_of_release': '2001'})
+        since = self.get('/changes').get_json()['next']
+
+        def commit(seq, film_id, age=0):
+            # A writer whose change_log entry was numbered `seq`, committing now
+            with self.app.app_context():
+                entry = dict(change_rows('film', [film_id])[0], seq=seq)
+                entry['changed_at'] -= timedelta(seconds=age)
+                db.session.execute(change_log.insert(), [entry])
+                db.session.commit()
+
+        # Writer A took seq 3 but writer B, numbered 4, commits first
+        commit(since + 2, 2)
+        pending = self.get('/changes?since=%d' % since).get_json()
+        self.assertEqual((pending['films'], pending['next'], pending['more']), ([], since, False))
+        commit(since + 1, 1)
+        both = self.get('/changes?since=%d' % since).get_json()
+        self.assertEqual(([film['id'] for film in both['films']], both['next']), ([1, 2], since + 2))
+
+        # A gap older than the commit lag was rolled back
+        commit(since + 4, 1, age=CHANGES_COMMIT_LAG + 1)
+        after = self.get('/changes?since=%d' % both['next']).get_json()
+        self.assertEqual(([film['id'] for film in after['films']], after['next']), ([1], since + 4))
+
+    def test_if_modified_since(self):
+        self.seed(films=2, actors_per_film=1)
+        with self.app.app_context():
+            # Written in the past, so Last-Modified is sent (it's held back until its second is over)
+            db.session.execute(Film.__table__.update().values(updated_at=datetime(2020, 1, 1, 12, 0, 0, 250000)))
+            db.session.execute(change_log.update().values(changed_at=datetime(2020, 1, 1)))
+            db.session.commit()
+        res = self.get('/films')
+        self.assertEqual(res.headers['Last-Modified'], 'Wed, 01 Jan 2020 12:00:01 GMT')
+        for _ in range(2):   # from the cache, then rebuilt
+            self.assertEqual(self.get('/films', **{'If-Modified-Since': res.headers['Last-Modified']}).status_code, 304)
+            cache.backend = LRUBackend()
+        self.client().post('/film', headers=self.headers, json={'name': 'New', 'date_of_release': '2001'})
+        res = self.get('/films', **{'If-Modified-Since': res.headers['Last-Modified']})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Last-Modified', res.headers)
+
+
+class IdempotencyTestCase(DatabaseTestCase):
+    """A POST retried with the same Idempotency-Key creates one row and gets the first response back."""
+
+    def setUp(self):
+        super().setUp()
+        idempotency.store.clear()
+
+    def post(self, key, name="Retried"):
+        return self.client().post('/film', headers={**self.headers, 'Idempotency-Key': key},
+                                  json={'name': name, 'date_of_release': '2001'})
+
+    def film_count(self):
+        with self.app.app_context():
+            return Film.query.count()
+
+    def test_retry_replays_first_response(self):
+        first = self.post('retry-1')
+        self.assertEqual(first.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        again = self.post('retry-1')
+        self.assertEqual(again.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(again.get_json(), first.get_json())
+        # Another worker, without the response in its store, replays it from the database
+        idempotency.store.clear()
+        self.assertEqual(self.post('retry-1').get_json(), first.get_json())
+        self.assertEqual(self.post('retry-2').status_code, 200)
+        self.assertEqual(self.film_count(), 2)
+
+    def test_key_reused_for_another_request(self):
+        self.post('reused')
+        self.assertEqual(self.post('reused', name="Something else").status_code, 422)
+        self.assertEqual(self.client().post('/actor', headers={**self.headers, 'Idempotency-Key': 'reused'},
+                                            json={'name': 'A', 'gender': 'Male', 'age': 40}).status_code, 200)
+        self.assertEqual(self.post('x' * 300).status_code, 400)
+
+    def test_keys_are_scoped_to_the_caller(self):
+        one = idempotency.request_key({'sub': 'auth0|one'}, 'POST', '/film', 'key', b'{}')
+        two = idempotency.request_key({'sub': 'auth0|two'}, 'POST', '/film', 'key', b'{}')
+        self.assertNotEqual(one[0], two[0])
+        self.assertEqual(one[1], two[1])
+
+    def test_racing_worker_is_answered_from_the_winner(self):
+        first = self.post('raced')
+        idempotency.store.clear()
+        fetch, calls = idempotency.fetch, []
+
+        def missed_first_lookup(digest, fingerprint):
+            calls.append(digest)
+            return None if len(calls) == 1 else fetch(digest, fingerprint)
+        with mock.patch.object(idempotency, 'fetch', missed_first_lookup):
+            again = self.post('raced')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(again.get_json(), first.get_json())
+        self.assertEqual(self.film_count(), 1)
+
+    def test_unfinished_and_expired_keys(self):
+        digest, fingerprint = idempotency.request_key(
+            {'sub': 'auth0|local-test-user'}, 'POST', '/film', 'pending', b'{}')
+        with self.app.app_context():
+            db.session.execute(idempotency_keys.insert().values(
+                key=digest, fingerprint=fingerprint, created_at=datetime.utcnow()))
+            db.session.commit()
+        res = self.client().post('/film', headers={**self.headers, 'Idempotency-Key': 'pending',
+                                                   'Content-Type': 'application/json'}, data=b'{}')
+        self.assertEqual(res.status_code, 409)
+
+        # A worker wrote the row and died before storing its response: retries wait out the lease only
+        self.post('lapsed')
+        with self.app.app_context():
+            db.session.execute(idempotency_keys.update().where(idempotency_keys.c.key != digest).values(
+                status=None, body=None,
+                created_at=datetime.utcnow() - timedelta(seconds=idempotency.IDEMPOTENCY_LEASE + 1)))
+            db.session.commit()
+        idempotency.store.clear()
+        retried = self.post('lapsed')
+        self.assertEqual(retried.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', retried.headers)
+        self.assertEqual(self.post('lapsed').headers['Idempotent-Replayed'], 'true')
+
+        self.post('expired')
+        with self.app.app_context():
+            db.session.execute(idempotency_keys.update().values(
+                created_at=datetime.utcnow() - timedelta(seconds=idempotency.IDEMPOTENCY_TTL + 1)))
+            db.session.commit()
+        idempotency.store.clear()
+        self.assertNotIn('Idempotent-Replayed', self.post('expired').headers)
+        self.assertEqual(self.film_count(), 4)
+
+
+class RateLimitTestCase(DatabaseTestCase):
+    """Each client gets a token bucket per scope, and the list endpoints shed load beyond their slots."""
+
+    def setUp(self):
+        super().setUp()
+        self.limiter = rate_limit.limiter
+        self.saved = self.limiter.default, self.limiter.limits
+        self.limiter.default = rate_limit.parse_limit('50/100')
+        self.limiter.limits = rate_limit.parse_limits('post:film=0.5/2,get:actor=off')
+
+    def tearDown(self):
+        self.limiter.default, self.limiter.limits = self.saved
+        super().tearDown()
+
+    def post_film(self):
+        return self.client().post('/film', headers=self.headers, json={'name': 'Film', 'date_of_release': '2001'})
+
+    def test_scope_limit(self):
+        self.assertEqual([self.post_film().status_code for _ in range(3)], [200, 200, 429])
+        res = self.post_film()
+        self.assertEqual(res.get_json()['Error'], 429)
+        self.assertEqual(res.headers['Retry-After'], '2')
+        # Other scopes have their own buckets
+        self.assertEqual(self.client().get('/films', headers=self.headers).status_code, 200)
+
+    def test_limits(self):
+        self.assertEqual(rate_limit.parse_limit('20'), (20.0, 20.0))
+        self.assertIsNone(rate_limit.parse_limit('off'))
+        limit_for = lambda *scopes: self.limiter.limit_for(Permissions(scopes))
+        self.assertEqual(limit_for('get:film', 'post:film'), (0.5, 2.0))
+        self.assertIsNone(limit_for('get:actor'))
+        self.assertEqual(limit_for('get:film', 'get:actor'), (50.0, 100.0))
+
+    def test_shared_buckets(self):
+        client = FakeSharedClient()
+        one, two = rate_limit.SharedBackend(client), rate_limit.SharedBackend(client)
+        self.assertEqual(one.take('client|post:film', 1.0, 2.0), 0.0)
+        self.assertEqual(two.take('client|post:film', 1.0, 2.0), 0.0)
+        self.assertGreater(one.take('client|post:film', 1.0, 2.0), 0.0)
+        self.assertEqual(two.take('other|post:film', 1.0, 2.0), 0.0)
+
+    def test_list_endpoints_shed_load(self):
+        self.seed(films=1200, actors_per_film=0)
+        slots = rate_limit.list_slots
+        held = 0
+        while slots._semaphore.acquire(blocking=False):
+            held += 1
+        try:
+            res = self.client().get('/films', headers=self.headers)
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers['Retry-After'], '1')
+        finally:
+            for _ in range(held):
+                slots._semaphore.release()
+        self.assertEqual(held, slots.slots)
+        # A streamed export gives its slot back once sent
+        res = self.client().get('/films?stream=ndjson', headers=self.headers)
+        self.assertEqual(len(res.data.splitlines()), 1200)
+        self.assertEqual(self.client().get('/films', headers=self.headers).status_code, 200)
+        acquired = [slots._semaphore.acquire(blocking=False) for _ in range(slots.slots)]
+        for _ in range(sum(acquired)):
+            slots._semaphore.release()
+        self.assertTrue(all(acquired))
+
+
+class ReplicaTestCase(DatabaseTestCase):
+    """GETs read from the replica; writes, and reads by a client that just wrote, use the primary.
+
+    The "replica" is a second SQLite database that nothing replicates to, so which one a
+    request read from shows in what it returns.
+    """
+
+    def setUp(self):
+        os.environ['DATABASE_REPLICA_URLS'] = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'casting_test_replica.db')
+        try:
+            super().setUp()
+        finally:
+            del os.environ['DATABASE_REPLICA_URLS']
+        replicas.recent_writers.writers.clear()
+        secret = mock.patch('replicas.READ_YOUR_WRITES_SECRET', 'test-secret')
+        secret.start()
+        self.addCleanup(secret.stop)
+        with self.app.app_context():
+            self.replica = db.get_engine(self.app, bind='replica_0')
+            db.Model.metadata.drop_all(self.replica)
+            db.Model.metadata.create_all(self.replica)
+            with self.replica.begin() as conn:
+                conn.execute(Film.__table__.insert().values(name="Replicated", date_of_release='2001',
+                                                            updated_at=datetime.utcnow()))
+
+    def tearDown(self):
+        db.Model.metadata.drop_all(self.replica)
+        super().tearDown()
+
+    def film_names(self, client=None):
+        client = client or self.client()
+        return [film['name'] for film in client.get('/films', headers=self.headers).get_json()['films']]
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.film_names(), ["Replicated"])
+        exposition = self.client().get('/metrics').data.decode()
+        self.assertIn('db_query_duration_seconds_count{engine="replica_0"}', exposition)
+        self.assertIn('db_pool_checkouts{engine="replica_0"}', exposition)
+        self.assertIn('replica_0', self.client().get('/status').get_json()['replicas'])
+
+    def test_writer_reads_its_writes(self):
+        res = self.client().post('/film', headers=self.headers, json={'name': 'Written', 'date_of_release': '2001'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.film_names(), ["Written"])
+        # Once the window is over (or for any other client), reads go back to the replica
+        replicas.recent_writers.writers.clear()
+        cache.backend.clear()
+        self.assertEqual(self.film_names(), ["Replicated"])
+
+    def test_pin_travels_with_the_client(self):
+        client = self.client()
+        res = client.post('/film', headers=self.headers, json={'name': 'Written', 'date_of_release': '2001'})
+        self.assertIn(replicas.PIN_COOKIE + '=', res.headers['Set-Cookie'])
+        # The next request lands on a worker that didn't see the write
+        replicas.recent_writers.writers.clear()
+        self.assertEqual(self.film_names(client), ["Written"])
+        value = res.headers['Set-Cookie'].split(';')[0].split('=', 1)[1]
+        until, signature = value.split('.')
+        # A tampered or expired pin reads the replica
+        for cookie in ('%d.%s' % (int(until) + 1, signature),
+                       replicas.pin_cookie('auth0|local-test-user', int(1000 * time.time()) - 1)):
+            other = self.client()
+            other.set_cookie('localhost', replicas.PIN_COOKIE, cookie)
+            cache.backend.clear()
+            self.assertEqual(self.film_names(other), ["Replicated"])
+
+    def test_no_replica_reads_without_a_way_to_share_pins(self):
+        with mock.patch('replicas.READ_YOUR_WRITES_SECRET', None):
+            self.assertEqual(self.film_names(), [])
+
+    def test_replica_reads_right_after_a_write_are_not_cached(self):
+        self.client().post('/film', headers=self.headers, json={'name': 'Written', 'date_of_release': '2001'})
+        replicas.recent_writers.writers.clear()
+        self.assertEqual(self.film_names(), ["Replicated"])
+        with self.replica.begin() as conn:
+            conn.execute(Film.__table__.update().values(name="Caught up"))
+        self.assertEqual(self.film_names(), ["Caught up"])
+
+
+class CostarGraphTestCase(DatabaseTestCase):
+    """Co-stars and degrees of separation, from the in-memory index kept up to date through the change log."""
+
+    def setUp(self):
+        super().setUp()
+        # Films 1-3 and actors 1-5: 1 and 2 in film 1, 2 and 3 in film 2, 3 and 4 in film 3; 5 in nothing
+        self.client().post('/films', headers=self.headers,
+                           json=[{'name': 'Film %d' % i, 'date_of_release': '2001'} for i in range(1, 4)])
+        self.client().post('/actors', headers=self.headers,
+                           json=[{'name': 'Actor %d' % i, 'gender': 'Female', 'age': 30} for i in range(1, 6)])
+        self.cast((1, 1), (1, 2), (2, 2), (2, 3), (3, 3), (3, 4))
+        costar_graph.graph.start_build(self.app).join()
+
+    def cast(self, *links):
+        res = self.client().post('/casting', headers=self.headers,
+                                 json=[{'film_id': film_id, 'actor_id': actor_id} for film_id, actor_id in links])
+        self.assertEqual(res.status_code, 200)
+
+    def path(self, source, target, query=''):
+        res = self.client().get('/actors/%d/path/%d%s' % (source, target, query), headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        body = res.get_json()
+        return body['degrees'], [actor['id'] for actor in body['actors']], [film['id'] for film in body['films']]
+
+    def test_costars(self):
+        self.cast((1, 3))
+        body = self.client().get('/actors/3/costars', headers=self.headers).get_json()
+        self.assertEqual(body['total'], 3)
+        self.assertEqual([(actor['id'], actor['shared_films']) for actor in body['costars']], [(2, 2), (1, 1), (4, 1)])
+        self.assertEqual(body['costars'][0]['name'], 'Actor 2')
+        limited = self.client().get('/actors/3/costars?limit=1', headers=self.headers).get_json()
+        self.assertEqual([actor['id'] for actor in limited['costars']], [2])
+        self.assertEqual(self.client().get('/actors/99/costars', headers=self.headers).status_code, 404)
+        self.assertEqual(self.client().get('/actors/3/costars?limit=0', headers=self.headers).status_code, 400)
+
+    def test_shortest_path(self):
+        self.assertEqual(self.path(1, 4), (3, [1, 2, 3, 4], [1, 2, 3]))
+        self.assertEqual(self.path(4, 1), (3, [4, 3, 2, 1], [3, 2, 1]))
+        self.assertEqual(self.path(2, 2), (0, [2], []))
+        self.assertEqual(self.path(1, 5), (None, [], []))
+        self.assertEqual(self.path(1, 4, '?max_degrees=2'), (None, [], []))
+        self.assertEqual(self.client().get('/actors/1/path/99', headers=self.headers).status_code, 404)
+
+    def test_casting_changes_update_the_index(self):
+        self.assertEqual(self.path(1, 4)[0], 3)
+        self.cast((1, 4))
+        self.assertEqual(self.path(1, 4), (1, [1, 4], [1]))
+        with self.app.app_context():
+            Film.query.get(1).delete()
+        self.assertEqual(self.path(1, 4), (None, [], []))
+        self.assertEqual(self.path(2, 4)[0], 2)
+        # Caught up from the change log, not rebuilt (the first catch-up replays the writes during the build)
+        self.assertEqual((costar_graph.graph.builds, costar_graph.graph.catch_ups), (1, 3))
+
+    def test_unavailable_until_built(self):
+        costar_graph.graph.reset()
+        with mock.patch.object(costar_graph.graph, 'start_build') as start_build:
+            res = self.client().get('/actors/1/costars', headers=self.headers)
+        self.assertEqual((res.status_code, res.headers['Retry-After']), (503, str(costar_graph.COSTAR_RETRY_AFTER)))
+        start_build.assert_called_once()
+        costar_graph.graph.start_build(self.app).join()
+        self.assertEqual(self.path(1, 4)[0], 3)
+
+    def test_catch_up_waits_for_earlier_commits(self):
+        self.assertEqual(self.path(1, 5)[0], None)
+
+        def commit(*entries):
+            with self.app.app_context():
+                db.session.execute(change_log.insert(),
+                                   [dict(change_rows(kind, [id])[0], seq=seq) for seq, kind, id in entries])
+                db.session.commit()
+                notify_write('cast')
+
+        with self.app.app_context():
+            db.session.execute(film_actors.insert(), [{'film_id': 3, 'actor_id': 5}, {'film_id': 1, 'actor_id': 5}])
+            seq = db.session.execute(select(func.max(change_log.c.seq))).scalar()
+            db.session.commit()
+        # Casting actor 5 in film 1 was logged first, but commits after casting them in film 3
+        commit((seq + 3, 'actor', 5), (seq + 4, 'film', 3))
+        self.assertEqual(self.path(1, 5)[0], None)
+        commit((seq + 1, 'actor', 5), (seq + 2, 'film', 1))
+        self.assertEqual(self.path(1, 5), (1, [1, 5], [1]))
+
+    def test_compaction(self):
+        graph = costar_graph.CostarGraph()
+        graph.load([(1, 1), (1, 2), (2, 2), (2, 3)])
+        # Actor 3 leaves film 2 for film 5, with actor 2
+        graph.films.replace(2, [1, 2, 5])
+        graph.films.replace(3, [5])
+        graph.casts.replace(2, [2])
+        graph.casts.replace(5, [3, 2])
+        self.assertEqual(graph.path(1, 3), ([1, 2, 3], [1, 5]))
+        compacted = (graph.films.compacted(), graph.casts.compacted())
+        self.assertEqual(({}, {}), (compacted[0].replaced, compacted[1].replaced))
+        self.assertEqual([list(compacted[1].row(id)) for id in range(6)], [[], [1, 2], [2], [], [], [2, 3]])
+        self.assertEqual(compacted[1].links(), graph.casts.links())
+
+
+class SetWriteTestCase(DatabaseTestCase):
+    """PATCH and DELETE write by id or by search, one statement per chunk, without loading the rows."""
+
+    def setUp(self):
+        super().setUp()
+        self.seed(films=2, actors_per_film=2)   # film 1: actors 1, 2; film 2: actors 3, 4
+
+    def send(self, method, url, body=None):
+        return self.client().open(url, method=method, headers=self.headers, json=body)
+
+    def statements(self, method, url, body):
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual(self.send(method, url, body).status_code, 200)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        return statements
+
+    def test_patch_one(self):
+        res = self.send('PATCH', '/actors/1', {'age': 41})
+        self.assertEqual(res.status_code, 200)
+        actor = res.get_json()['actor']
+        self.assertEqual(actor, {'id': 1, 'name': "Actor", 'gender': "Female", 'age': 41})
+        listed = self.client().get('/actors?fields=age,version', headers=self.headers).get_json()['actors']
+        self.assertEqual(listed[0], {'id': 1, 'age': 41, 'version': 2})
+        film = self.send('PATCH', '/films/2', {'date_of_release': '1999-05-01'}).get_json()['film']
+        self.assertEqual((film['name'], film['date_of_release']), ("Film", '1999-05-01'))
+        found = self.client().get('/films?released_before=1999-12-31', headers=self.headers).get_json()['films']
+        self.assertEqual([film['id'] for film in found], [2])
+        self.assertEqual(self.send('PATCH', '/actors/99', {'age': 41}).status_code, 404)
+        self.assertEqual(self.send('PATCH', '/actors/1', {'film_count': 3}).status_code, 400)
+        for age in ('old', 41.5, False):
+            self.assertEqual(self.send('PATCH', '/actors/1', {'age': age}).status_code, 400)
+        self.assertEqual(self.send('PATCH', '/actors/1', {}).status_code, 400)
+
+    def test_patch_many(self):
+        res = self.send('PATCH', '/actors', {'ids': [2, 3, 99], 'changes': {'gender': 'Male'}}).get_json()
+        self.assertEqual((res['updated'], res['ids']), (2, [2, 3]))
+        res = self.send('PATCH', '/actors?gender=Male', {'changes': {'age': 50}}).get_json()
+        self.assertEqual(res['ids'], [2, 3])
+        ages = {actor['id']: actor['age'] for actor in self.client().get('/actors', headers=self.headers).get_json()['actors']}
+        self.assertEqual(ages, {1: 30, 2: 50, 3: 50, 4: 30})
+        self.assertEqual(self.send('PATCH', '/actors', {'changes': {'age': 50}}).status_code, 400)
+        self.assertEqual(self.send('PATCH', '/actors?gender=Male', {'ids': [1], 'changes': {'age': 5}}).status_code, 400)
+
+    def test_statements_do_not_grow_with_rows(self):
+        self.seed(films=1, actors_per_film=20)
+        few = self.statements('PATCH', '/actors', {'ids': [1, 2], 'changes': {'age': 40}})
+        many = self.statements('PATCH', '/actors', {'ids': list(range(1, 25)), 'changes': {'age': 40}})
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(len(self.statements('DELETE', '/films', {'ids': [1]})),
+                         len(self.statements('DELETE', '/films', {'ids': [2, 3]})))
+
+    def test_delete_cascades_links(self):
+        res = self.send('DELETE', '/films/1')
+        self.assertEqual(res.get_json()['ids'], [1])
+        self.assertEqual(self.send('DELETE', '/films/1').status_code, 404)
+        with self.app.app_context():
+            self.assertEqual(db.session.query(film_actors).count(), 2)
+            counts = {actor.id: (actor.film_count, actor.version) for actor in Actor.query}
+        self.assertEqual(counts, {1: (0, 2), 2: (0, 2), 3: (1, 1), 4: (1, 1)})
+        changes = self.client().get('/changes', headers=self.headers).get_json()
+        self.assertEqual(changes['deleted']['films'], [1])
+        self.assertEqual([actor['id'] for actor in changes['actors']], [1, 2])
+
+        res = self.send('DELETE', '/actors?min_age=25').get_json()
+        self.assertEqual((res['deleted'], res['ids']), (4, [1, 2, 3, 4]))
+        with self.app.app_context():
+            self.assertEqual(db.session.query(film_actors).count(), 0)
+            self.assertEqual(Film.query.get(2).cast_count, 0)
+        self.assertEqual(self.send('DELETE', '/actors').status_code, 400)
+
+
+class ImportJobTestCase(DatabaseTestCase):
+    """Uploads are queued and answered at once; a worker loads them in checkpointed chunks."""
+
+    def setUp(self):
+        super().setUp()
+        import_jobs.queue = self.queue = import_jobs.LocalQueue()
+        self.worker = import_jobs.Worker(self.queue, chunk_rows=2)
+
+    def tearDown(self):
+        import_jobs.queue = import_jobs.queue_from_env()
+        super().tearDown()
+
+    def upload(self, kind, body, content_type='text/csv'):
+        res = self.client().post('/imports/' + kind, headers={**self.headers, 'Content-Type': content_type}, data=body)
+        self.assertEqual(res.status_code, 202)
+        self.assertTrue(res.headers['Location'].endswith('/imports/%d' % res.get_json()['job']['id']))
+        return res.get_json()['job']
+
+    def job(self, job_id):
+        return self.client().get('/imports/%d' % job_id, headers=self.headers).get_json()['job']
+
+    def test_csv_import(self):
+        job = self.upload('actors', 'name,gender,age\nAnn,Female,30\nBob,Male,old\n\n"Cy, Jr",Male,40\nDee,Female,22\n')
+        self.assertEqual((job['status'], job['processed']), ('queued', 0))
+        self.assertTrue(self.worker.run_once())
+        self.assertFalse(self.worker.run_once())
+        job = self.job(job['id'])
+        self.assertEqual((job['status'], job['processed'], job['created'], job['rejected'], job['progress']),
+                         ('done', 4, 3, 1, 1.0))
+        self.assertEqual(job['errors'], ["row 2: 'age' is missing or not a valid int"])
+        names = [actor['name'] for actor in self.client().get('/actors', headers=self.headers).get_json()['actors']]
+        self.assertEqual(names, ['Ann', 'Cy, Jr', 'Dee'])
+
+    def test_csv_quoted_newlines(self):
+        body = ('name,gender,age\n"Ann\nMarie",Female,30\n"Bob ""B""\n\nJr",Male,40\nCy,Male,\n'
+                '"Dee\nDoe",Female,22\n')
+        job = self.upload('actors', body)
+        self.worker.run_once()
+        job = self.job(job['id'])
+        self.assertEqual((job['status'], job['processed'], job['created'], job['rejected']), ('done', 4, 3, 1))
+        self.assertEqual(job['errors'], ["row 3: 'age' is missing or not a valid int"])
+        # The chunk of two rows ends at the byte after the second multi-line record
+        self.assertEqual(job['position'], len(body))
+        names = [actor['name'] for actor in self.client().get('/actors', headers=self.headers).get_json()['actors']]
+        self.assertEqual(names, ['Ann\nMarie', 'Bob "B"\n\nJr', 'Dee\nDoe'])
+
+    def test_csv_checkpoints_fall_between_records(self):
+        body = b'name,gender,age\n"Ann\nMarie",Female,30\n"Bob\nJr",Male,40\n'
+        ends = [end for end, _ in import_jobs.records(body, 'csv', 0)]
+        self.assertEqual(ends, [body.index(b'"Bob'), len(body)])
+        resumed = list(import_jobs.records(body, 'csv', ends[0]))
+        self.assertEqual(resumed, [(len(body), {'name': 'Bob\nJr', 'gender': 'Male', 'age': '40'})])
+
+    def test_ndjson_casting_import(self):
+        self.seed(films=1, actors_per_film=1)
+        self.client().post('/actor', headers=self.headers, json={'name': 'Second', 'gender': 'Male', 'age': 50})
+        lines = ['{"film_id": 1, "actor_id": 2}', '{"film_id": 1, "actor_id": 9}', 'not json']
+        job = self.upload('casting', '\n'.join(lines), 'application/x-ndjson')
+        self.worker.run_once()
+        job = self.job(job['id'])
+        self.assertEqual((job['created'], job['rejected']), (1, 2))
+        self.assertEqual(job['errors'][0], "row 2: unknown actor_id 9")
+        cast = self.client().get('/films/1/actors', headers=self.headers).get_json()['actors']
+        self.assertEqual([actor['id'] for actor in cast], [1, 2])
+
+    def test_stopped_worker_is_resumed_from_its_checkpoint(self):
+        rows = ''.join('Film %d,2001\n' % i for i in range(5))
+        job = self.upload('films', 'name,date_of_release\n' + rows)
+        listener = on_write(lambda tags: self.worker.stop())
+        try:
+            self.worker.run_once()
+        finally:
+            write_listeners.remove(listener)
+        progress = self.job(job['id'])
+        self.assertEqual((progress['status'], progress['processed'], progress['created']), ('queued', 2, 2))
+        self.assertGreater(progress['position'], 0)
+
+        # The next worker carries on after the two rows already loaded
+        self.queue.push(job['id'])
+        import_jobs.Worker(self.queue, chunk_rows=2).run_once()
+        self.assertEqual(self.job(job['id'])['created'], 5)
+        films = self.client().get('/films', headers=self.headers).get_json()['films']
+        self.assertEqual([film['name'] for film in films], ['Film %d' % i for i in range(5)])
+
+    def test_only_one_worker_runs_a_job(self):
+        job = self.upload('actors', 'name,gender,age\nAnn,Female,30\n')
+        with self.app.app_context():
+            self.assertTrue(import_jobs.claim(job['id']))
+            self.assertFalse(import_jobs.claim(job['id']))
+            with mock.patch.object(import_jobs, 'IMPORT_LEASE_SECONDS', -1):
+                self.assertTrue(import_jobs.claim(job['id']))
+
+    def test_failed_runs_are_retried_after_a_back_off(self):
+        job = self.upload('films', 'name,date_of_release\nA,2001\nB,2001\nC,2001\n')
+        lost = OperationalError('INSERT', {}, Exception('server closed the connection'))
+        load_chunk, chunks = import_jobs.load_chunk, []
+
+        def second_chunk_fails(*args):
+            chunks.append(args)
+            if len(chunks) == 2:
+                raise lost
+            return load_chunk(*args)
+        with mock.patch.object(import_jobs, 'load_chunk', second_chunk_fails):
+            self.worker.run_once()
+        progress = self.job(job['id'])
+        self.assertEqual((progress['status'], progress['attempts'], progress['created']), ('queued', 1, 2))
+        self.assertIsNotNone(progress['retry_at'])
+        with self.app.app_context():
+            self.assertFalse(import_jobs.claim(job['id']))   # not before the back-off is over
+
+        with self.app.app_context():
+            db.session.execute(import_jobs.import_jobs.update().values(retry_at=datetime.utcnow()))
+            db.session.commit()
+        self.queue.push(job['id'])
+        self.worker.run_once()
+        progress = self.job(job['id'])
+        self.assertEqual((progress['status'], progress['attempts'], progress['created']), ('done', 1, 3))
+
+    def test_failed_for_good(self):
+        with mock.patch.object(import_jobs, 'IMPORT_RETRY_SECONDS', 0), \
+                mock.patch.object(import_jobs, 'IMPORT_MAX_ATTEMPTS', 2), \
+                mock.patch.object(import_jobs, 'load_chunk',
+                                  side_effect=OperationalError('INSERT', {}, Exception('timeout'))):
+            job = self.upload('films', 'name,date_of_release\nA,2001\n')
+            self.assertTrue(self.worker.run_once())
+            self.assertEqual(self.job(job['id'])['status'], 'queued')
+            self.assertTrue(self.worker.run_once())
+        progress = self.job(job['id'])
+        self.assertEqual((progress['status'], progress['attempts']), ('failed', 2))
+        self.assertIn('OperationalError', progress['errors'][0])
+
+        # An error retrying wouldn't fix fails the job at once
+        with mock.patch.object(import_jobs, 'load_chunk', side_effect=KeyError('kind')):
+            job = self.upload('films', 'name,date_of_release\nA,2001\n')
+            self.worker.run_once()
+        self.assertEqual((self.job(job['id'])['status'], self.job(job['id'])['attempts']), ('failed', 1))
+
+    def test_upload_errors(self):
+        headers = {**self.headers, 'Content-Type': 'application/json'}
+        self.assertEqual(self.client().post('/imports/films', headers=headers, data='[]').status_code, 400)
+        self.assertEqual(self.client().post('/imports/films?format=csv', headers=headers, data=' ').status_code, 400)
+        job = self.upload('films', 'name,date_of_release\nA,2001\n')
+        with self.app.app_context():
+            db.session.execute(import_jobs.import_jobs.update().values(owner='auth0|someone-else'))
+            db.session.commit()
+        # Only the uploader can see a job
+        self.assertEqual(self.client().get('/imports/%d' % job['id'], headers=self.headers).status_code, 404)
+
+
+@unittest.skipIf(aiosqlite is None, 'aiosqlite is not installed (requirements-async.txt)')
+class AsyncAppTestCase(DatabaseTestCase, unittest.IsolatedAsyncioTestCase):
+    """The ASGI app (asgi.py), driven through ASGI calls on aiosqlite."""
+
+    def setUp(self):
+        super().setUp()
+        idempotency.store.clear()
+        self.asgi = asgi.AsyncCastingApp(os.environ['DATABASE_URL'], AUTH_CONFIG)
+
+    async def asyncSetUp(self):
+        # The server's side of the lifespan protocol: one task for the app's whole life
+        self.events, self.completed = asyncio.Queue(), asyncio.Queue()
+        self.lifespan = asyncio.create_task(self.asgi({'type': 'lifespan'}, self.events.get, self.completed.put))
+        await self.events.put({'type': 'lifespan.startup'})
+        self.assertEqual((await self.completed.get())['type'], 'lifespan.startup.complete')
+
+    async def asyncTearDown(self):
+        await self.events.put({'type': 'lifespan.shutdown'})
+        self.assertEqual((await self.completed.get())['type'], 'lifespan.shutdown.complete')
+        await self.lifespan
+
+    async def call(self, method, path, body=None, query='', headers=None):
+        """(status, headers, body) of one request; `body` is sent as JSON."""
+        headers = self.headers if headers is None else headers
+        chunks = [json.dumps(body).encode()[:10], json.dumps(body).encode()[10:]] if body is not None else [b'']
+        async def receive():
+            return {'type': 'http.request', 'body': chunks.pop(0), 'more_body': bool(chunks)}
+        sent = []
+        async def send(message):
+            sent.append(message)
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+                 'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+                 'client': ('127.0.0.1', 50000)}
+        await self.asgi(scope, receive, send)
+        self.assertEqual([message['type'] for message in sent], ['http.response.start', 'http.response.body'])
+        response_headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+        self.assertEqual(int(response_headers['content-length']), len(sent[1]['body']))
+        return sent[0]['status'], response_headers, json.loads(sent[1]['body'] or b'null')
+
+    async def test_list_page(self):
+        self.seed(films=3, actors_per_film=1)
+        status, headers, body = await self.call('GET', '/films', query='limit=2&fields=name')
+        self.assertEqual((status, headers['content-type']), (200, 'application/json'))
+        self.assertEqual(body, {'Success': 'True', 'films': [{'id': 1, 'name': 'Film'}, {'id': 2, 'name': 'Film'}],
+                                'next': 2})
+        _, _, body = await self.call('GET', '/films', query='after=2&include=cast')
+        self.assertEqual([(film['id'], [actor['id'] for actor in film['actors']]) for film in body['films']],
+                         [(3, [3])])
+        status, _, body = await self.call('GET', '/films', query='limit=0')
+        self.assertEqual((status, body['Error']), (400, 400))
+
+    async def test_post_writes_the_row_and_the_change_log(self):
+        status, _, body = await self.call('POST', '/actor', {'name': 'Ann', 'gender': 'Female', 'age': 30})
+        self.assertEqual((status, body['actor']), (200, {'id': 1, 'name': 'Ann', 'gender': 'Female', 'age': 30}))
+        status, _, _ = await self.call('POST', '/actor', {'name': 'Bob', 'gender': 'Male', 'age': 3.5})
+        self.assertEqual(status, 400)
+        with self.app.app_context():
+            self.assertEqual([actor.name for actor in Actor.query.all()], ['Ann'])
+            self.assertEqual(db.session.execute(change_log.select()).all()[0][1:3], ('actor', 1))
+
+    async def test_auth_errors(self):
+        status, _, body = await self.call('GET', '/films', headers={})
+        self.assertEqual((status, body['Error']), (401, 401))
+        status, _, _ = await self.call('GET', '/films', headers={'Authorization': 'Token abc'})
+        self.assertEqual(status, 401)
+        token = make_token(['get:actor'])
+        status, _, body = await self.call('POST', '/film', {'name': 'F', 'date_of_release': '2001'},
+                                          headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual((status, body['Error']), (403, 403))
+
+    async def test_not_found_and_method_not_allowed(self):
+        self.assertEqual((await self.call('GET', '/no-such-endpoint'))[0], 404)
+        self.assertEqual((await self.call('GET', '/films/99/actors'))[0], 404)
+        status, _, body = await self.call('DELETE', '/film')
+        self.assertEqual((status, body['Message']), (405, 'Method Not Allowed.'))
+        # Endpoints only the Flask app serves say so
+        status, _, body = await self.call('GET', '/changes')
+        self.assertEqual((status, body['Message']),
+                         (404, 'GET /changes is only served by the Flask app (gunicorn app:app).'))
+        self.assertEqual((await self.call('PATCH', '/films', {'ids': [1]}))[0], 405)
+        self.assertEqual((await self.call('DELETE', '/actors/1'))[0], 404)
+        self.assertEqual((await self.call('GET', '/films', query='stream=ndjson'))[0], 400)
+
+    async def test_batch_posts(self):
+        status, _, body = await self.call('POST', '/films', [{'name': 'F%d' % i, 'date_of_release': '2001'}
+                                                             for i in range(3)])
+        self.assertEqual((status, body), (200, {'Success': 'True', 'created': 3, 'ids': [1, 2, 3]}))
+        status, _, body = await self.call('POST', '/actors', {'actors': [{'name': 'A', 'gender': 'Male', 'age': 40}]})
+        self.assertEqual((status, body['ids']), (200, [1]))
+        self.assertEqual((await self.call('POST', '/actors', [{'name': 'A', 'gender': 'Male', 'age': 'x'}]))[0], 400)
+        links = [{'film_id': 1, 'actor_id': 1}, {'film_id': 2, 'actor_id': 1}]
+        status, _, body = await self.call('POST', '/casting', links + links[:1])
+        self.assertEqual((status, body['created']), (200, 2))
+        self.assertEqual((await self.call('POST', '/casting', links))[2]['created'], 0)
+        status, _, body = await self.call('POST', '/casting', [{'film_id': 9, 'actor_id': 1}])
+        self.assertEqual((status, body['Message']), (400, 'Unknown film_id(s): 9'))
+        _, _, body = await self.call('GET', '/actors', query='fields=film_count,version')
+        self.assertEqual(body['actors'], [{'id': 1, 'film_count': 2, 'version': 2}])
+        with self.app.app_context():
+            self.assertEqual(db.session.execute(select(func.count()).select_from(change_log)).scalar(), 7)
+
+    async def test_idempotency_key_replay(self):
+        headers = dict(self.headers, **{'Idempotency-Key': 'async-1'})
+        film = {'name': 'Once', 'date_of_release': '2001'}
+        first = await self.call('POST', '/film', film, headers=headers)
+        self.assertEqual(first[0], 200)
+        idempotency.store.clear()   # replayed from the database, as another worker would
+        again = await self.call('POST', '/film', film, headers=headers)
+        self.assertEqual((again[0], again[2]), (200, first[2]))
+        self.assertEqual(again[1]['idempotent-replayed'], 'true')
+        status, _, _ = await self.call('POST', '/film', dict(film, name='Other'), headers=headers)
+        self.assertEqual(status, 422)
+        with self.app.app_context():
+            self.assertEqual(Film.query.count(), 1)
+
+
+class CompressionTestCase(DatabaseTestCase):
+    """Large responses are compressed as negotiated; cached entries keep their compressed bytes."""
+
+    def get(self, url, **headers):
+        res = self.client().get(url, headers={**self.headers, **headers})
+        self.assertEqual(res.status_code, 200)
+        return res
+
+    def test_cached_list_is_compressed_once(self):
+        self.seed(films=50, actors_per_film=0)
+        plain = self.get('/films').data
+        compressed_before = dict(compression.stats.compressed)
+        count, _ = self.count_statements('/films')
+        res = self.get('/films', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertTrue(res.headers['ETag'].endswith('-gzip"'))
+        self.assertLess(len(res.data), len(plain) / 3)
+        self.assertEqual(gzip.decompress(res.data), plain)
+        # Served from the stored variant: nothing compressed, nothing queried
+        self.assertEqual(compression.stats.compressed, compressed_before)
+        self.assertEqual(count, 0)
+        res = self.client().get('/films', headers={**self.headers, 'Accept-Encoding': 'gzip',
+                                                   'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_brotli_is_preferred(self):
+        self.seed(films=50, actors_per_film=0)
+        plain = self.get('/films').data
+        res = self.get('/films', **{'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertEqual(compression.brotli.decompress(res.data), plain)
+        res = self.get('/films', **{'Accept-Encoding': 'gzip, br;q=0.5'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+
+    def test_uncached_entry_is_compressed_only_as_negotiated(self):
+        self.seed(films=50, actors_per_film=0)
+        cache.backend = LRUBackend(ttl=0)
+
+        def compressed_by(request_headers):
+            before = {encoding: totals[0] for encoding, totals in compression.stats.compressed.items()}
+            res = self.get('/films', **request_headers)
+            counts = {encoding: totals[0] - before.get(encoding, 0)
+                      for encoding, totals in compression.stats.compressed.items()}
+            return res, {encoding: count for encoding, count in counts.items() if count}
+
+        res, compressed = compressed_by({})
+        self.assertEqual((compressed, res.headers.get('Content-Encoding')), ({}, None))
+        res, compressed = compressed_by({'Accept-Encoding': 'gzip'})
+        self.assertEqual((compressed, res.headers['Content-Encoding']), ({'gzip': 1}, 'gzip'))
+        self.assertEqual(cache.backend.entries, {})
+        res = self.client().get('/films', headers={**self.headers, 'Accept-Encoding': 'gzip',
+                                                   'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_small_bodies_are_not_compressed(self):
+        self.seed(films=1, actors_per_film=0)
+        res = self.get('/films?limit=1', **{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_export_stream_is_compressed(self):
+        self.seed(films=1200, actors_per_film=0)
+        plain = self.get('/films?stream=ndjson').data
+        res = self.get('/films?stream=ndjson', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.data), plain)
+
+
+class WarmUpTestCase(DatabaseTestCase):
+    """GET /ready passes only in a worker that has warmed up; connections never cross a fork."""
+
+    def setUp(self):
+        super().setUp()
+        warmup.readiness.__init__()
+
+    def tearDown(self):
+        if warmup.readiness.retry is not None:
+            warmup.readiness.retry.cancel()
+        super().tearDown()
+
+    def test_ready_once_warm(self):
+        self.assertTrue(warmup.warm_worker(self.app))
+        res = self.client().get('/ready')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['checks'], {'jwks': True, 'database': True})
+
+    def test_ready_only_reports(self):
+        with mock.patch('warmup.warm_worker') as warm_worker:
+            res = self.client().get('/ready')
+        self.assertEqual(res.status_code, 503)
+        warm_worker.assert_not_called()
+        self.assertFalse(warmup.readiness.ready)
+
+    def test_failed_step_is_retried_on_a_timer(self):
+        with mock.patch('warmup.ping', side_effect=OSError('database unreachable')), \
+                mock.patch.object(warmup, 'WARM_UP_RETRY_SECONDS', 3600):
+            self.assertFalse(warmup.warm_worker(self.app))
+        res = self.client().get('/ready')
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.get_json()['checks']['database'], False)
+        # ...and the timer tries again
+        retry = warmup.readiness.retry
+        self.assertTrue(retry.is_alive())
+        retry.cancel()
+        retry.function(*retry.args, **retry.kwargs)
+        self.assertEqual(self.client().get('/ready').status_code, 200)
+
+    def test_state_inherited_from_another_process_is_not_ready(self):
+        warmup.warm_worker(self.app)
+        warmup.readiness.pid = os.getpid() + 1
+        self.assertFalse(warmup.readiness.ready)
+
+    def test_master_closes_its_connections_before_forking(self):
+        with self.app.app_context():
+            engine = db.engine
+            engine.connect().close()
+            checks = warmup.warm_master(self.app)
+            self.assertEqual(checks, {'jwks': True, 'mappers': True})
+            if isinstance(engine.pool, QueuePool):
+                self.assertEqual(engine.pool.checkedin(), 0)
+
+
+class MetricsTestCase(DatabaseTestCase):
+    """/metrics has latency histograms per endpoint, per phase and per engine, in the Prometheus text format."""
+
+    def setUp(self):
+        super().setUp()
+        self.seed(films=2, actors_per_film=1)
+        for histogram in (metrics.request_latency, metrics.phase_latency, metrics.query_latency):
+            histogram.series.clear()
+
+    def exposition(self):
+        res = self.client().get('/metrics')
+        self.assertEqual(res.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        return res.get_data(as_text=True).splitlines()
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram('test_seconds', 'A test.', ('endpoint',), buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(seconds, '/films')
+        self.assertEqual(histogram.exposition(), [
+            '# HELP test_seconds A test.', '# TYPE test_seconds histogram',
+            'test_seconds_bucket{endpoint="/films",le="0.1"} 2',
+            'test_seconds_bucket{endpoint="/films",le="1"} 3',
+            'test_seconds_bucket{endpoint="/films",le="+Inf"} 4',
+            'test_seconds_sum{endpoint="/films"} 5.650000',
+            'test_seconds_count{endpoint="/films"} 4'])
+
+    def test_request_phase_and_query_histograms(self):
+        statements, _ = self.count_statements('/films')
+        self.client().get('/films/99/actors', headers=self.headers)
+        self.client().get('/no-such-endpoint')
+        lines = self.exposition()
+        for line in ('http_request_duration_seconds_count{endpoint="/films",method="GET",status="200"} 1',
+                     'http_request_duration_seconds_bucket{endpoint="/films",method="GET",status="200",le="+Inf"} 1',
+                     'http_request_duration_seconds_count{endpoint="/films/<int:film_id>/actors",method="GET",'
+                     'status="404"} 1',
+                     'http_request_duration_seconds_count{endpoint="unmatched",method="GET",status="404"} 1',
+                     'http_request_phase_seconds_count{endpoint="/films",phase="auth_header"} 1',
+                     'http_request_phase_seconds_count{endpoint="/films",phase="db"} 1',
+                     'http_request_phase_seconds_count{endpoint="/films",phase="serialise"} 1',
+                     '# TYPE db_query_duration_seconds histogram'):
+            self.assertIn(line, lines)
+        # Every statement of the /films request, plus the 404's lookup
+        self.assertIn('db_query_duration_seconds_count{engine="primary"} %d' % (statements + 1), lines)
+        buckets = [line for line in lines if line.startswith('http_request_duration_seconds_bucket{endpoint="/films",')]
+        self.assertEqual(len(buckets), len(metrics.BUCKETS) + 1)
+
+
+class StatusTestCase(DatabaseTestCase):
+
+    def test_status_reports_the_pool(self):
+        self.seed(films=1, actors_per_film=1)
+        self.client().get('/films', headers=self.headers)
+        body = self.client().get('/status').get_json()
+        self.assertEqual((body['Success'], body['replicas']), ('True', {}))
+        self.assertGreater(body['database']['checkouts'], 0)
+        self.assertIn('checkout_wait_avg_ms', body['database'])
+
+
+class PoolOptionsTestCase(unittest.TestCase):
+    """Pool settings come from the defaults, then DB_POOL_*, then overrides; pools time their checkouts."""
+
+    def test_defaults(self):
+        with mock.patch.dict(os.environ, {name: '' for name, _ in db_pool.POOL_ENV.values()}):
+            options = db_pool.engine_options('postgresql://localhost/casting')
+        self.assertEqual(options, dict(db_pool.POOL_DEFAULTS, poolclass=db_pool.TimedQueuePool))
+
+    def test_environment_and_overrides(self):
+        env = {'DB_POOL_SIZE': '10', 'DB_MAX_OVERFLOW': '0', 'DB_POOL_TIMEOUT': '2.5',
+               'DB_POOL_RECYCLE': '60', 'DB_POOL_PRE_PING': 'no'}
+        with mock.patch.dict(os.environ, env):
+            options = db_pool.engine_options('postgresql://localhost/casting', pool_size=3)
+        self.assertEqual((options['pool_size'], options['max_overflow'], options['pool_timeout'],
+                          options['pool_recycle'], options['pool_pre_ping']), (3, 0, 2.5, 60, False))
+        with mock.patch.dict(os.environ, {'DB_POOL_PRE_PING': 'True'}):
+            self.assertTrue(db_pool.engine_options('postgresql://localhost/casting')['pool_pre_ping'])
+
+    def test_sqlite_keeps_its_own_pool(self):
+        with mock.patch.dict(os.environ, {'DB_POOL_SIZE': '10'}):
+            options = db_pool.engine_options('sqlite:///casting.db')
+        for option in db_pool.QUEUE_POOL_ONLY + ('poolclass',):
+            self.assertNotIn(option, options)
+        self.assertIn('pool_recycle', options)
+
+    def test_checkout_metrics(self):
+        engine = create_engine('sqlite://', poolclass=db_pool.TimedQueuePool, pool_size=1, max_overflow=0,
+                               pool_timeout=0.05)
+        metrics = db_pool.instrument(engine)
+        held = engine.connect()
+        with self.assertRaises(PoolTimeoutError):
+            engine.connect()
+        held.close()
+        engine.connect().close()
+        stats = metrics.snapshot(engine.pool)
+        self.assertEqual((stats['pool'], stats['checkouts'], stats['connects'], stats['connect_errors'],
+                          stats['checkout_timeouts']), ('TimedQueuePool', 3, 1, 0, 1))
+        self.assertGreaterEqual(stats['checkout_wait_max_ms'], 50)
+        self.assertEqual((stats['size'], stats['checked_out'], stats['idle']), (1, 0, 1))
+        engine.dispose()
+
+    def test_connect_failures_are_not_timeouts(self):
+        def refuse():
+            raise sqlite3.OperationalError('unable to open database file')
+        engine = create_engine('sqlite://', poolclass=db_pool.TimedQueuePool, creator=refuse)
+        metrics = db_pool.instrument(engine)
+        with self.assertRaises(OperationalError):
+            engine.connect()
+        stats = metrics.snapshot(engine.pool)
+        self.assertEqual((stats['connect_errors'], stats['checkout_timeouts'], stats['connects']), (1, 0, 0))
+        engine.dispose()
+
+
+class ForkedPoolTestCase(unittest.TestCase):
+    """A connection opened in another process is discarded, not reused or closed."""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.engine = create_engine('sqlite:///' + self.path, poolclass=QueuePool)
+        db_pool.guard_fork(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_connection_from_another_process_is_replaced(self):
+        with self.engine.connect() as connection:
+            record = connection.connection._connection_record
+            inherited = connection.connection.connection
+        record.info['pid'] = os.getpid() + 1
+        with self.engine.connect() as connection:
+            self.assertIsNot(connection.connection.connection, inherited)
+            self.assertEqual(connection.scalar('SELECT 1'), 1)
+        # Still open: it belongs to the other process
+        self.assertEqual(inherited.execute('SELECT 1').fetchone(), (1,))
+
+    def test_after_fork_starts_an_empty_pool(self):
+        with self.engine.connect() as connection:
+            inherited = connection.connection.connection
+        old_pool = self.engine.pool
+        db_pool.after_fork(self.engine)
+        self.assertIsNot(self.engine.pool, old_pool)
+        self.assertIn(old_pool, db_pool.inherited_pools)
+        self.assertEqual(self.engine.pool.checkedin(), 0)
+        self.assertEqual(inherited.execute('SELECT 1').fetchone(), (1,))
+        db_pool.inherited_pools.remove(old_pool)
+        old_pool.dispose()
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    """The search filters on the list endpoints must be answered from an index."""
+
+    def setUp(self):
+        self.app = create_app()
+        with self.app.app_context():
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def query_plan(self, model, criteria, order=None, after=None):
+        with self.app.app_context():
+            _, query = projection(model, None, after, criteria, order)
+            sql = str(query.limit(101).compile(db.engine, compile_kwargs={'literal_binds': True}))
+            if db.engine.dialect.name == 'postgresql':
+                # Tiny test tables make a sequential scan cheapest; ask whether an index *can* be used
+                db.session.execute('SET LOCAL enable_seqscan = off')
+                plan = db.session.execute('EXPLAIN ' + sql).fetchall()
+            else:
+                plan = db.session.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+            db.session.rollback()
+        return ' '.join(str(line[-1]) for line in plan)
+
+    def test_age_range_uses_index(self):
+        self.assertIn('ix_actor_age', self.query_plan(Actor, {'min_age': 30, 'max_age': 40}))
+
+    def test_gender_uses_index(self):
+        self.assertIn('ix_actor_gender', self.query_plan(Actor, {'gender': 'Female'}))
+
+    def test_release_date_range_uses_index(self):
+        criteria = {'released_after': date(1940, 1, 1), 'released_before': date(1949, 12, 31)}
+        self.assertIn('ix_film_released_on', self.query_plan(Film, criteria))
+
+    def test_sort_by_count_uses_index(self):
+        self.assertIn('ix_actor_film_count', self.query_plan(Actor, None, ('film_count', True)))
+        self.assertIn('ix_film_cast_count', self.query_plan(Film, None, ('cast_count', False), (3, 10)))
+
+    def test_name_search_uses_trigram_index(self):
+        with self.app.app_context():
+            if db.engine.dialect.name != 'postgresql':
+                self.skipTest('trigram indexes need Postgres')
+        self.assertIn('ix_actor_name_trgm', self.query_plan(Actor, {'name': 'reeves'}))
+        self.assertIn('ix_film_name_trgm', self.query_plan(Film, {'name': 'casablanca'}))
+
+
+class FakeSharedClient:
+    """Local stand-in for the Redis commands SharedBackend uses."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def sadd(self, key, member):
+        self.data.setdefault(key, set()).add(member)
+
+    def smembers(self, key):
+        return set(self.data.get(key, ()))
+
+    def expire(self, key, seconds):
+        pass
+
+    def register_script(self, source):
+        """Emulate the token bucket script with a LocalBackend shared by every caller."""
+        buckets = self.data.setdefault('buckets', rate_limit.LocalBackend())
+        return lambda keys, args: str(buckets.take(keys[0], *args))
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+
+
+class SharedBackendTestCase(unittest.TestCase):
+    """Two workers sharing one store see each other's invalidations."""
+
+    def test_invalidation_is_shared(self):
+        client = FakeSharedClient()
+        worker_a, worker_b = SharedBackend(client), SharedBackend(client)
+        entry = Entry(b'{}', 'etag', 'application/json')
+        worker_a.set('/films?', entry, {'film'}, worker_a.current_epoch())
+        self.assertEqual(worker_b.get('/films?'), entry)
+        worker_b.invalidate({'film'})
+        self.assertIsNone(worker_a.get('/films?'))
+
+    def test_variants_round_trip(self):
+        backend = SharedBackend(FakeSharedClient())
+        entry = Entry(b'{"films": []}', 'etag', 'application/json', None, {'gzip': b'\x1f\x8b\n', 'br': b'\n\n'})
+        backend.set('/films?', entry, {'film'}, backend.current_epoch())
+        self.assertEqual(backend.get('/films?'), entry)
+
+    def test_stale_set_is_dropped(self):
+        backend = SharedBackend(FakeSharedClient())
+        epoch = backend.current_epoch()
+        backend.invalidate({'film'})
+        backend.set('/films?', Entry(b'{}', 'etag', 'application/json'), {'film'}, epoch)
+        self.assertIsNone(backend.get('/films?'))
+
+
+class SerialiseTestCase(unittest.TestCase):
+    """The row encoders produce the same JSON as encoding the row dicts."""
+
+    def test_row_encoder_matches_json(self):
+        fields = ['id', 'name', 'date_of_release', 'released_on', 'updated_at']
+        rows = [(1, 'Amélie "2001" \\ \n', '2001', date(2001, 4, 25), datetime(2021, 6, 1, 12, 30, 5, 250)),
+                (2, '%d %s 100%', '25-Apr-2001', None, datetime(2021, 6, 2))]
+        expected = [
+            {'id': 1, 'name': 'Amélie "2001" \\ \n', 'date_of_release': '2001', 'released_on': '2001-04-25',
+             'updated_at': '2021-06-01T12:30:05.000250'},
+            {'id': 2, 'name': '%d %s 100%', 'date_of_release': '25-Apr-2001', 'released_on': None,
+             'updated_at': '2021-06-02T00:00:00'}]
+        # The template encoders, and orjson over the row dicts when it's installed
+        for backend in (None, serialise.orjson):
+            with mock.patch.object(serialise, 'orjson', backend), mock.patch.object(serialise, '_encoders', {}):
+                self.assertEqual(json.loads(encode_rows(Film, fields, rows)), expected)
+                self.assertEqual([json.loads(row_encoder(Film, fields)(row)) for row in rows], expected)
+                self.assertIs(row_encoder(Film, fields), row_encoder(Film, fields))
+                # A trailing sort key selected for the cursor isn't encoded
+                self.assertEqual(json.loads(row_encoder(Film, fields)(rows[0] + (3,))), expected[0])
+
+    def test_list_document(self):
+        body = list_document('actors', encode_rows(Actor, ['id', 'age'], [(3, 41)]), 3)
+        self.assertEqual(json.loads(body), {'Success': 'True', 'actors': [{'id': 3, 'age': 41}], 'next': 3})
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import hashlib, threading, time
+from collections import OrderedDict
+
+
+DEFAULT_MAX_SIZE = 1024
+
+
+def token_digest(token):
+    """Cache key for a bearer token - the raw token is never kept in memory."""
+    return hashlib.sha256(token.encode()).digest()
+
+
+## Verified Token Cache
+class TokenCache:
+    """Bounded LRU cache of verified JWT payloads, keyed by token digest.
+
+    Each entry lives until the token's own `exp` claim, and is dropped early if
+    the signing key (kid) it was verified with is retired by the IdP.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()   # digest -> (payload, exp, kid)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Return the cached payload for a token, or None on a miss."""
+        digest = token_digest(token)
+        with self._lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, exp, kid = entry
+            if exp is not None and time.time() >= exp:
+                del self.entries[digest]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            return payload
+
+    def put(self, token, payload, kid):
+        """Remember a payload that has just been verified with key `kid`."""
+        if self.max_size <= 0:
+            return
+        digest = token_digest(token)
+        with self._lock:
+            self.entries[digest] = (payload, payload.get('exp'), kid)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def evict_kids(self, kids):
+        """Drop every entry verified with one of the given (rotated out) kids."""
+        with self._lock:
+            stale = [digest for digest, (_, _, kid) in self.entries.items() if kid in kids]
+            for digest in stale:
+                del self.entries[digest]
+            self.evictions += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Hit/miss/eviction counters, for measuring the verification work saved."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
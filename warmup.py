@@ -0,0 +1,117 @@
+"""Warm-up before and after gunicorn forks its workers, and the readiness it reports.
+
+With `preload_app` (see gunicorn.conf.py) the master imports the app once, fetches
+the JWKS and configures the ORM mappers, then closes its database connections, so
+every worker is forked with the keys and config already in memory and no sockets to
+share. Each worker then replaces the pools it inherited, starts its own background
+threads (including the co-star index build, which the co-star endpoints wait for
+rather than /ready) and opens one connection per engine before it accepts a request. GET /ready
+passes only once the worker serving it has done so; it only reports, and a warm-up
+that failed a step is tried again on a timer every WARM_UP_RETRY_SECONDS.
+"""
+import logging, os, threading, time
+from sqlalchemy import text
+from sqlalchemy.orm import configure_mappers
+
+import costar_graph, db_pool, import_jobs
+from auth import get_key_store
+from models import engines
+
+logger = logging.getLogger('warmup')
+
+WARM_UP_RETRY_SECONDS = float(os.environ.get('WARM_UP_RETRY_SECONDS', 5))
+
+
+class Readiness:
+    """Whether this process is warm, and the outcome of each warm-up step."""
+
+    def __init__(self):
+        self.pid = None
+        self.checks = {}
+        self.seconds = None
+        self.retry = None   # the timer that will warm up again, after a failed step
+
+    def record(self, checks, started):
+        self.pid = os.getpid()
+        self.checks = checks
+        self.seconds = time.perf_counter() - started
+
+    @property
+    def ready(self):
+        # State inherited from the master (or a previous worker) doesn't count
+        return self.pid == os.getpid() and bool(self.checks) and all(self.checks.values())
+
+    def status(self):
+        return {"ready": self.ready, "pid": os.getpid(), "checks": dict(self.checks),
+                "warm_up_ms": None if self.seconds is None else round(1000 * self.seconds, 1)}
+
+
+readiness = Readiness()
+
+
+def check(name, step, checks):
+    """Run one warm-up step, recording (and logging) whether it worked."""
+    try:
+        checks[name] = step() is not False
+    except Exception:
+        logger.exception('Warm-up step %s failed', name)
+        checks[name] = False
+
+
+def load_keys(app):
+    """Make sure the app's signing keys are in memory (a JWKS file is loaded with its key store)."""
+    key_store = get_key_store(app.config)
+    if not key_store.keys:
+        key_store.refresh(force=True)
+    return bool(key_store.keys)
+
+
+def warm_master(app):
+    """Before forking: load what every worker shares, then close the master's connections."""
+    started, checks = time.perf_counter(), {}
+    check('jwks', lambda: load_keys(app), checks)
+    check('mappers', configure_mappers, checks)
+    with app.app_context():
+        for engine in engines().values():
+            engine.dispose()
+    logger.info('Master warm in %.0f ms: %s', 1000 * (time.perf_counter() - started), checks)
+    return checks
+
+
+def ping(engine):
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+
+
+def warm_worker(app, forked=True):
+    """In a new worker, before it serves: its own pools and threads, and a live connection per engine."""
+    started, checks = time.perf_counter(), {}
+    with app.app_context():
+        named = engines()
+        if forked:
+            for engine in named.values():
+                db_pool.after_fork(engine)
+            if import_jobs.local_imports():
+                # The master's queue and thread didn't come across the fork
+                import_jobs.queue = import_jobs.queue_from_env()
+                import_jobs.init_app(app)
+        check('jwks', lambda: load_keys(app), checks)
+        if checks['jwks']:
+            get_key_store(app.config).start_background_refresh()
+        if costar_graph.graph.seq is None:
+            costar_graph.graph.start_build(app)
+        for name, engine in named.items():
+            check('database' if name == 'primary' else name, lambda: ping(engine), checks)
+    readiness.record(checks, started)
+    logger.info('Worker %d warm in %.0f ms: %s', readiness.pid, 1000 * readiness.seconds, checks)
+    if not readiness.ready:
+        retry_later(app)
+    return readiness.ready
+
+
+def retry_later(app):
+    """Warm up again in WARM_UP_RETRY_SECONDS, on a daemon timer (which retries in turn until it passes)."""
+    timer = threading.Timer(WARM_UP_RETRY_SECONDS, warm_worker, (app,), {'forked': False})
+    timer.daemon = True
+    readiness.retry = timer
+    timer.start()